@@ -1,5 +1,234 @@
+import logging
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from bson import ObjectId
+from django.conf import settings
+from django.core import signing
 from rest_framework import authentication, exceptions
-from .models import AuthToken
+from .models import AuthToken, JetonRevoque, User
+
+logger = logging.getLogger(__name__)
+
+SEL_JETON = 'core.authentication.jeton'
+MOTS_CLES = (b'bearer', b'token')
+
+
+class CacheTokens:
+    """
+    Cache LRU borné, avec expiration, des tokens validés : clé -> documents du token et de
+    l'utilisateur. Une requête authentifiée ne lit MongoDB qu'au premier usage d'une clé puis
+    toutes les `ttl` secondes ; la suppression d'un token ou le changement de mot de passe
+    invalident explicitement les entrées concernées (dans ce processus).
+    """
+
+    def __init__(self, taille: int = 1024, ttl: float = 60):
+        self.taille = taille
+        self.ttl = ttl
+        self.entrees: "OrderedDict[str, tuple]" = OrderedDict()
+        self.par_utilisateur: Dict[str, set] = {}
+        self.verrou = threading.Lock()
+        self.compteurs = {'succes': 0, 'echecs': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0}
+
+    def lire(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.verrou:
+            entree = self.entrees.get(key)
+            if entree is None:
+                self.compteurs['echecs'] += 1
+                return None
+            expiration, valeur = entree
+            if expiration < time.monotonic():
+                self._retirer(key)
+                self.compteurs['expirations'] += 1
+                self.compteurs['echecs'] += 1
+                return None
+            self.entrees.move_to_end(key)
+            self.compteurs['succes'] += 1
+            return valeur
+
+    def enregistrer(self, key: str, valeur: Dict[str, Any]):
+        if self.taille <= 0:
+            return
+        user_id = str(valeur['utilisateur']['_id'])
+        with self.verrou:
+            self._retirer(key)
+            self.entrees[key] = (time.monotonic() + self.ttl, valeur)
+            self.par_utilisateur.setdefault(user_id, set()).add(key)
+            while len(self.entrees) > self.taille:
+                self._retirer(next(iter(self.entrees)))
+                self.compteurs['evictions'] += 1
+
+    def _retirer(self, key: str):
+        entree = self.entrees.pop(key, None)
+        if entree is not None:
+            user_id = str(entree[1]['utilisateur']['_id'])
+            cles = self.par_utilisateur.get(user_id)
+            if cles is not None:
+                cles.discard(key)
+                if not cles:
+                    del self.par_utilisateur[user_id]
+
+    def invalider(self, key: str):
+        """Retire un token (déconnexion, suppression)"""
+        with self.verrou:
+            if key in self.entrees:
+                self._retirer(key)
+                self.compteurs['invalidations'] += 1
+
+    def invalider_utilisateur(self, user_id):
+        """Retire tous les tokens d'un utilisateur (sessions fermées, mot de passe ou profil modifiés)"""
+        with self.verrou:
+            for key in list(self.par_utilisateur.get(str(user_id), ())):
+                self._retirer(key)
+                self.compteurs['invalidations'] += 1
+
+    def vider(self):
+        with self.verrou:
+            self.compteurs['invalidations'] += len(self.entrees)
+            self.entrees.clear()
+            self.par_utilisateur.clear()
+
+    def statistiques(self) -> Dict[str, Any]:
+        with self.verrou:
+            lectures = self.compteurs['succes'] + self.compteurs['echecs']
+            return dict(
+                self.compteurs,
+                entrees=len(self.entrees),
+                taille=self.taille,
+                ttl=self.ttl,
+                taux_succes=round(100.0 * self.compteurs['succes'] / lectures, 1) if lectures else None,
+            )
+
+
+cache_tokens = CacheTokens(
+    taille=getattr(settings, 'AUTH_CACHE_TAILLE', 1024),
+    ttl=getattr(settings, 'AUTH_CACHE_TTL', 60),
+)
+
+
+def signer_jeton(user, session_id=None) -> Tuple[str, int]:
+    """
+    Jeton d'accès signé (HMAC de SECRET_KEY) portant l'id, le rôle, l'expiration, un identifiant
+    unique (jti) et la session (sid : AuthToken de rafraîchissement) ; vérifié sans lecture de la
+    base. Retourne (jeton, expiration en secondes epoch).
+    """
+    expiration = int(time.time() + getattr(settings, 'AUTH_JETON_DUREE', 900))
+    charge = {'id': str(user.id), 'role': user.role, 'exp': expiration, 'jti': secrets.token_hex(8)}
+    if session_id is not None:
+        charge['sid'] = str(session_id)
+    return signing.dumps(charge, salt=SEL_JETON), expiration
+
+
+def lire_jeton(jeton: str) -> Dict[str, Any]:
+    """Charge d'un jeton signé ; AuthenticationFailed s'il est altéré, expiré ou révoqué"""
+    try:
+        charge = signing.loads(jeton, salt=SEL_JETON)
+    except signing.BadSignature:
+        raise exceptions.AuthenticationFailed("Token non valide.")
+    if charge.get('exp', 0) < time.time():
+        raise exceptions.AuthenticationFailed("Token expiré.")
+    if revocations.est_revoque(charge.get('jti')):
+        raise exceptions.AuthenticationFailed("Token révoqué.")
+    return charge
+
+
+class Revocations:
+    """
+    Liste des jetons signés révoqués, en mémoire : rechargée depuis JetonRevoque au plus toutes les
+    `intervalle` secondes (une révocation faite dans un autre processus est vue après ce délai) ;
+    si MongoDB ne répond pas, la dernière liste chargée reste utilisée.
+    """
+
+    def __init__(self, intervalle: float = 30):
+        self.intervalle = intervalle
+        self.jtis: Dict[str, datetime] = {}
+        self.prochain_chargement = 0.0
+        self.verrou = threading.Lock()
+
+    def recharger(self):
+        maintenant = datetime.utcnow()
+        try:
+            jtis = {
+                revocation['jti']: revocation['expiresAt']
+                for revocation in JetonRevoque._get_collection().find(
+                    {'expiresAt': {'$gt': maintenant}}, {'jti': 1, 'expiresAt': 1}
+                )
+            }
+        except Exception:
+            logger.exception("Chargement des jetons révoqués impossible")
+            jtis = {jti: expiration for jti, expiration in self.jtis.items() if expiration > maintenant}
+        with self.verrou:
+            self.jtis = jtis
+            self.prochain_chargement = time.monotonic() + self.intervalle
+
+    def est_revoque(self, jti: str) -> bool:
+        if time.monotonic() >= self.prochain_chargement:
+            self.recharger()
+        return jti in self.jtis
+
+    def revoquer(self, jti: str, expiration: int):
+        """Révoque un jeton jusqu'à son expiration (écrit en base pour les autres processus)"""
+        expire = datetime.utcfromtimestamp(expiration)
+        JetonRevoque._get_collection().update_one(
+            {'jti': jti}, {'$set': {'expiresAt': expire}}, upsert=True
+        )
+        with self.verrou:
+            self.jtis[jti] = expire
+
+
+revocations = Revocations(intervalle=getattr(settings, 'AUTH_REVOCATIONS_INTERVALLE', 30))
+
+
+def utilisateur_complet(user) -> User:
+    """Utilisateur avec tous ses champs : relu si l'authentification par jeton signé n'a fourni que l'id et le rôle"""
+    if user.email is None:
+        return User.objects.get(id=user.id)
+    return user
+
+
+def cle_requete(request) -> Optional[str]:
+    """Clé du token de l'en-tête Authorization (Bearer ou Token) ; None sans en-tête, AuthenticationFailed s'il est mal formé"""
+    auth = authentication.get_authorization_header(request).split()
+
+    if not auth or auth[0].lower() not in MOTS_CLES:
+        return None
+
+    if len(auth) == 1:
+        msg = "En-tête de token invalide. Aucune informations d'identification fournies."
+        raise exceptions.AuthenticationFailed(msg)
+    elif len(auth) > 2:
+        msg = "En-tête de token invalide. La chaîne de token ne doit pas contenir d'espaces."
+        raise exceptions.AuthenticationFailed(msg)
+
+    try:
+        return auth[1].decode()
+    except UnicodeError:
+        msg = "En-tête de token invalide. Le token contient des caractères non valides."
+        raise exceptions.AuthenticationFailed(msg)
+
+
+def identifier(request) -> Optional[Tuple[User, Any]]:
+    """
+    (utilisateur, token) de la requête, résolu une seule fois : le résultat, ou l'échec, est gardé
+    sur la requête Django et réutilisé par le middleware, DRF et les vues. None sans token.
+    """
+    requete = getattr(request, '_request', request)
+    try:
+        resultat = requete._identite
+    except AttributeError:
+        try:
+            cle = cle_requete(requete)
+            resultat = MongoTokenAuthentication().authenticate_credentials(cle) if cle else None
+        except exceptions.AuthenticationFailed as e:
+            resultat = e
+        requete._identite = resultat
+    if isinstance(resultat, exceptions.AuthenticationFailed):
+        raise resultat
+    return resultat
 
 
 class MongoTokenAuthentication(authentication.BaseAuthentication):
@@ -10,33 +239,43 @@ class MongoTokenAuthentication(authentication.BaseAuthentication):
     keyword = "Bearer"
 
     def authenticate(self, request):
-        auth = authentication.get_authorization_header(request).split()
-
-        if not auth or auth[0].lower() != self.keyword.lower().encode():
-            return None
+        return identifier(request)
 
-        if len(auth) == 1:
-            msg = "En-tête de token invalide. Aucune informations d'identification fournies."
-            raise exceptions.AuthenticationFailed(msg)
-        elif len(auth) > 2:
-            msg = "En-tête de token invalide. La chaîne de token ne doit pas contenir d'espaces."
-            raise exceptions.AuthenticationFailed(msg)
+    def charger(self, key):
+        """Token et utilisateur en une seule requête ($lookup) ; None si le token n'existe pas"""
+        for token in AuthToken._get_collection().aggregate([
+            {'$match': {'key': key}},
+            {'$limit': 1},
+            {'$lookup': {
+                'from': User._get_collection_name(), 'localField': 'user', 'foreignField': '_id', 'as': 'utilisateur',
+            }},
+        ]):
+            if token['utilisateur']:
+                return {'utilisateur': token.pop('utilisateur')[0], 'token': token}
+        return None
 
-        try:
-            token = auth[1].decode()
-        except UnicodeError:
-            msg = "En-tête de token invalide. Le token contient des caractères non valides."
-            raise exceptions.AuthenticationFailed(msg)
+    def authenticate_credentials(self, key):
+        # Jeton signé (contient des ':') : vérifié sans base ; request.auth est sa charge
+        if ':' in key:
+            charge = lire_jeton(key)
+            return (User._from_son({'_id': ObjectId(charge['id']), 'role': charge['role']}), charge)
 
-        return self.authenticate_credentials(token)
+        documents = cache_tokens.lire(key)
+        if documents is None:
+            documents = self.charger(key)
+            if documents is None:
+                raise exceptions.AuthenticationFailed("Token non valide.")
+            cache_tokens.enregistrer(key, documents)
 
-    def authenticate_credentials(self, key):
-        try:
-            token = AuthToken.objects.get(key=key)
-        except AuthToken.DoesNotExist:
-            raise exceptions.AuthenticationFailed("Token non valide.")
+        # L'index TTL supprime les tokens expirés avec un délai, et le cache peut en garder un
+        expiration = documents['token'].get('expiresAt')
+        if expiration is not None and expiration <= datetime.utcnow():
+            cache_tokens.invalider(key)
+            raise exceptions.AuthenticationFailed("Token expiré.")
 
-        user = token.user
+        # Nouvelles instances à chaque requête : une vue peut modifier l'utilisateur sans toucher au cache
+        user = User._from_son(dict(documents['utilisateur']))
+        token = AuthToken._from_son(dict(documents['token']))
 
         # Vérifier que l'utilisateur est actif
         if not getattr(user, "is_active", True):
@@ -0,0 +1,169 @@
+"""
+Diffusion des notifications hors du cycle requête/réponse (outbox)
+
+La création d'un devoir ou d'un message n'écrit qu'une entrée NotificationEnAttente. Les entrées
+sont réservées une à une (find_one_and_update) puis traitées par lots, soit par le pool de threads
+de la diffusion juste après la requête, soit par la commande `python manage.py diffuser_notifications`.
+Une entrée n'est marquée envoyée qu'après la création de ses notifications : en cas d'interruption
+elle est reprise à l'expiration de son verrou (livraison au moins une fois ; une nouvelle tentative
+ne notifie pas deux fois le même destinataire), dans la limite de NOTIFICATIONS_TENTATIVES_MAX.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+
+from .models import Message, Notification, NotificationEnAttente
+from .services import NotificationService, id_reference
+
+DUREE_VERROU = timedelta(minutes=5)
+
+_executeur = None
+_verrou = threading.Lock()
+
+
+def executeur() -> ThreadPoolExecutor:
+    """
+    Pool de threads de la diffusion, créé à la première publication : séparé de celui des jobs pour
+    que les notifications n'attendent pas la fin d'un recalcul de toute l'école
+    """
+    global _executeur
+    with _verrou:
+        if _executeur is None:
+            _executeur = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'NOTIFICATIONS_DIFFUSION_WORKERS', 1),
+                thread_name_prefix='diffusion'
+            )
+    return _executeur
+
+
+def _notifications_devoir(reference_id: ObjectId) -> List[Dict[str, Any]]:
+    return NotificationService.notifications_devoir(str(reference_id))
+
+
+def _notifications_message(reference_id: ObjectId) -> List[Dict[str, Any]]:
+    message = Message.objects.get(id=reference_id)
+    maintenant = datetime.utcnow()
+    return [{
+        'destinataire': ObjectId(id_reference(message, 'receiver')),
+        'type': 'message',
+        'referenceId': reference_id,
+        'lu': False,
+        'dateEnvoi': maintenant,
+        'createdAt': maintenant,
+        'updatedAt': maintenant,
+    }]
+
+
+# type d'entrée -> documents de notification à insérer
+TYPES_DIFFUSION = {
+    'devoir': _notifications_devoir,
+    'message': _notifications_message,
+}
+
+
+class DiffusionService:
+    """Service pour la file d'attente des notifications et son traitement par lots"""
+
+    @staticmethod
+    def publier(type_notification: str, reference_id: str, immediate: bool = None) -> NotificationEnAttente:
+        """Enregistre l'entrée à diffuser ; si immediate, un thread du pool vide la file sans attendre la commande"""
+        entree = NotificationEnAttente(
+            type=type_notification,
+            referenceId=ObjectId(reference_id),
+            prochainEssai=datetime.utcnow(),
+        )
+        entree.save()
+
+        if immediate is None:
+            immediate = getattr(settings, 'NOTIFICATIONS_DIFFUSION_IMMEDIATE', True)
+        if immediate:
+            executeur().submit(DiffusionService.traiter_lot)
+        return entree
+
+    @staticmethod
+    def reserver(tentatives_max: int = None) -> Optional[Dict[str, Any]]:
+        """
+        Réserve l'entrée la plus ancienne prête à être traitée, ou dont le verrou a expiré sans avoir
+        épuisé ses tentatives (une entrée qui tue son worker n'est pas reprise indéfiniment)
+        """
+        tentatives_max = tentatives_max or getattr(settings, 'NOTIFICATIONS_TENTATIVES_MAX', 5)
+        maintenant = datetime.utcnow()
+        return NotificationEnAttente._get_collection().find_one_and_update(
+            {'$or': [
+                {'statut': 'en_attente', 'prochainEssai': {'$lte': maintenant}},
+                {'statut': 'en_cours', 'verrouJusqua': {'$lt': maintenant}, 'tentatives': {'$lt': tentatives_max}},
+            ]},
+            {
+                '$set': {'statut': 'en_cours', 'verrouJusqua': maintenant + DUREE_VERROU, 'updatedAt': maintenant},
+                '$inc': {'tentatives': 1},
+            },
+            sort=[('prochainEssai', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    def abandonner_interrompues(tentatives_max: int) -> int:
+        """Marque échouées les entrées interrompues (verrou expiré) à leur dernière tentative"""
+        maintenant = datetime.utcnow()
+        return NotificationEnAttente._get_collection().update_many(
+            {'statut': 'en_cours', 'verrouJusqua': {'$lt': maintenant}, 'tentatives': {'$gte': tentatives_max}},
+            {'$set': {
+                'statut': 'echouee',
+                'derniereErreur': "Traitement interrompu à chaque tentative",
+                'updatedAt': maintenant,
+            }},
+        ).modified_count
+
+    @staticmethod
+    def diffuser(entree: Dict[str, Any]) -> int:
+        """Crée les notifications d'une entrée ; à partir de la 2e tentative, les destinataires déjà notifiés sont exclus"""
+        documents = TYPES_DIFFUSION[entree['type']](entree['referenceId'])
+        if entree.get('tentatives', 1) > 1 and documents:
+            deja_notifies = set(Notification._get_collection().distinct('destinataire', {
+                'type': entree['type'],
+                '$or': [{'referenceId': entree['referenceId']}, {'references': entree['referenceId']}],
+            }))
+            documents = [document for document in documents if document['destinataire'] not in deja_notifies]
+        return NotificationService.inserer_notifications(documents)
+
+    @staticmethod
+    def traiter_lot(limite: int = None) -> Dict[str, int]:
+        """Traite jusqu'à limite entrées ; une erreur reporte l'entrée (délai croissant) ou l'abandonne"""
+        limite = limite or getattr(settings, 'NOTIFICATIONS_TAILLE_LOT', 100)
+        tentatives_max = getattr(settings, 'NOTIFICATIONS_TENTATIVES_MAX', 5)
+        collection = NotificationEnAttente._get_collection()
+        rapport = {'traitees': 0, 'envoyees': 0, 'reportees': 0, 'echouees': 0, 'notifications_creees': 0}
+        rapport['echouees'] += DiffusionService.abandonner_interrompues(tentatives_max)
+
+        for _ in range(limite):
+            entree = DiffusionService.reserver(tentatives_max)
+            if entree is None:
+                break
+            rapport['traitees'] += 1
+
+            try:
+                rapport['notifications_creees'] += DiffusionService.diffuser(entree)
+            except Exception as e:
+                maintenant = datetime.utcnow()
+                abandon = entree['tentatives'] >= tentatives_max
+                collection.update_one({'_id': entree['_id']}, {'$set': {
+                    'statut': 'echouee' if abandon else 'en_attente',
+                    'prochainEssai': maintenant + timedelta(seconds=30 * 2 ** entree['tentatives']),
+                    'derniereErreur': str(e),
+                    'updatedAt': maintenant,
+                }})
+                rapport['echouees' if abandon else 'reportees'] += 1
+                continue
+
+            maintenant = datetime.utcnow()
+            collection.update_one({'_id': entree['_id']}, {'$set': {
+                'statut': 'envoyee', 'dateEnvoi': maintenant, 'updatedAt': maintenant,
+            }})
+            rapport['envoyees'] += 1
+
+        return rapport
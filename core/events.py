@@ -0,0 +1,174 @@
+"""
+Diffusion en temps réel des notifications (Server-Sent Events, servi par ASGI)
+
+Chaque processus tient un registre des connexions ouvertes (une file asyncio par connexion) et une
+seule tâche de lecture partagée : elle interroge MongoDB pour les notifications récentes des
+utilisateurs connectés (curseur sur updatedAt avec une marge de recouvrement) et les distribue aux
+files : une notification regroupée qui reçoit un nouveau devoir ou message est renvoyée. MongoDB
+sert ainsi de transport entre processus : une notification insérée par un autre worker ou par la
+commande `diffuser_notifications` est vue au plus tard après NOTIFICATIONS_STREAM_INTERVALLE
+secondes ; une insertion dans ce processus réveille la lecture immédiatement.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from django.conf import settings
+
+from .models import Notification
+
+logger = logging.getLogger(__name__)
+
+# Recouvrement entre deux lectures : couvre les écarts d'horloge entre les processus qui insèrent
+MARGE = timedelta(seconds=5)
+TAILLE_FILE = 100
+EPOQUE = datetime(1970, 1, 1)
+
+
+def evenement(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Notification au format de NotificationSerializer"""
+    def date(valeur):
+        return valeur.isoformat() if valeur else None
+
+    return {
+        'id': str(document['_id']),
+        'destinataire': str(document.get('destinataire')),
+        'type': document.get('type'),
+        'referenceId': str(document['referenceId']) if document.get('referenceId') else None,
+        'references': [str(reference) for reference in document.get('references') or []],
+        'lu': document.get('lu', False),
+        'dateEnvoi': date(document.get('dateEnvoi')),
+        'createdAt': date(document.get('createdAt')),
+        'updatedAt': date(document.get('updatedAt')),
+    }
+
+
+class Abonnements:
+    """Registre des connexions SSE d'un processus et tâche de lecture partagée"""
+
+    def __init__(self):
+        self.files: Dict[str, Set[asyncio.Queue]] = {}
+        self.boucle = None
+        self.tache = None
+        self.reveil = None
+        self.curseur = None
+        self.plancher = None
+        self.envoyes: Dict[Tuple[ObjectId, datetime], float] = {}
+        self.verrou = threading.Lock()
+
+    async def abonner(self, user_id: str) -> asyncio.Queue:
+        """Ouvre une file pour une connexion ; démarre la lecture si c'est la première"""
+        file = asyncio.Queue(maxsize=TAILLE_FILE)
+        self.files.setdefault(user_id, set()).add(file)
+
+        if self.tache is None or self.tache.done() or self.boucle is not asyncio.get_running_loop():
+            with self.verrou:
+                self.boucle = asyncio.get_running_loop()
+                self.reveil = asyncio.Event()
+            # Rien d'antérieur au démarrage de la lecture (le rattrapage passe par Last-Event-ID)
+            maintenant = datetime.utcnow()
+            self.curseur = self.plancher = maintenant.replace(microsecond=maintenant.microsecond // 1000 * 1000)
+            self.tache = self.boucle.create_task(self.interroger())
+        return file
+
+    def desabonner(self, user_id: str, file: asyncio.Queue):
+        """Ferme la file d'une connexion ; la lecture s'arrête quand plus personne n'écoute"""
+        files = self.files.get(user_id)
+        if files is not None:
+            files.discard(file)
+            if not files:
+                del self.files[user_id]
+
+    def signaler(self):
+        """Réveille la lecture (appelable depuis n'importe quel thread) après une insertion de notifications"""
+        with self.verrou:
+            boucle, reveil = self.boucle, self.reveil
+        if boucle is not None and reveil is not None and not boucle.is_closed():
+            boucle.call_soon_threadsafe(reveil.set)
+
+    def lire(self, destinataires: List[str]) -> List[Dict[str, Any]]:
+        """
+        Notifications non lues créées ou complétées (regroupement) depuis la dernière lecture,
+        moins la marge, sans les versions déjà distribuées
+        """
+        maintenant = datetime.utcnow()
+        documents = Notification._get_collection().find({
+            'destinataire': {'$in': [ObjectId(user_id) for user_id in destinataires]},
+            'lu': False,
+            'updatedAt': {'$gte': max(self.curseur - MARGE, self.plancher)},
+        }).sort('updatedAt', 1)
+        self.curseur = maintenant
+
+        horloge = time.monotonic()
+        nouveaux = []
+        for document in documents:
+            cle = (document['_id'], document.get('updatedAt'))
+            if cle not in self.envoyes:
+                self.envoyes[cle] = horloge
+                nouveaux.append(document)
+
+        limite = horloge - 2 * MARGE.total_seconds()
+        self.envoyes = {cle: date for cle, date in self.envoyes.items() if date >= limite}
+        return nouveaux
+
+    def distribuer(self, documents: List[Dict[str, Any]]):
+        """Place chaque notification dans les files de son destinataire (une file pleine perd l'événement)"""
+        for document in documents:
+            for file in self.files.get(str(document.get('destinataire')), ()):
+                if not file.full():
+                    file.put_nowait((identifiant(document), evenement(document)))
+
+    async def interroger(self):
+        """Boucle de lecture : toutes les NOTIFICATIONS_STREAM_INTERVALLE secondes ou au premier signal"""
+        intervalle = getattr(settings, 'NOTIFICATIONS_STREAM_INTERVALLE', 2)
+        while self.files:
+            try:
+                await asyncio.wait_for(self.reveil.wait(), timeout=intervalle)
+            except asyncio.TimeoutError:
+                pass
+            self.reveil.clear()
+            if not self.files:
+                break
+
+            try:
+                documents = await asyncio.to_thread(self.lire, list(self.files))
+            except Exception:
+                logger.exception("Lecture des notifications pour le flux SSE impossible")
+                continue
+            self.distribuer(documents)
+
+
+abonnements = Abonnements()
+
+
+def identifiant(document: Dict[str, Any]) -> str:
+    """Identifiant d'événement SSE : id de la notification et updatedAt en millisecondes"""
+    date = document.get('updatedAt') or document['_id'].generation_time.replace(tzinfo=None)
+    return f"{document['_id']}:{int((date - EPOQUE).total_seconds() * 1000)}"
+
+
+def date_identifiant(dernier_id: str) -> Optional[datetime]:
+    """updatedAt porté par un Last-Event-ID (date de l'ObjectId s'il est seul) ; None s'il est invalide"""
+    notification_id, _, millisecondes = dernier_id.partition(':')
+    if not ObjectId.is_valid(notification_id):
+        return None
+    if millisecondes.isdigit():
+        return EPOQUE + timedelta(milliseconds=int(millisecondes))
+    return ObjectId(notification_id).generation_time.replace(tzinfo=None)
+
+
+def rattrapage(user_id: str, dernier_id: str, limite: int = TAILLE_FILE) -> List[Tuple[str, Dict[str, Any]]]:
+    """Notifications non lues créées ou complétées depuis Last-Event-ID, envoyées à la reconnexion d'un client"""
+    depuis = date_identifiant(dernier_id)
+    if depuis is None:
+        return []
+    documents = Notification._get_collection().find({
+        'destinataire': ObjectId(user_id),
+        'lu': False,
+        'updatedAt': {'$gt': depuis},
+    }).sort('updatedAt', 1).limit(limite)
+    return [(identifiant(document), evenement(document)) for document in documents]
@@ -0,0 +1,198 @@
+"""
+Exécution en arrière-plan des opérations longues (calcul des notes, promotion)
+
+Une opération est découpée en morceaux (une classe par morceau). Le document Job enregistre
+les morceaux terminés, les compteurs et les erreurs : un job interrompu reprend au premier
+morceau non terminé (commande `python manage.py reprendre_jobs`).
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+from bson import ObjectId
+from django.conf import settings
+from pymongo import ReturnDocument
+
+from .models import Eleve, Job
+from .services import NoteService, PromotionService
+
+SANS_CLASSE = 'sans_classe'
+
+_executeur = None
+_verrou = threading.Lock()
+
+
+def executeur() -> ThreadPoolExecutor:
+    """Pool de threads partagé par le processus, créé au premier job"""
+    global _executeur
+    with _verrou:
+        if _executeur is None:
+            _executeur = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'JOBS_WORKERS', 2),
+                thread_name_prefix='job'
+            )
+    return _executeur
+
+
+def _classes_inscrites(parametres: Dict[str, Any]) -> List[str]:
+    return list(NoteService.planifier_inscriptions(
+        parametres.get('classe_id'), parametres.get('subdivision')
+    ))
+
+
+def _compteurs_calcul(rapport: Dict[str, Any]) -> Dict[str, int]:
+    return dict(rapport['ecriture'], notes_calculees=rapport['notes_calculees'])
+
+
+def _classes_eleves(parametres: Dict[str, Any]) -> List[str]:
+    classes = Eleve._get_collection().distinct('classe')
+    return [str(classe) if classe else SANS_CLASSE for classe in classes]
+
+
+def _promouvoir_classe(parametres: Dict[str, Any], morceau: str) -> Dict[str, int]:
+    if parametres.get('mode', 'lot') == 'lot':
+        if morceau == SANS_CLASSE:
+            return {'promotions_reussies': 0, 'promotions_echouees': Eleve._get_collection().count_documents({'classe': None})}
+        rapport = PromotionService.promouvoir_lot(
+            parametres['annee_scolaire_id'], parametres.get('methode_subdivision', 'auto'), classe_id=morceau
+        )
+        return {cle: rapport[cle] for cle in ('promotions_reussies', 'promotions_echouees')}
+
+    classe = None if morceau == SANS_CLASSE else ObjectId(morceau)
+    eleve_ids = [eleve['_id'] for eleve in Eleve._get_collection().find({'classe': classe}, {'_id': 1})]
+    return PromotionService.promouvoir_eleves(
+        eleve_ids, parametres['annee_scolaire_id'], parametres.get('methode_subdivision', 'auto')
+    )
+
+
+# type de job -> (liste des morceaux, traitement d'un morceau retournant des compteurs)
+TYPES_JOBS: Dict[str, Dict[str, Callable]] = {
+    'calcul_notes_trimestrielles': {
+        'morceaux': _classes_inscrites,
+        'traiter': lambda parametres, morceau: _compteurs_calcul(NoteService.calculer_trimestre(
+            parametres['trimestre_id'], classe_id=morceau,
+            subdivision=parametres.get('subdivision'), mode=parametres.get('mode', 'agregation')
+        )),
+    },
+    'calcul_notes_annuelles': {
+        'morceaux': _classes_inscrites,
+        'traiter': lambda parametres, morceau: _compteurs_calcul(NoteService.calculer_annee(
+            parametres['annee_scolaire_id'], classe_id=morceau, subdivision=parametres.get('subdivision')
+        )),
+    },
+    'promotion_automatique': {
+        'morceaux': _classes_eleves,
+        'traiter': _promouvoir_classe,
+    },
+}
+
+
+class JobService:
+    """Service pour la création, l'exécution et la reprise des jobs"""
+
+    @staticmethod
+    def creer(type_job: str, parametres: Dict[str, Any], utilisateur=None) -> Job:
+        """Crée le job et fige la liste de ses morceaux"""
+        job = Job(
+            type=type_job,
+            parametres=parametres,
+            morceaux=TYPES_JOBS[type_job]['morceaux'](parametres),
+            compteurs={},
+            demandePar=utilisateur,
+        )
+        job.save()
+        return job
+
+    @staticmethod
+    def soumettre(type_job: str, parametres: Dict[str, Any], utilisateur=None) -> Job:
+        """Crée le job et le confie au pool ; retourne immédiatement"""
+        job = JobService.creer(type_job, parametres, utilisateur)
+        executeur().submit(JobService.executer, str(job.id))
+        return job
+
+    @staticmethod
+    def reserver(job_id: str, delai_reprise: timedelta = None) -> Dict[str, Any]:
+        """
+        Passe le job en cours s'il est en attente (ou, pour une reprise, en cours sans activité
+        depuis delai_reprise). Retourne None si un autre worker l'exécute déjà.
+        """
+        maintenant = datetime.utcnow()
+        statuts = [{'statut': 'en_attente'}]
+        if delai_reprise is not None:
+            statuts.append({'statut': 'en_cours', 'derniereActivite': {'$lt': maintenant - delai_reprise}})
+            statuts.append({'statut': 'echoue'})
+
+        return Job._get_collection().find_one_and_update(
+            {'_id': ObjectId(job_id), '$or': statuts},
+            [{'$set': {
+                'statut': 'en_cours',
+                'derniereActivite': maintenant,
+                'dateDebut': {'$ifNull': ['$dateDebut', maintenant]},
+            }}],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @staticmethod
+    def executer(job_id: str, delai_reprise: timedelta = None) -> Dict[str, Any]:
+        """Traite les morceaux non terminés du job ; chaque morceau terminé est enregistré aussitôt"""
+        job = JobService.reserver(job_id, delai_reprise)
+        if job is None:
+            return None
+
+        collection = Job._get_collection()
+        morceaux = job.get('morceaux', [])
+        termines = set(job.get('morceauxTermines', []))
+        traiter = TYPES_JOBS[job['type']]['traiter']
+        en_erreur = 0
+
+        for morceau in morceaux:
+            if morceau in termines:
+                continue
+            try:
+                compteurs = traiter(job.get('parametres', {}), morceau)
+            except Exception as e:
+                en_erreur += 1
+                collection.update_one({'_id': job['_id']}, {
+                    '$push': {'erreurs': {'morceau': morceau, 'message': str(e), 'date': datetime.utcnow()}},
+                    '$set': {'derniereActivite': datetime.utcnow()},
+                })
+                continue
+
+            termines.add(morceau)
+            collection.update_one({'_id': job['_id']}, {
+                '$addToSet': {'morceauxTermines': morceau},
+                '$inc': {f'compteurs.{cle}': valeur for cle, valeur in compteurs.items()},
+                '$set': {
+                    'progression': round(100.0 * len(termines) / len(morceaux), 1),
+                    'derniereActivite': datetime.utcnow(),
+                },
+            })
+
+        maintenant = datetime.utcnow()
+        collection.update_one({'_id': job['_id']}, {'$set': {
+            'statut': 'echoue' if en_erreur else 'termine',
+            'progression': round(100.0 * len(termines) / len(morceaux), 1) if morceaux else 100.0,
+            'dateFin': maintenant,
+            'derniereActivite': maintenant,
+            'updatedAt': maintenant,
+        }})
+        return collection.find_one({'_id': job['_id']})
+
+    @staticmethod
+    def reprendre(delai_minutes: int = 5, inclure_echoues: bool = False) -> List[Dict[str, Any]]:
+        """Relance les jobs interrompus (en cours sans activité depuis delai_minutes) à partir de leur dernier morceau terminé"""
+        delai = timedelta(minutes=delai_minutes)
+        statuts = [
+            {'statut': 'en_attente', 'createdAt': {'$lt': datetime.utcnow() - delai}},
+            {'statut': 'en_cours', 'derniereActivite': {'$lt': datetime.utcnow() - delai}},
+        ]
+        if inclure_echoues:
+            statuts.append({'statut': 'echoue'})
+
+        resultats = []
+        for job in Job._get_collection().find({'$or': statuts}, {'_id': 1}):
+            resultat = JobService.executer(str(job['_id']), delai_reprise=delai)
+            if resultat is not None:
+                resultats.append(resultat)
+        return resultats
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from core.services import RetentionNotificationService
+
+
+def _taille(octets: int) -> str:
+    for unite in ('o', 'Ko', 'Mo', 'Go'):
+        if abs(octets) < 1024 or unite == 'Go':
+            return f"{octets:.0f} {unite}" if unite == 'o' else f"{octets:.1f} {unite}"
+        octets /= 1024
+
+
+class Command(BaseCommand):
+    help = "Archive les notifications lues anciennes et compacte la collection des notifications"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jours', type=int, default=None,
+                            help="Ancienneté (jours depuis l'envoi) au-delà de laquelle une notification lue est archivée")
+        parser.add_argument('--lot', type=int, default=1000, help="Nombre de notifications déplacées par lot")
+        parser.add_argument('--compacter', action='store_true',
+                            help="Lancer `compact` sur la collection pour rendre l'espace libéré au système")
+
+    def handle(self, *args, **options):
+        rapport = RetentionNotificationService.compacter(options['jours'], options['lot'], options['compacter'])
+
+        self.stdout.write(f"{rapport['archivees']} notification(s) archivée(s) en {rapport['lots']} lot(s)")
+        avant, apres, recupere = rapport['avant'], rapport['apres'], rapport['recupere']
+        for cle, libelle in (('size', 'Données'), ('storageSize', 'Stockage'), ('totalIndexSize', 'Index')):
+            self.stdout.write(
+                f"{libelle} : {_taille(avant[cle])} -> {_taille(apres[cle])} ({_taille(recupere[cle])} récupéré(s))"
+            )
+        if rapport['compaction']:
+            self.stdout.write(f"Compaction : {rapport['compaction']}")
+        if rapport['expiration_archive']:
+            self.stdout.write(f"Archive : {rapport['archive']['count']} document(s), "
+                              f"expiration après {rapport['expiration_archive'] // 86400} jour(s)")
+        else:
+            self.stdout.write(f"Archive : {rapport['archive']['count']} document(s), sans expiration")
+        self.stdout.write(self.style.SUCCESS("Archivage terminé"))
@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core.diffusion import DiffusionService
+
+
+class Command(BaseCommand):
+    help = "Diffuse les notifications en attente (devoirs, messages) par lots"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lot', type=int, default=None, help="Nombre maximum d'entrées traitées par lot")
+        parser.add_argument('--intervalle', type=float, default=5,
+                            help="Secondes d'attente quand la file est vide")
+        parser.add_argument('--une-fois', action='store_true', help="Vider la file puis s'arrêter")
+
+    def handle(self, *args, **options):
+        while True:
+            rapport = DiffusionService.traiter_lot(options['lot'])
+            if rapport['traitees']:
+                self.stdout.write(
+                    f"{rapport['envoyees']} envoyée(s), {rapport['reportees']} reportée(s), "
+                    f"{rapport['echouees']} échouée(s), {rapport['notifications_creees']} notification(s) créée(s)"
+                )
+                continue
+            if options['une_fois']:
+                break
+            time.sleep(options['intervalle'])
+        self.stdout.write(self.style.SUCCESS("File de notifications vide"))
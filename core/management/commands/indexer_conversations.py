@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from core.services import ConversationService
+
+
+class Command(BaseCommand):
+    help = "Rattache les messages existants à leur conversation et recalcule les conversations"
+
+    def handle(self, *args, **options):
+        messages = ConversationService.indexer_messages()
+        self.stdout.write(f"{messages} message(s) complété(s) (clé de conversation, date de création)")
+        conversations = ConversationService.reconstruire()
+        self.stdout.write(self.style.SUCCESS(f"{conversations} conversation(s) recalculée(s)"))
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from core.jobs import JobService
+
+
+class Command(BaseCommand):
+    help = "Reprend les jobs interrompus à partir de leur dernier morceau terminé"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', help="Identifiant d'un job précis à reprendre")
+        parser.add_argument('--delai', type=int, default=5,
+                            help="Minutes sans activité au-delà desquelles un job en cours est considéré interrompu")
+        parser.add_argument('--echoues', action='store_true', help="Relancer aussi les morceaux en erreur des jobs échoués")
+
+    def handle(self, *args, **options):
+        if options['job']:
+            resultat = JobService.executer(options['job'], delai_reprise=timedelta(minutes=options['delai']))
+            jobs = [resultat] if resultat else []
+        else:
+            jobs = JobService.reprendre(options['delai'], options['echoues'])
+
+        for job in jobs:
+            self.stdout.write(
+                f"{job['_id']} {job['type']} : {job['statut']} "
+                f"({len(job.get('morceauxTermines', []))}/{len(job.get('morceaux', []))} morceaux)"
+            )
+        self.stdout.write(self.style.SUCCESS(f"{len(jobs)} job(s) repris"))
@@ -2,33 +2,28 @@
 Middleware personnalisé pour l'authentification avec MongoDB et mongoengine
 """
 from django.utils.deprecation import MiddlewareMixin
-from django.http import HttpResponse
-from .services import AuthTokenService
-import json
+from django.utils.functional import SimpleLazyObject
+from rest_framework import exceptions
+from .authentication import identifier
 
 class MongoAuthenticationMiddleware(MiddlewareMixin):
     """
-    Middleware pour l'authentification avec les utilisateurs MongoDB
+    Middleware pour l'authentification avec les utilisateurs MongoDB : même résolution que DRF
+    (core.authentication.identifier), faite au premier accès à request.user et partagée avec les vues
     """
     
     def process_request(self, request):
-        # Récupérer le token de l'en-tête Authorization
-        auth_header = request.META.get('HTTP_AUTHORIZATION')
-        
-        if auth_header and auth_header.startswith('Token '):
-            token_key = auth_header.split(' ')[1]
-            
-            # Valider le token et récupérer l'utilisateur
-            is_valid, user = AuthTokenService.validate_token(token_key)
-            
-            if is_valid and user:
-                # Ajouter l'utilisateur à la requête
-                request.user = user
-                request.user.is_authenticated = True
-            else:
-                request.user = AnonymousUser()
-        else:
-            request.user = AnonymousUser()
+        request.user = SimpleLazyObject(lambda: utilisateur(request))
+
+
+def utilisateur(request):
+    """Utilisateur du token de la requête, AnonymousUser sans token ou si le token est refusé"""
+    try:
+        identite = identifier(request)
+    except exceptions.AuthenticationFailed:
+        identite = None
+    return identite[0] if identite else AnonymousUser()
+
 
 class AnonymousUser:
     """Utilisateur anonyme pour les requêtes non authentifiées"""
@@ -12,7 +12,7 @@ class TimestampMixin:
         return super().save(*args, **kwargs)
 
 # User
-class User(me.Document, TimestampMixin):
+class User(TimestampMixin, me.Document):
     nom = me.StringField(required=True)
     prenom = me.StringField(required=True)
     email = me.StringField(required=True, unique=True)
@@ -56,7 +56,7 @@ class User(me.Document, TimestampMixin):
         return f"{self.prenom} {self.nom} ({self.email})"
 
 #Eleve
-class Eleve(me.Document, TimestampMixin):
+class Eleve(TimestampMixin, me.Document):
 	nom = me.StringField(required=True)
 	prenom = me.StringField(required=True)
 	matricule = me.StringField(required=True, unique=True)
@@ -74,7 +74,7 @@ class Subdivision(me.EmbeddedDocument):
 	profPrincipal = me.ReferenceField('User')
 
 #Classe
-class Classe(me.Document, TimestampMixin):
+class Classe(TimestampMixin, me.Document):
 	nom = me.StringField(required=True)
 	niveau = me.IntField(required=True)
 	typeClasse = me.StringField(choices=["primaire","secondaire"], required=True)
@@ -84,7 +84,7 @@ class Classe(me.Document, TimestampMixin):
 	updatedAt = me.DateTimeField()
 
 #Matiere
-class Matiere(me.Document, TimestampMixin):
+class Matiere(TimestampMixin, me.Document):
     nom = me.StringField(required=True)
     coefficient = me.IntField()
     professeur = me.ReferenceField('User')
@@ -93,7 +93,7 @@ class Matiere(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 #Devoir
-class Devoir(me.Document, TimestampMixin):
+class Devoir(TimestampMixin, me.Document):
     titre = me.StringField(required=True)
     description = me.StringField()
     dateLimite = me.DateTimeField()
@@ -105,8 +105,12 @@ class Devoir(me.Document, TimestampMixin):
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
 
+    meta = {'indexes': [
+        {'fields': ['$titre', '$description'], 'default_language': 'french', 'weights': {'titre': 3, 'description': 1}},
+    ]}
+
 #AnneeScolaire
-class AnneeScolaire(me.Document, TimestampMixin):
+class AnneeScolaire(TimestampMixin, me.Document):
     nom = me.StringField(required=True)
     dateDebut = me.DateTimeField()
     dateFin = me.DateTimeField()
@@ -115,7 +119,7 @@ class AnneeScolaire(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 #Trimestre
-class Trimestre(me.Document, TimestampMixin):
+class Trimestre(TimestampMixin, me.Document):
     nom = me.StringField(required=True)
     dateDebut = me.DateTimeField()
     dateFin = me.DateTimeField()
@@ -125,7 +129,7 @@ class Trimestre(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 #Periode
-class Periode(me.Document, TimestampMixin):
+class Periode(TimestampMixin, me.Document):
     nom = me.StringField(required=True)
     dateDebut = me.DateTimeField()
     dateFin = me.DateTimeField()
@@ -134,7 +138,7 @@ class Periode(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 #Interrogation
-class Interrogation(me.Document, TimestampMixin):
+class Interrogation(TimestampMixin, me.Document):
     eleve = me.ReferenceField('Eleve')
     matiere = me.ReferenceField('Matiere')
     periode = me.ReferenceField('Periode')
@@ -144,7 +148,7 @@ class Interrogation(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 #Examen
-class Examen(me.Document, TimestampMixin):
+class Examen(TimestampMixin, me.Document):
     eleve = me.ReferenceField('Eleve')
     matiere = me.ReferenceField('Matiere')
     trimestre = me.ReferenceField('Trimestre')
@@ -158,7 +162,7 @@ class DetailsNoteTrimestrielle(me.EmbeddedDocument):
     moyenneTravaux = me.FloatField()
     noteExamen = me.FloatField()
 
-class NoteTrimestrielle(me.Document, TimestampMixin):
+class NoteTrimestrielle(TimestampMixin, me.Document):
     eleve = me.ReferenceField('Eleve')
     matiere = me.ReferenceField('Matiere')
     trimestre = me.ReferenceField('Trimestre')
@@ -167,12 +171,14 @@ class NoteTrimestrielle(me.Document, TimestampMixin):
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
 
+    meta = {'indexes': [('eleve', 'matiere', 'trimestre')]}
+
 #NoteAnnuelle
 class DetailNoteAnnuelle(me.EmbeddedDocument):
     trimestre = me.ReferenceField('Trimestre')
     noteTrimestre = me.FloatField()
 
-class NoteAnnuelle(me.Document, TimestampMixin):
+class NoteAnnuelle(TimestampMixin, me.Document):
     eleve = me.ReferenceField('Eleve')
     matiere = me.ReferenceField('Matiere')
     anneeScolaire = me.ReferenceField('AnneeScolaire')
@@ -184,25 +190,165 @@ class NoteAnnuelle(me.Document, TimestampMixin):
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
 
+    meta = {'indexes': [('eleve', 'matiere', 'anneeScolaire')]}
+
+#Clés (eleve, matiere, trimestre) dont la note trimestrielle est à recalculer
+class NoteModifiee(me.Document):
+    eleve = me.ReferenceField('Eleve')
+    matiere = me.ReferenceField('Matiere')
+    trimestre = me.ReferenceField('Trimestre')
+    dateModification = me.DateTimeField()
+
+    meta = {'indexes': [('eleve', 'matiere', 'trimestre'), 'dateModification']}
+
+#StatistiquesClasse : moyennes, extrêmes, rangs et percentiles d'une classe pour un trimestre,
+#recalculés en même temps que les notes trimestrielles (subdivision vide = toute la classe)
+class StatistiquesMatiere(me.EmbeddedDocument):
+    matiere = me.ReferenceField('Matiere')
+    effectif = me.IntField()
+    moyenne = me.FloatField()
+    noteMin = me.FloatField()
+    noteMax = me.FloatField()
+
+class RangMatiere(me.EmbeddedDocument):
+    matiere = me.ReferenceField('Matiere')
+    note = me.FloatField()
+    rang = me.IntField()
+    percentile = me.FloatField()
+
+class ClassementEleve(me.EmbeddedDocument):
+    eleve = me.ReferenceField('Eleve')
+    moyenne = me.FloatField()
+    rang = me.IntField()
+    percentile = me.FloatField()
+    matieres = me.ListField(me.EmbeddedDocumentField('RangMatiere'))
+
+class StatistiquesClasse(me.Document):
+    classe = me.ReferenceField('Classe')
+    subdivision = me.StringField()
+    trimestre = me.ReferenceField('Trimestre')
+    effectif = me.IntField()
+    moyenne = me.FloatField()
+    noteMin = me.FloatField()
+    noteMax = me.FloatField()
+    matieres = me.ListField(me.EmbeddedDocumentField('StatistiquesMatiere'))
+    classement = me.ListField(me.EmbeddedDocumentField('ClassementEleve'))
+    dateCalcul = me.DateTimeField()
+
+    meta = {'indexes': [{'fields': ['classe', 'trimestre', 'subdivision'], 'unique': True}]}
+
+#Job : opération longue exécutée en arrière-plan, morceau par morceau (une classe par morceau)
+class ErreurJob(me.EmbeddedDocument):
+    morceau = me.StringField()
+    message = me.StringField()
+    date = me.DateTimeField()
+
+class Job(TimestampMixin, me.Document):
+    type = me.StringField(choices=["calcul_notes_trimestrielles","calcul_notes_annuelles","promotion_automatique"], required=True)
+    parametres = me.DictField()
+    statut = me.StringField(choices=["en_attente","en_cours","termine","echoue"], default="en_attente")
+    morceaux = me.ListField(me.StringField())
+    morceauxTermines = me.ListField(me.StringField())
+    progression = me.FloatField(default=0.0)
+    compteurs = me.DictField()
+    erreurs = me.ListField(me.EmbeddedDocumentField('ErreurJob'))
+    demandePar = me.ReferenceField('User')
+    dateDebut = me.DateTimeField()
+    dateFin = me.DateTimeField()
+    derniereActivite = me.DateTimeField()
+    createdAt = me.DateTimeField()
+    updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [('statut', 'derniereActivite')]}
+
 #Message
-class Message(me.Document, TimestampMixin):
+class Message(TimestampMixin, me.Document):
     sender = me.ReferenceField('User')
     receiver = me.ReferenceField('User')
     contenu = me.StringField()
     lu = me.BooleanField(default=False)
+    conversation = me.StringField()  # clé de la paire sender/receiver (voir Conversation)
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
 
+    meta = {'indexes': [
+        ('receiver', 'sender', 'lu'),
+        ('conversation', '-createdAt', '-_id'),
+        {'fields': ['$contenu'], 'default_language': 'french'},
+    ]}
+
+#Conversation : une par paire d'utilisateurs (clé : les deux ids triés), tenue à jour à chaque
+#message ; porte le dernier message et les non-lus de chaque participant pour la boîte de réception
+class Conversation(TimestampMixin, me.Document):
+    cle = me.StringField(required=True)
+    participants = me.ListField(me.ReferenceField('User'))
+    dernierMessage = me.ReferenceField('Message')
+    expediteur = me.ReferenceField('User')
+    apercu = me.StringField()
+    derniereActivite = me.DateTimeField()
+    nonLus = me.DictField()  # user_id -> messages non lus
+    createdAt = me.DateTimeField()
+    updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [{'fields': ['cle'], 'unique': True}, ('participants', '-derniereActivite', '-_id')]}
+
 #Notification
-class Notification(me.Document, TimestampMixin):
+class Notification(TimestampMixin, me.Document):
     destinataire = me.ReferenceField('User')
     type = me.StringField(choices=["message","devoir"])
     referenceId = me.ObjectIdField()
+    references = me.ListField(me.ObjectIdField())  # notification regroupée : tous les devoirs/messages
     lu = me.BooleanField(default=False)
     dateEnvoi = me.DateTimeField()
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
 
+    meta = {'indexes': [('destinataire', 'lu', 'type'), ('destinataire', 'updatedAt'), ('lu', 'dateEnvoi')]}
+
+#NotificationArchivee : notifications lues déplacées hors de la collection active par la commande
+#`archiver_notifications` ; supprimées par MongoDB (index TTL sur dateEnvoi) après la durée d'archivage
+class NotificationArchivee(me.Document):
+    destinataire = me.ReferenceField('User')
+    type = me.StringField(choices=["message","devoir"])
+    referenceId = me.ObjectIdField()
+    references = me.ListField(me.ObjectIdField())
+    lu = me.BooleanField(default=True)
+    dateEnvoi = me.DateTimeField()
+    dateArchivage = me.DateTimeField()
+    createdAt = me.DateTimeField()
+    updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [('destinataire', 'dateEnvoi')]}
+
+#CompteurNonLus : notifications (par type) et messages non lus d'un utilisateur, tenus à jour
+#par $inc à chaque création ou lecture ; initialisé à la première consultation
+class CompteurNonLus(me.Document):
+    utilisateur = me.ReferenceField('User', required=True)
+    notifications = me.DictField()
+    messages = me.IntField(default=0)
+    #initialise : False tant que le premier calcul n'est pas appliqué ; version : compare-and-set des (re)calculs
+    initialise = me.BooleanField(default=True)
+    version = me.IntField(default=0)
+    updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [{'fields': ['utilisateur'], 'unique': True}]}
+
+#NotificationEnAttente : file d'attente (outbox) des notifications à diffuser, écrite avec le
+#Devoir/Message et vidée en arrière-plan (livraison au moins une fois, avec nouvelles tentatives)
+class NotificationEnAttente(TimestampMixin, me.Document):
+    type = me.StringField(choices=["message","devoir"], required=True)
+    referenceId = me.ObjectIdField(required=True)
+    statut = me.StringField(choices=["en_attente","en_cours","envoyee","echouee"], default="en_attente")
+    tentatives = me.IntField(default=0)
+    prochainEssai = me.DateTimeField()
+    verrouJusqua = me.DateTimeField()
+    derniereErreur = me.StringField()
+    dateEnvoi = me.DateTimeField()
+    createdAt = me.DateTimeField()
+    updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [('statut', 'prochainEssai'), ('statut', 'verrouJusqua')]}
+
 #EmploiDuTemps
 class CoursEmploi(me.EmbeddedDocument):
     heureDebut = me.StringField()
@@ -215,7 +361,7 @@ class JourEmploi(me.EmbeddedDocument):
     nom = me.StringField(choices=["Lundi","Mardi","Mercredi","Jeudi","Vendredi","Samedi"])
     cours = me.ListField(me.EmbeddedDocumentField('CoursEmploi'))
 
-class EmploiDuTemps(me.Document, TimestampMixin):
+class EmploiDuTemps(TimestampMixin, me.Document):
     classe = me.ReferenceField('Classe')
     subdivision = me.StringField()
     anneeScolaire = me.ReferenceField('AnneeScolaire')
@@ -225,12 +371,18 @@ class EmploiDuTemps(me.Document, TimestampMixin):
     updatedAt = me.DateTimeField()
 
 # 16️⃣ Token d'authentification personnalisé
-class AuthToken(me.Document, TimestampMixin):
+#AuthToken : une session (un appareil) ; un utilisateur peut en avoir plusieurs, chacune supprimée
+#par MongoDB (index TTL) à son expiration
+class AuthToken(TimestampMixin, me.Document):
     key = me.StringField(required=True, unique=True, max_length=40)
     user = me.ReferenceField('User', required=True)
     created = me.DateTimeField()
+    expiresAt = me.DateTimeField()
+    appareil = me.StringField(max_length=200)
     createdAt = me.DateTimeField()
     updatedAt = me.DateTimeField()
+
+    meta = {'indexes': [('user', '-created'), {'fields': ['expiresAt'], 'expireAfterSeconds': 0}]}
     
     @staticmethod
     def generate_key():
@@ -246,4 +398,12 @@ class AuthToken(me.Document, TimestampMixin):
         super().save(*args, **kwargs)
     
     def __str__(self):
-        return f"Token for {self.user.email}"
\ No newline at end of file
+        return f"Token for {self.user.email}"
+
+#JetonRevoque : jetons d'accès signés révoqués avant leur expiration (déconnexion), supprimés par
+#MongoDB (index TTL) quand le jeton expire
+class JetonRevoque(me.Document):
+    jti = me.StringField(required=True)
+    expiresAt = me.DateTimeField(required=True)
+
+    meta = {'indexes': [{'fields': ['jti'], 'unique': True}, {'fields': ['expiresAt'], 'expireAfterSeconds': 0}]}
\ No newline at end of file
@@ -0,0 +1,224 @@
+"""
+Calcul des notes et évaluation des promotions réparties par classe sur plusieurs processus
+
+Chaque processus du pool (contexte "spawn") initialise Django, donc sa propre connexion
+mongoengine : aucune connexion n'est partagée entre processus. Les processus ne font que
+lire et calculer ; les résultats sont fusionnés puis écrits en lots par le processus parent.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from django.conf import settings
+
+from .models import Eleve, NoteAnnuelle
+from .services import (
+    NoteBulkWriter, NoteService, PromotionService, SimulationPromotionService, StatistiquesService
+)
+
+TAILLE_LOT = 1000
+
+_pool = None
+_taille_pool = 0
+_verrou = threading.Lock()
+
+
+def _initialiser_worker():
+    """Initialisation de chaque processus : configuration Django et connexion MongoDB"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gestion_scolaire.settings')
+    import django
+    django.setup()
+
+
+def parallelisme(processus: int = None) -> int:
+    """Nombre de processus : paramètre explicite, sinon CALCUL_PARALLELISME, sinon le nombre de cœurs"""
+    return max(1, processus or getattr(settings, 'CALCUL_PARALLELISME', None) or os.cpu_count() or 1)
+
+
+def morceaux_classes(classe_id: str = None, subdivision: str = None,
+                     par_subdivision: bool = False) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Découpe les élèves en morceaux (classe, subdivision) ; subdivision vaut None sauf si par_subdivision"""
+    filtre = {}
+    if classe_id:
+        filtre['classe'] = ObjectId(classe_id)
+    if subdivision:
+        filtre['subdivision'] = subdivision
+
+    if not par_subdivision:
+        return [
+            (str(classe) if classe else None, subdivision)
+            for classe in Eleve._get_collection().distinct('classe', filtre)
+        ]
+
+    subdivisions = {}
+    for groupe in Eleve._get_collection().aggregate([
+        {'$match': filtre},
+        {'$group': {'_id': {'classe': '$classe', 'subdivision': '$subdivision'}}},
+    ]):
+        classe = groupe['_id'].get('classe')
+        subdivisions.setdefault(str(classe) if classe else None, set()).add(groupe['_id'].get('subdivision'))
+
+    # Des élèves sans subdivision ne peuvent pas être isolés : leur classe reste un seul morceau
+    return [
+        (classe, sub)
+        for classe, noms in subdivisions.items()
+        for sub in (sorted(noms) if all(noms) else [None])
+    ]
+
+
+def soumettre(fonction: Callable, arguments: List[Tuple], nb_processus: int) -> List[Future]:
+    """
+    Soumet les morceaux au pool de processus partagé par le processus courant : créé au premier
+    calcul (le démarrage de Django dans chaque worker n'est payé qu'une fois), agrandi si un calcul
+    demande plus de processus, recréé si un worker a été tué
+    """
+    global _pool, _taille_pool
+    with _verrou:
+        for _ in range(2):
+            if _pool is None or _taille_pool < nb_processus:
+                if _pool is not None:
+                    # Les morceaux déjà soumis à l'ancien pool se terminent normalement
+                    _pool.shutdown(wait=False)
+                _pool = ProcessPoolExecutor(
+                    max_workers=nb_processus,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_initialiser_worker,
+                )
+                _taille_pool = nb_processus
+            try:
+                return [_pool.submit(fonction, *args) for args in arguments]
+            except BrokenProcessPool:
+                _pool.shutdown(wait=False)
+                _pool = None
+        raise BrokenProcessPool("Pool de processus inutilisable")
+
+
+def executer_morceaux(fonction: Callable, arguments: List[Tuple], processus: int = None) -> List[Any]:
+    """Exécute fonction(*args) pour chaque morceau, sur le pool de processus si plus d'un cœur est demandé"""
+    nb_processus = min(parallelisme(processus), len(arguments))
+    if nb_processus <= 1:
+        return [fonction(*args) for args in arguments]
+
+    return [future.result() for future in soumettre(fonction, arguments, nb_processus)]
+
+
+# Fonctions exécutées dans les processus : définies au niveau du module pour être sérialisables
+
+def _notes_trimestrielles_morceau(trimestre_id: str, classe_id: str, subdivision: str, mode: str):
+    return NoteService.resultats_trimestre(trimestre_id, classe_id, subdivision, mode)
+
+
+def _notes_annuelles_morceau(annee_scolaire_id: str, classe_id: str, subdivision: str):
+    return NoteService.resultats_annee(annee_scolaire_id, classe_id, subdivision)[1]
+
+
+def _promotion_morceau(annee_scolaire_id: str, classe_id: str, subdivision: str, methode_subdivision: str):
+    filtre = {'classe': ObjectId(classe_id) if classe_id else None}
+    if subdivision:
+        filtre['subdivision'] = subdivision
+
+    rapport = {'promotions_reussies': 0, 'promotions_echouees': 0}
+    operations = []
+    for eleve in Eleve._get_collection().find(filtre, {'_id': 1}):
+        resultat, mises_a_jour = PromotionService.preparer_promotion(
+            str(eleve['_id']), annee_scolaire_id, methode_subdivision
+        )
+        rapport['promotions_reussies' if resultat['promotion_effectuee'] else 'promotions_echouees'] += 1
+        operations.extend(mises_a_jour)
+    return rapport, operations
+
+
+class CalculParalleleService:
+    """Service pour les calculs de toute l'école répartis par classe sur un pool de processus"""
+
+    @staticmethod
+    def calculer_trimestre(trimestre_id: str, classe_id: str = None, subdivision: str = None,
+                           mode: str = 'agregation', processus: int = None,
+                           par_subdivision: bool = False) -> Dict[str, Any]:
+        """Équivalent de NoteService.calculer_trimestre, une classe (ou subdivision) par tâche"""
+        morceaux = [
+            morceau for morceau in morceaux_classes(classe_id, subdivision, par_subdivision) if morceau[0]
+        ]
+        resultats = executer_morceaux(
+            _notes_trimestrielles_morceau,
+            [(trimestre_id, classe, sub, mode) for classe, sub in morceaux],
+            processus,
+        )
+
+        writer = NoteBulkWriter()
+        plan, tous_resultats = {}, {}
+        for plan_morceau, resultats_morceau in resultats:
+            # Un morceau par subdivision : la classe est reconstituée pour ses statistiques
+            for classe, inscriptions in plan_morceau.items():
+                plan.setdefault(classe, {'eleve_ids': [], 'matiere_ids': inscriptions['matiere_ids']})
+                plan[classe]['eleve_ids'].extend(inscriptions['eleve_ids'])
+            tous_resultats.update(resultats_morceau)
+            for (eleve_id, matiere_id), resultat in resultats_morceau.items():
+                writer.ajouter_note_trimestrielle(eleve_id, matiere_id, trimestre_id, resultat)
+
+        return {
+            'notes_calculees': len(tous_resultats),
+            'classes': len(plan),
+            'morceaux': len(morceaux),
+            'processus': min(parallelisme(processus), len(morceaux)),
+            'ecriture': writer.flush(),
+            'statistiques': StatistiquesService.enregistrer(trimestre_id, plan, tous_resultats, subdivision),
+        }
+
+    @staticmethod
+    def calculer_annee(annee_scolaire_id: str, classe_id: str = None, subdivision: str = None,
+                       processus: int = None, par_subdivision: bool = False) -> Dict[str, Any]:
+        """Équivalent de NoteService.calculer_annee, une classe (ou subdivision) par tâche"""
+        morceaux = [
+            morceau for morceau in morceaux_classes(classe_id, subdivision, par_subdivision) if morceau[0]
+        ]
+        resultats = executer_morceaux(
+            _notes_annuelles_morceau,
+            [(annee_scolaire_id, classe, sub) for classe, sub in morceaux],
+            processus,
+        )
+
+        writer = NoteBulkWriter()
+        notes_calculees = 0
+        for resultats_morceau in resultats:
+            notes_calculees += len(resultats_morceau)
+            for (eleve_id, matiere_id), resultat in resultats_morceau.items():
+                writer.ajouter_note_annuelle(eleve_id, matiere_id, annee_scolaire_id, resultat)
+
+        rapport = {
+            'notes_calculees': notes_calculees,
+            'classes': len({classe for classe, _ in morceaux}),
+            'morceaux': len(morceaux),
+            'processus': min(parallelisme(processus), len(morceaux)),
+            'ecriture': writer.flush(),
+        }
+        SimulationPromotionService.invalider(annee_scolaire_id)
+        return rapport
+
+    @staticmethod
+    def promouvoir(annee_scolaire_id: str, methode_subdivision: str = 'auto', processus: int = None,
+                   par_subdivision: bool = False) -> Dict[str, int]:
+        """Équivalent de la promotion automatique élève par élève : évaluation en parallèle, écriture groupée"""
+        morceaux = morceaux_classes(par_subdivision=par_subdivision)
+        resultats = executer_morceaux(
+            _promotion_morceau,
+            [(annee_scolaire_id, classe, sub, methode_subdivision) for classe, sub in morceaux],
+            processus,
+        )
+
+        rapport = {'promotions_reussies': 0, 'promotions_echouees': 0}
+        operations = []
+        for rapport_morceau, operations_morceau in resultats:
+            rapport['promotions_reussies'] += rapport_morceau['promotions_reussies']
+            rapport['promotions_echouees'] += rapport_morceau['promotions_echouees']
+            operations.extend(operations_morceau)
+
+        collection = NoteAnnuelle._get_collection()
+        for debut in range(0, len(operations), TAILLE_LOT):
+            collection.bulk_write(operations[debut:debut + TAILLE_LOT], ordered=False)
+
+        return rapport
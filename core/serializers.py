@@ -98,10 +98,12 @@ class AuthTokenSerializer(BaseMongoSerializer):
     key = serializers.CharField(read_only=True)
     user = serializers.CharField(read_only=True)
     created = serializers.DateTimeField(read_only=True)
+    expiresAt = serializers.DateTimeField(read_only=True)
+    appareil = serializers.CharField(read_only=True, allow_null=True)
     
     class Meta:
         model = AuthToken
-        fields = ['id', 'key', 'user', 'created']
+        fields = ['id', 'key', 'user', 'created', 'expiresAt', 'appareil']
 class BaseMongoSerializer(serializers.Serializer):
     """Base serializer pour mongoengine documents"""
     def create(self, validated_data):
@@ -329,6 +331,7 @@ class NotificationSerializer(BaseMongoSerializer):
     destinataire = serializers.CharField(required=False)
     type = serializers.ChoiceField(choices=["message","devoir"])
     referenceId = serializers.CharField(required=False)
+    references = serializers.ListField(child=serializers.CharField(), read_only=True)
     lu = serializers.BooleanField(default=False)
     dateEnvoi = serializers.DateTimeField(required=False)
     createdAt = serializers.DateTimeField(read_only=True)
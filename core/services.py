@@ -1,15 +1,35 @@
 """
 Services pour la logique métier complexe du système de gestion scolaire
 """
-from datetime import datetime
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import heapq
 import random
-from typing import List, Dict, Any
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
 
+from bson import ObjectId
+from django.conf import settings
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import OperationFailure
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .authentication import cache_tokens, revocations, signer_jeton
+from .events import EPOQUE, abonnements
 from .models import (
     User, Eleve, Classe, Matiere, Devoir, AnneeScolaire, 
     Trimestre, Periode, Interrogation, Examen, NoteTrimestrielle, 
     NoteAnnuelle, Message, Notification, EmploiDuTemps,
-    DetailsNoteTrimestrielle, DetailNoteAnnuelle
+    DetailsNoteTrimestrielle, DetailNoteAnnuelle, NoteModifiee, StatistiquesClasse, CompteurNonLus,
+    NotificationArchivee, Conversation
 )
 
 class NoteService:
@@ -70,6 +90,176 @@ class NoteService:
             'note_examen': note_examen
         }
 
+    @staticmethod
+    def combiner_note_trimestrielle(notes_par_periode: Dict[str, List[float]], periode_ids: List[str],
+                                    note_examen: Optional[float]) -> Dict[str, float]:
+        """Applique la règle 50% travaux + 50% examen à des notes déjà chargées (même arithmétique que calculer_note_trimestrielle)"""
+        moyennes_periodes = []
+        for periode_id in periode_ids:
+            notes = notes_par_periode.get(periode_id, [])
+            moyenne_periode = sum(notes) / len(notes) if notes else 0.0
+            if moyenne_periode > 0:
+                moyennes_periodes.append(moyenne_periode)
+
+        moyenne_travaux = sum(moyennes_periodes) / len(moyennes_periodes) if moyennes_periodes else 0.0
+        note_examen = note_examen if note_examen is not None else 0.0
+        note_finale = (moyenne_travaux * 0.5) + (note_examen * 0.5)
+
+        return {
+            'note_finale': note_finale,
+            'moyenne_travaux': moyenne_travaux,
+            'note_examen': note_examen
+        }
+
+    @staticmethod
+    def agreger_notes_trimestre(trimestre_id: str, eleve_ids: List[str] = None,
+                                matiere_ids: List[str] = None) -> Dict[str, Any]:
+        """
+        Charge en deux pipelines $group toutes les notes d'un trimestre :
+        les notes d'interrogation par (eleve, matiere, periode) et la note d'examen par (eleve, matiere)
+        """
+        trimestre = Trimestre.objects.get(id=trimestre_id)
+        periode_ids = [periode.id for periode in trimestre.periodes]
+
+        filtre = {}
+        if eleve_ids is not None:
+            filtre['eleve'] = {'$in': [ObjectId(eleve_id) for eleve_id in eleve_ids]}
+        if matiere_ids is not None:
+            filtre['matiere'] = {'$in': [ObjectId(matiere_id) for matiere_id in matiere_ids]}
+
+        # Les notes sont poussées dans l'ordre naturel puis sommées côté Python,
+        # pour retrouver exactement l'arithmétique du calcul élève par élève
+        interrogations = Interrogation.objects.aggregate([
+            {'$match': dict(filtre, periode={'$in': periode_ids}, note={'$ne': None})},
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {'eleve': '$eleve', 'matiere': '$matiere', 'periode': '$periode'},
+                'notes': {'$push': '$note'},
+            }},
+        ], allowDiskUse=True)
+
+        notes_periodes = {}
+        for groupe in interrogations:
+            cle = (str(groupe['_id']['eleve']), str(groupe['_id']['matiere']))
+            notes_periodes.setdefault(cle, {})[str(groupe['_id']['periode'])] = groupe['notes']
+
+        # Équivalent de Examen.objects.filter(...).first() pour chaque couple
+        examens = Examen.objects.aggregate([
+            {'$match': dict(filtre, trimestre=trimestre.id)},
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {'eleve': '$eleve', 'matiere': '$matiere'},
+                'note': {'$first': '$note'},
+            }},
+        ], allowDiskUse=True)
+
+        notes_examens = {
+            (str(groupe['_id']['eleve']), str(groupe['_id']['matiere'])): groupe.get('note')
+            for groupe in examens
+        }
+
+        return {
+            'periode_ids': [str(periode_id) for periode_id in periode_ids],
+            'notes_periodes': notes_periodes,
+            'notes_examens': notes_examens,
+        }
+
+    @staticmethod
+    def calculer_notes_trimestrielles_lot(trimestre_id: str, paires: List[Tuple[str, str]],
+                                          eleve_ids: List[str] = None,
+                                          matiere_ids: List[str] = None) -> Dict[Tuple[str, str], Dict[str, float]]:
+        """Calcule les notes trimestrielles de tous les couples (eleve, matiere) demandés à partir des agrégats du trimestre"""
+        agregats = NoteService.agreger_notes_trimestre(trimestre_id, eleve_ids, matiere_ids)
+
+        resultats = {}
+        for eleve_id, matiere_id in paires:
+            cle = (str(eleve_id), str(matiere_id))
+            resultats[cle] = NoteService.combiner_note_trimestrielle(
+                agregats['notes_periodes'].get(cle, {}),
+                agregats['periode_ids'],
+                agregats['notes_examens'].get(cle),
+            )
+
+        return resultats
+
+    @staticmethod
+    def planifier_inscriptions(classe_id: str = None, subdivision: str = None) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Regroupe par classe les élèves et les matières de cette classe :
+        seuls les couples (eleve, matiere) d'une même classe sont à calculer
+        """
+        filtre_eleves = {'classe': {'$ne': None}}
+        if classe_id:
+            filtre_eleves['classe'] = ObjectId(classe_id)
+        if subdivision:
+            filtre_eleves['subdivision'] = subdivision
+
+        plan = {}
+        for eleve in Eleve._get_collection().find(filtre_eleves, {'classe': 1}):
+            plan.setdefault(str(eleve['classe']), {'eleve_ids': [], 'matiere_ids': []})['eleve_ids'].append(str(eleve['_id']))
+
+        matieres = Matiere._get_collection().find(
+            {'classe': {'$in': [ObjectId(id_classe) for id_classe in plan]}}, {'classe': 1}
+        )
+        for matiere in matieres:
+            plan[str(matiere['classe'])]['matiere_ids'].append(str(matiere['_id']))
+
+        return plan
+
+    @staticmethod
+    def paires_inscriptions(plan: Dict[str, Dict[str, List[str]]]) -> List[Tuple[str, str]]:
+        """Liste des couples (eleve, matiere) d'un plan d'inscriptions"""
+        return [
+            (eleve_id, matiere_id)
+            for classe in plan.values()
+            for eleve_id in classe['eleve_ids']
+            for matiere_id in classe['matiere_ids']
+        ]
+
+    @staticmethod
+    def resultats_trimestre(trimestre_id: str, classe_id: str = None, subdivision: str = None,
+                            mode: str = 'agregation') -> Tuple[Dict[str, Dict[str, List[str]]], Dict[Tuple[str, str], Dict[str, float]]]:
+        """Calcule sans les enregistrer les notes trimestrielles des couples (eleve, matiere) réellement inscrits"""
+        plan = NoteService.planifier_inscriptions(classe_id, subdivision)
+        paires = NoteService.paires_inscriptions(plan)
+
+        if mode == 'agregation':
+            # Sans filtre, le $match sur toute l'école évite un $in de plusieurs milliers d'élèves
+            eleve_ids = None
+            if classe_id or subdivision:
+                eleve_ids = [eleve_id for classe in plan.values() for eleve_id in classe['eleve_ids']]
+            resultats = NoteService.calculer_notes_trimestrielles_lot(trimestre_id, paires, eleve_ids=eleve_ids)
+        elif mode == 'vectorise':
+            eleve_ids = None
+            if classe_id or subdivision:
+                eleve_ids = [eleve_id for classe in plan.values() for eleve_id in classe['eleve_ids']]
+            notes = NoteVectoriseeService.charger_notes(trimestre_id, eleve_ids=eleve_ids)
+            resultats = NoteVectoriseeService.calculer(notes, paires)
+        else:
+            resultats = {
+                (eleve_id, matiere_id): NoteService.calculer_note_trimestrielle(eleve_id, matiere_id, trimestre_id)
+                for eleve_id, matiere_id in paires
+            }
+
+        return plan, resultats
+
+    @staticmethod
+    def calculer_trimestre(trimestre_id: str, classe_id: str = None, subdivision: str = None,
+                           mode: str = 'agregation') -> Dict[str, Any]:
+        """Calcule et enregistre les notes trimestrielles des couples (eleve, matiere) réellement inscrits"""
+        plan, resultats = NoteService.resultats_trimestre(trimestre_id, classe_id, subdivision, mode)
+
+        writer = NoteBulkWriter()
+        for (eleve_id, matiere_id), resultat in resultats.items():
+            writer.ajouter_note_trimestrielle(eleve_id, matiere_id, trimestre_id, resultat)
+
+        return {
+            'notes_calculees': len(resultats),
+            'classes': len(plan),
+            'ecriture': writer.flush(),
+            'statistiques': StatistiquesService.enregistrer(trimestre_id, plan, resultats, subdivision),
+        }
+
     @staticmethod
     def calculer_note_annuelle(eleve_id: str, matiere_id: str, annee_scolaire_id: str) -> Dict[str, Any]:
         """Calcule la note annuelle : moyenne des 3 trimestres"""
@@ -101,6 +291,579 @@ class NoteService:
             'nb_trimestres': len(notes_trimestres)
         }
 
+    @staticmethod
+    def combiner_note_annuelle(notes_par_trimestre: Dict[str, Optional[float]], trimestre_ids: List[str]) -> Dict[str, Any]:
+        """Moyenne des notes trimestrielles déjà chargées (même règle que calculer_note_annuelle)"""
+        notes_trimestres = []
+        details_trimestres = []
+
+        for trimestre_id in trimestre_ids:
+            note = notes_par_trimestre.get(trimestre_id)
+            if note is not None:
+                notes_trimestres.append(note)
+                details_trimestres.append({
+                    'trimestre': trimestre_id,
+                    'note_trimestre': note
+                })
+
+        note_annuelle = sum(notes_trimestres) / len(notes_trimestres) if notes_trimestres else 0.0
+
+        return {
+            'note_finale': note_annuelle,
+            'details': details_trimestres,
+            'nb_trimestres': len(notes_trimestres)
+        }
+
+    @staticmethod
+    def calculer_notes_annuelles_lot(annee_scolaire_id: str, paires: List[Tuple[str, str]],
+                                     eleve_ids: List[str] = None,
+                                     matiere_ids: List[str] = None) -> Dict[Tuple[str, str], Dict[str, Any]]:
+        """Calcule les notes annuelles des couples (eleve, matiere) en lisant toutes les notes trimestrielles de l'année en une requête"""
+        annee = AnneeScolaire.objects.get(id=annee_scolaire_id)
+        trimestre_ids = [trimestre.id for trimestre in annee.trimestres]
+
+        filtre = {'trimestre': {'$in': trimestre_ids}}
+        if eleve_ids is not None:
+            filtre['eleve'] = {'$in': [ObjectId(eleve_id) for eleve_id in eleve_ids]}
+        if matiere_ids is not None:
+            filtre['matiere'] = {'$in': [ObjectId(matiere_id) for matiere_id in matiere_ids]}
+
+        # Seule la première note trouvée par trimestre compte, comme le .first() du calcul unitaire
+        notes = {}
+        curseur = NoteTrimestrielle._get_collection().find(
+            filtre, {'eleve': 1, 'matiere': 1, 'trimestre': 1, 'noteFinale': 1}
+        ).sort('_id', 1)
+        for doc in curseur:
+            cle = (str(doc.get('eleve')), str(doc.get('matiere')))
+            notes.setdefault(cle, {}).setdefault(str(doc.get('trimestre')), doc.get('noteFinale'))
+
+        trimestre_ids = [str(trimestre_id) for trimestre_id in trimestre_ids]
+        return {
+            (str(eleve_id), str(matiere_id)): NoteService.combiner_note_annuelle(
+                notes.get((str(eleve_id), str(matiere_id)), {}), trimestre_ids
+            )
+            for eleve_id, matiere_id in paires
+        }
+
+    @staticmethod
+    def resultats_annee(annee_scolaire_id: str, classe_id: str = None,
+                        subdivision: str = None) -> Tuple[Dict[str, Dict[str, List[str]]], Dict[Tuple[str, str], Dict[str, Any]]]:
+        """Calcule sans les enregistrer les notes annuelles des couples (eleve, matiere) réellement inscrits"""
+        plan = NoteService.planifier_inscriptions(classe_id, subdivision)
+        paires = NoteService.paires_inscriptions(plan)
+
+        eleve_ids = None
+        if classe_id or subdivision:
+            eleve_ids = [eleve_id for classe in plan.values() for eleve_id in classe['eleve_ids']]
+        return plan, NoteService.calculer_notes_annuelles_lot(annee_scolaire_id, paires, eleve_ids=eleve_ids)
+
+    @staticmethod
+    def calculer_annee(annee_scolaire_id: str, classe_id: str = None, subdivision: str = None) -> Dict[str, Any]:
+        """Calcule et enregistre les notes annuelles des couples (eleve, matiere) réellement inscrits"""
+        plan, resultats = NoteService.resultats_annee(annee_scolaire_id, classe_id, subdivision)
+
+        writer = NoteBulkWriter()
+        for (eleve_id, matiere_id), resultat in resultats.items():
+            writer.ajouter_note_annuelle(eleve_id, matiere_id, annee_scolaire_id, resultat)
+
+        rapport = {
+            'notes_calculees': len(resultats),
+            'classes': len(plan),
+            'ecriture': writer.flush(),
+        }
+        SimulationPromotionService.invalider(annee_scolaire_id)
+        return rapport
+
+class NoteVectoriseeService:
+    """
+    Noyau NumPy du calcul trimestriel : les notes sont chargées une fois en colonnes, codées en
+    indices entiers (paire eleve/matiere, periode) par np.unique et réduites avec np.bincount
+    """
+
+    @staticmethod
+    def charger_notes(trimestre_id: str, eleve_ids: List[str] = None) -> Dict[str, Any]:
+        """Charge les notes brutes d'interrogation et d'examen d'un trimestre (projection minimale)"""
+        if np is None:
+            raise ValueError("Le mode vectorisé nécessite NumPy (pip install numpy)")
+
+        trimestre = Trimestre.objects.get(id=trimestre_id)
+        periode_ids = [periode.id for periode in trimestre.periodes]
+
+        filtre = {}
+        if eleve_ids is not None:
+            filtre['eleve'] = {'$in': [ObjectId(eleve_id) for eleve_id in eleve_ids]}
+
+        interrogations = Interrogation._get_collection().find(
+            dict(filtre, periode={'$in': periode_ids}, note={'$ne': None}),
+            {'eleve': 1, 'matiere': 1, 'periode': 1, 'note': 1}
+        ).sort('_id', 1)
+        examens = Examen._get_collection().find(
+            dict(filtre, trimestre=trimestre.id),
+            {'eleve': 1, 'matiere': 1, 'note': 1}
+        ).sort('_id', 1)
+
+        return {
+            'periode_ids': [str(periode_id) for periode_id in periode_ids],
+            'interrogations': NoteVectoriseeService.colonnes(list(interrogations), ['eleve', 'matiere', 'periode']),
+            'examens': NoteVectoriseeService.colonnes(list(examens), ['eleve', 'matiere']),
+        }
+
+    @staticmethod
+    def colonnes(documents: List[Dict[str, Any]], champs: List[str]) -> Dict[str, Any]:
+        """Tableaux par colonne : identifiants en chaînes, notes en float (None devient nan)"""
+        tableaux = {champ: np.array([str(doc.get(champ)) for doc in documents], dtype=str) for champ in champs}
+        tableaux['note'] = np.array([doc.get('note') for doc in documents], dtype=np.float64)
+        return tableaux
+
+    @staticmethod
+    def positions(references, valeurs):
+        """Indice de chaque valeur dans references (-1 si absente), par np.unique(return_inverse=True)"""
+        univers, inverse = np.unique(np.concatenate([references, valeurs]), return_inverse=True)
+        inverse = inverse.reshape(-1)
+        index = np.full(len(univers), -1, dtype=np.int64)
+        index[inverse[:len(references)]] = np.arange(len(references))
+        return index[inverse[len(references):]]
+
+    @staticmethod
+    def cles(eleves, matieres):
+        """Clé texte d'une paire eleve/matiere, calculée sur des colonnes entières"""
+        return np.char.add(np.char.add(eleves, '|'), matieres)
+
+    @staticmethod
+    def calculer(notes: Dict[str, Any], paires: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Dict[str, float]]:
+        """Moyennes par période, moyenne des travaux (périodes vides ignorées) et note finale 50/50"""
+        if np is None:
+            raise ValueError("Le mode vectorisé nécessite NumPy (pip install numpy)")
+
+        paires = [(str(eleve_id), str(matiere_id)) for eleve_id, matiere_id in paires]
+        tableau_paires = np.array(paires, dtype=str).reshape(-1, 2)
+        cles_paires = NoteVectoriseeService.cles(tableau_paires[:, 0], tableau_paires[:, 1])
+
+        # Une période listée deux fois dans le trimestre compte deux fois, comme dans le calcul unitaire
+        periodes, multiplicite = np.unique(np.array(notes['periode_ids'], dtype=str), return_counts=True)
+
+        nb_paires, nb_periodes = len(paires), len(periodes)
+        taille = nb_paires * nb_periodes
+
+        interrogations = notes['interrogations']
+        i = NoteVectoriseeService.positions(
+            cles_paires, NoteVectoriseeService.cles(interrogations['eleve'], interrogations['matiere'])
+        )
+        j = NoteVectoriseeService.positions(periodes, interrogations['periode'])
+        gardees = (i >= 0) & (j >= 0)
+        codes = i[gardees] * nb_periodes + j[gardees]
+        valeurs = interrogations['note'][gardees]
+
+        sommes = np.bincount(codes, weights=valeurs, minlength=taille)
+        nombres = np.bincount(codes, minlength=taille)
+        moyennes = np.divide(sommes, nombres, out=np.zeros(taille), where=nombres > 0).reshape(nb_paires, nb_periodes)
+
+        valides = (moyennes > 0) * multiplicite
+        nb_valides = valides.sum(axis=1)
+        moyenne_travaux = np.divide(
+            (moyennes * valides).sum(axis=1), nb_valides,
+            out=np.zeros(nb_paires), where=nb_valides > 0
+        )
+
+        # Première note d'examen de chaque paire (ordre des _id), None comptant pour 0
+        examens = notes['examens']
+        i = NoteVectoriseeService.positions(
+            cles_paires, NoteVectoriseeService.cles(examens['eleve'], examens['matiere'])
+        )
+        gardes = i >= 0
+        note_examen = np.zeros(nb_paires)
+        if gardes.any():
+            premiers, rangs = np.unique(i[gardes], return_index=True)
+            note_examen[premiers] = np.nan_to_num(examens['note'][gardes][rangs], nan=0.0)
+
+        note_finale = (moyenne_travaux * 0.5) + (note_examen * 0.5)
+
+        return {
+            paire: {
+                'note_finale': finale,
+                'moyenne_travaux': travaux,
+                'note_examen': examen
+            }
+            for paire, finale, travaux, examen in zip(
+                paires, note_finale.tolist(), moyenne_travaux.tolist(), note_examen.tolist()
+            )
+        }
+
+class NoteBulkWriter:
+    """
+    Accumule les notes calculées et les enregistre par lots bulk_write non ordonnés
+    (UpdateOne upsert sur la clé eleve/matiere/trimestre ou eleve/matiere/anneeScolaire)
+    """
+
+    def __init__(self, taille_lot: int = 1000):
+        self.taille_lot = taille_lot
+        self._operations = {NoteTrimestrielle: [], NoteAnnuelle: []}
+        self.rapport = {'inseres': 0, 'modifies': 0, 'inchanges': 0}
+
+    @staticmethod
+    def _mise_a_jour(champs: Dict[str, Any], defauts: Dict[str, Any], maintenant: datetime) -> List[Dict[str, Any]]:
+        """
+        Pipeline de mise à jour : updatedAt n'est modifié que si une valeur change,
+        ce qui permet à MongoDB de compter les documents inchangés
+        """
+        identiques = {'$and': [
+            {'$eq': [f'${champ}', {'$literal': valeur}]} for champ, valeur in champs.items()
+        ]}
+        nouveaux_champs = {champ: {'$literal': valeur} for champ, valeur in champs.items()}
+        for champ, valeur in dict(defauts, createdAt=maintenant).items():
+            nouveaux_champs[champ] = {'$ifNull': [f'${champ}', {'$literal': valeur}]}
+        nouveaux_champs['updatedAt'] = {'$cond': [identiques, '$updatedAt', maintenant]}
+        return [{'$set': nouveaux_champs}]
+
+    def _ajouter(self, modele, filtre: Dict[str, Any], champs: Dict[str, Any], defauts: Dict[str, Any] = None):
+        self._operations[modele].append(
+            UpdateOne(filtre, self._mise_a_jour(champs, defauts or {}, datetime.utcnow()), upsert=True)
+        )
+        if len(self._operations[modele]) >= self.taille_lot:
+            self._ecrire(modele)
+
+    def ajouter_note_trimestrielle(self, eleve_id: str, matiere_id: str, trimestre_id: str, resultat: Dict[str, float]):
+        """Ajoute le résultat de calculer_note_trimestrielle au lot"""
+        self._ajouter(
+            NoteTrimestrielle,
+            {'eleve': ObjectId(eleve_id), 'matiere': ObjectId(matiere_id), 'trimestre': ObjectId(trimestre_id)},
+            {
+                'noteFinale': resultat['note_finale'],
+                'details': {
+                    'moyenneTravaux': resultat['moyenne_travaux'],
+                    'noteExamen': resultat['note_examen'],
+                },
+            },
+        )
+
+    def ajouter_note_annuelle(self, eleve_id: str, matiere_id: str, annee_scolaire_id: str, resultat: Dict[str, Any]):
+        """Ajoute le résultat de calculer_note_annuelle au lot"""
+        self._ajouter(
+            NoteAnnuelle,
+            {'eleve': ObjectId(eleve_id), 'matiere': ObjectId(matiere_id), 'anneeScolaire': ObjectId(annee_scolaire_id)},
+            {
+                'noteFinale': resultat['note_finale'],
+                'details': [
+                    {'trimestre': ObjectId(detail['trimestre']), 'noteTrimestre': detail['note_trimestre']}
+                    for detail in resultat['details']
+                ],
+            },
+            defauts={'promotionAutomatique': False},
+        )
+
+    def _ecrire(self, modele):
+        operations = self._operations[modele]
+        if not operations:
+            return
+        self._operations[modele] = []
+
+        resultat = modele._get_collection().bulk_write(operations, ordered=False)
+        self.rapport['inseres'] += resultat.upserted_count
+        self.rapport['modifies'] += resultat.modified_count
+        self.rapport['inchanges'] += resultat.matched_count - resultat.modified_count
+
+    def flush(self) -> Dict[str, int]:
+        """Écrit les opérations en attente et retourne le rapport cumulé"""
+        for modele in self._operations:
+            self._ecrire(modele)
+        return dict(self.rapport)
+
+def id_reference(document, champ: str) -> Optional[str]:
+    """Identifiant d'un champ référence sans déréférencer le document lié"""
+    valeur = document._data.get(champ)
+    if valeur is None:
+        return None
+    return str(getattr(valeur, 'id', valeur))
+
+class StatistiquesService:
+    """Statistiques de classe par trimestre (moyennes, extrêmes, rangs, percentiles) matérialisées dans StatistiquesClasse"""
+
+    @staticmethod
+    def classer(notes: Dict[str, float]) -> Dict[str, Tuple[int, float]]:
+        """Rang (les ex aequo partagent le même rang) et percentile de chaque clé, meilleure note en tête"""
+        effectif = len(notes)
+        premiers_rangs = {}
+        for position, note in enumerate(sorted(notes.values(), reverse=True), start=1):
+            premiers_rangs.setdefault(note, position)
+
+        return {
+            cle: (
+                premiers_rangs[note],
+                round(100.0 * (effectif - premiers_rangs[note]) / (effectif - 1), 1) if effectif > 1 else 100.0,
+            )
+            for cle, note in notes.items()
+        }
+
+    @staticmethod
+    def construire(trimestre_id: str, classe_id: str, eleve_ids: List[str], matiere_ids: List[str],
+                   notes: Dict[Tuple[str, str], float], coefficients: Dict[str, int],
+                   subdivision: str = None) -> Dict[str, Any]:
+        """Document StatistiquesClasse d'une classe ; la moyenne générale est pondérée par les coefficients"""
+        notes_matieres = {matiere_id: {} for matiere_id in matiere_ids}
+        for eleve_id in eleve_ids:
+            for matiere_id in matiere_ids:
+                if (eleve_id, matiere_id) in notes:
+                    notes_matieres[matiere_id][eleve_id] = notes[(eleve_id, matiere_id)]
+
+        moyennes = {}
+        for eleve_id in eleve_ids:
+            total, poids = 0.0, 0
+            for matiere_id in matiere_ids:
+                note = notes_matieres[matiere_id].get(eleve_id)
+                if note is not None:
+                    coefficient = coefficients.get(matiere_id) or 1
+                    total += note * coefficient
+                    poids += coefficient
+            if poids:
+                moyennes[eleve_id] = total / poids
+
+        rangs = StatistiquesService.classer(moyennes)
+        rangs_matieres = {
+            matiere_id: StatistiquesService.classer(notes_matiere)
+            for matiere_id, notes_matiere in notes_matieres.items()
+        }
+
+        classement = [
+            {
+                'eleve': ObjectId(eleve_id),
+                'moyenne': moyenne,
+                'rang': rangs[eleve_id][0],
+                'percentile': rangs[eleve_id][1],
+                'matieres': [
+                    {
+                        'matiere': ObjectId(matiere_id),
+                        'note': notes_matieres[matiere_id][eleve_id],
+                        'rang': rangs_matieres[matiere_id][eleve_id][0],
+                        'percentile': rangs_matieres[matiere_id][eleve_id][1],
+                    }
+                    for matiere_id in matiere_ids if eleve_id in notes_matieres[matiere_id]
+                ],
+            }
+            for eleve_id, moyenne in moyennes.items()
+        ]
+        classement.sort(key=lambda entree: entree['rang'])
+
+        return {
+            'classe': ObjectId(classe_id),
+            'subdivision': subdivision,
+            'trimestre': ObjectId(trimestre_id),
+            'effectif': len(moyennes),
+            'moyenne': sum(moyennes.values()) / len(moyennes) if moyennes else None,
+            'noteMin': min(moyennes.values()) if moyennes else None,
+            'noteMax': max(moyennes.values()) if moyennes else None,
+            'matieres': [
+                {
+                    'matiere': ObjectId(matiere_id),
+                    'effectif': len(notes_matiere),
+                    'moyenne': sum(notes_matiere.values()) / len(notes_matiere),
+                    'noteMin': min(notes_matiere.values()),
+                    'noteMax': max(notes_matiere.values()),
+                }
+                for matiere_id, notes_matiere in notes_matieres.items() if notes_matiere
+            ],
+            'classement': classement,
+            'dateCalcul': datetime.utcnow(),
+        }
+
+    @staticmethod
+    def enregistrer(trimestre_id: str, plan: Dict[str, Dict[str, List[str]]],
+                    resultats: Dict[Tuple[str, str], Dict[str, Any]], subdivision: str = None) -> int:
+        """Remplace les statistiques des classes du plan à partir des notes qui viennent d'être calculées"""
+        if not plan:
+            return 0
+
+        coefficients = {
+            str(matiere['_id']): matiere.get('coefficient')
+            for matiere in Matiere._get_collection().find(
+                {'classe': {'$in': [ObjectId(classe_id) for classe_id in plan]}}, {'coefficient': 1}
+            )
+        }
+        notes = {cle: resultat['note_finale'] for cle, resultat in resultats.items()}
+
+        operations = []
+        for classe_id, inscriptions in plan.items():
+            document = StatistiquesService.construire(
+                trimestre_id, classe_id, inscriptions['eleve_ids'], inscriptions['matiere_ids'],
+                notes, coefficients, subdivision
+            )
+            operations.append(ReplaceOne(
+                {'classe': document['classe'], 'trimestre': document['trimestre'], 'subdivision': subdivision},
+                document, upsert=True
+            ))
+
+        StatistiquesClasse._get_collection().bulk_write(operations, ordered=False)
+        return len(operations)
+
+    @staticmethod
+    def rafraichir(trimestre_id: str, classe_ids: List[str]) -> int:
+        """Recalcule depuis les notes trimestrielles enregistrées les statistiques existantes ou non de ces classes"""
+        total = 0
+        for classe_id in classe_ids:
+            subdivisions = {None} | {
+                statistiques.get('subdivision')
+                for statistiques in StatistiquesClasse._get_collection().find(
+                    {'classe': ObjectId(classe_id), 'trimestre': ObjectId(trimestre_id)}, {'subdivision': 1}
+                )
+            }
+            for subdivision in subdivisions:
+                plan = NoteService.planifier_inscriptions(classe_id, subdivision)
+                if not plan:
+                    continue
+
+                resultats = {}
+                curseur = NoteTrimestrielle._get_collection().find(
+                    {
+                        'trimestre': ObjectId(trimestre_id),
+                        'eleve': {'$in': [ObjectId(eleve_id) for eleve_id in plan[classe_id]['eleve_ids']]},
+                    },
+                    {'eleve': 1, 'matiere': 1, 'noteFinale': 1}
+                ).sort('_id', 1)
+                for note in curseur:
+                    if note.get('noteFinale') is not None:
+                        resultats.setdefault(
+                            (str(note['eleve']), str(note['matiere'])), {'note_finale': note['noteFinale']}
+                        )
+
+                total += StatistiquesService.enregistrer(trimestre_id, plan, resultats, subdivision)
+        return total
+
+class SuiviNotesService:
+    """Suivi des notes trimestrielles à recalculer après la saisie d'interrogations ou d'examens"""
+
+    @staticmethod
+    def cles_interrogation(interrogation) -> set:
+        """Clé (eleve, matiere, trimestre) impactée par une interrogation"""
+        eleve_id = id_reference(interrogation, 'eleve')
+        matiere_id = id_reference(interrogation, 'matiere')
+        periode_id = id_reference(interrogation, 'periode')
+        if not (eleve_id and matiere_id and periode_id):
+            return set()
+
+        periode = Periode._get_collection().find_one({'_id': ObjectId(periode_id)}, {'trimestre': 1})
+        if not periode or not periode.get('trimestre'):
+            return set()
+        return {(eleve_id, matiere_id, str(periode['trimestre']))}
+
+    @staticmethod
+    def cles_examen(examen) -> set:
+        """Clé (eleve, matiere, trimestre) impactée par un examen"""
+        cle = (id_reference(examen, 'eleve'), id_reference(examen, 'matiere'), id_reference(examen, 'trimestre'))
+        return {cle} if all(cle) else set()
+
+    @staticmethod
+    def marquer(cles) -> int:
+        """Enregistre les clés à recalculer (une seule entrée par clé grâce à l'upsert)"""
+        maintenant = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'eleve': ObjectId(eleve_id), 'matiere': ObjectId(matiere_id), 'trimestre': ObjectId(trimestre_id)},
+                {'$set': {'dateModification': maintenant}},
+                upsert=True
+            )
+            for eleve_id, matiere_id, trimestre_id in cles
+        ]
+        if operations:
+            NoteModifiee._get_collection().bulk_write(operations, ordered=False)
+        return len(operations)
+
+    @staticmethod
+    def recalculer(limite: int = None) -> Dict[str, Any]:
+        """
+        Recalcule uniquement les notes trimestrielles marquées, puis les notes annuelles
+        déjà existantes qui en dépendent
+        """
+        curseur = NoteModifiee._get_collection().find().sort('dateModification', 1)
+        if limite:
+            curseur = curseur.limit(limite)
+        entrees = list(curseur)
+        if not entrees:
+            return {'cles_recalculees': 0, 'notes_trimestrielles': {}, 'notes_annuelles': {}}
+
+        paires_par_trimestre = {}
+        for entree in entrees:
+            paires_par_trimestre.setdefault(str(entree['trimestre']), set()).add(
+                (str(entree['eleve']), str(entree['matiere']))
+            )
+
+        writer = NoteBulkWriter()
+        for trimestre_id, paires in paires_par_trimestre.items():
+            resultats = NoteService.calculer_notes_trimestrielles_lot(
+                trimestre_id, list(paires),
+                eleve_ids=list({eleve_id for eleve_id, _ in paires}),
+                matiere_ids=list({matiere_id for _, matiere_id in paires}),
+            )
+            for (eleve_id, matiere_id), resultat in resultats.items():
+                writer.ajouter_note_trimestrielle(eleve_id, matiere_id, trimestre_id, resultat)
+        rapport_trimestriel = writer.flush()
+
+        # Statistiques des classes dont une note trimestrielle a changé
+        statistiques = 0
+        for trimestre_id, paires in paires_par_trimestre.items():
+            classe_ids = Eleve._get_collection().distinct(
+                'classe', {'_id': {'$in': [ObjectId(eleve_id) for eleve_id, _ in paires]}}
+            )
+            statistiques += StatistiquesService.rafraichir(
+                trimestre_id, [str(classe_id) for classe_id in classe_ids if classe_id]
+            )
+
+        # Notes annuelles existantes qui dépendent des trimestres recalculés
+        annees = {
+            str(trimestre['_id']): str(trimestre['anneeScolaire'])
+            for trimestre in Trimestre._get_collection().find(
+                {'_id': {'$in': [ObjectId(trimestre_id) for trimestre_id in paires_par_trimestre]}},
+                {'anneeScolaire': 1}
+            )
+            if trimestre.get('anneeScolaire')
+        }
+        paires_par_annee = {}
+        for trimestre_id, paires in paires_par_trimestre.items():
+            if trimestre_id in annees:
+                paires_par_annee.setdefault(annees[trimestre_id], set()).update(paires)
+
+        writer_annuel = NoteBulkWriter()
+        annees_recalculees = set()
+        for annee_id, paires in paires_par_annee.items():
+            eleve_ids = list({eleve_id for eleve_id, _ in paires})
+            matiere_ids = list({matiere_id for _, matiere_id in paires})
+            existantes = {
+                (str(note['eleve']), str(note['matiere']))
+                for note in NoteAnnuelle._get_collection().find(
+                    {
+                        'anneeScolaire': ObjectId(annee_id),
+                        'eleve': {'$in': [ObjectId(eleve_id) for eleve_id in eleve_ids]},
+                        'matiere': {'$in': [ObjectId(matiere_id) for matiere_id in matiere_ids]},
+                    },
+                    {'eleve': 1, 'matiere': 1}
+                )
+            }
+            paires_existantes = [paire for paire in paires if paire in existantes]
+            if not paires_existantes:
+                continue
+
+            resultats = NoteService.calculer_notes_annuelles_lot(
+                annee_id, paires_existantes, eleve_ids=eleve_ids, matiere_ids=matiere_ids
+            )
+            for (eleve_id, matiere_id), resultat in resultats.items():
+                writer_annuel.ajouter_note_annuelle(eleve_id, matiere_id, annee_id, resultat)
+                annees_recalculees.add(annee_id)
+        rapport_annuel = writer_annuel.flush()
+        # La simulation de promotion ne doit pas servir les anciennes moyennes jusqu'à la fin du TTL
+        for annee_id in annees_recalculees:
+            SimulationPromotionService.invalider(annee_id)
+
+        # Une clé re-marquée pendant le recalcul garde une date plus récente et reste en attente
+        NoteModifiee._get_collection().bulk_write([
+            DeleteOne({'_id': entree['_id'], 'dateModification': entree['dateModification']})
+            for entree in entrees
+        ], ordered=False)
+
+        return {
+            'cles_recalculees': len(entrees),
+            'notes_trimestrielles': rapport_trimestriel,
+            'notes_annuelles': rapport_annuel,
+            'statistiques': statistiques,
+        }
+
 class PromotionService:
     """Service pour la promotion automatique des élèves"""
     
@@ -146,6 +909,15 @@ class PromotionService:
     @staticmethod
     def promouvoir_eleve(eleve_id: str, annee_scolaire_id: str, methode_subdivision: str = 'auto') -> Dict[str, Any]:
         """Promouvoir un élève à la classe suivante"""
+        resultat, operations = PromotionService.preparer_promotion(eleve_id, annee_scolaire_id, methode_subdivision)
+        if operations:
+            NoteAnnuelle._get_collection().bulk_write(operations, ordered=False)
+        return resultat
+
+    @staticmethod
+    def preparer_promotion(eleve_id: str, annee_scolaire_id: str,
+                           methode_subdivision: str = 'auto') -> Tuple[Dict[str, Any], List[UpdateOne]]:
+        """Décide la promotion d'un élève et retourne les mises à jour de ses notes annuelles sans les écrire"""
         eleve = Eleve.objects.get(id=eleve_id)
         evaluation = PromotionService.evaluer_promotion(eleve_id, annee_scolaire_id)
         
@@ -153,7 +925,7 @@ class PromotionService:
             return {
                 'promotion_effectuee': False, 
                 'raison': f"Moyenne insuffisante: {evaluation.get('moyenne_generale', 0):.2f}/{evaluation.get('seuil_requis', 0)}"
-            }
+            }, []
         
         # Trouver la classe suivante
         classe_actuelle = eleve.classe
@@ -165,137 +937,1274 @@ class PromotionService:
         ).first()
         
         if not classe_suivante:
-            return {'promotion_effectuee': False, 'raison': 'Aucune classe suivante trouvée'}
+            return {'promotion_effectuee': False, 'raison': 'Aucune classe suivante trouvée'}, []
         
         # Choisir la subdivision
-        if methode_subdivision == 'auto' and classe_suivante.subdivisions:
-            subdivision_choisie = random.choice([sub.nom for sub in classe_suivante.subdivisions])
-        else:
-            subdivision_choisie = classe_suivante.subdivisions[0].nom if classe_suivante.subdivisions else 'A'
+        subdivision_choisie = PromotionService.choisir_subdivision(
+            [sub.nom for sub in classe_suivante.subdivisions], methode_subdivision
+        )
         
-        # Mettre à jour la note annuelle avec les infos de promotion
-        for matiere in Matiere.objects.filter(classe=classe_actuelle):
-            note_annuelle = NoteAnnuelle.objects.filter(
-                eleve=eleve_id,
-                matiere=str(matiere.id),
-                anneeScolaire=annee_scolaire_id
-            ).first()
-            
-            if note_annuelle:
-                note_annuelle.promotionAutomatique = True
-                note_annuelle.nouvelleClasse = classe_suivante
-                note_annuelle.nouvelleSubdivision = subdivision_choisie
-                note_annuelle.save()
+        # Mettre à jour la note annuelle avec les infos de promotion (une par matière, comme le .first())
+        maintenant = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {'eleve': ObjectId(eleve_id), 'matiere': matiere['_id'], 'anneeScolaire': ObjectId(annee_scolaire_id)},
+                {'$set': {
+                    'promotionAutomatique': True,
+                    'nouvelleClasse': classe_suivante.id,
+                    'nouvelleSubdivision': subdivision_choisie,
+                    'updatedAt': maintenant,
+                }}
+            )
+            for matiere in Matiere._get_collection().find({'classe': classe_actuelle.id}, {'_id': 1})
+        ]
         
         return {
             'promotion_effectuee': True,
             'nouvelle_classe': classe_suivante.nom,
             'nouvelle_subdivision': subdivision_choisie,
             'moyenne_generale': evaluation['moyenne_generale']
+        }, operations
+
+    @staticmethod
+    def promouvoir_eleves(eleve_ids: List[str], annee_scolaire_id: str, methode_subdivision: str = 'auto') -> Dict[str, int]:
+        """Promouvoir une liste d'élèves et compter les promotions réussies et échouées"""
+        rapport = {'promotions_reussies': 0, 'promotions_echouees': 0}
+        for eleve_id in eleve_ids:
+            resultat = PromotionService.promouvoir_eleve(str(eleve_id), annee_scolaire_id, methode_subdivision)
+            if resultat['promotion_effectuee']:
+                rapport['promotions_reussies'] += 1
+            else:
+                rapport['promotions_echouees'] += 1
+        return rapport
+
+    @staticmethod
+    def choisir_subdivision(subdivisions: List[str], methode_subdivision: str = 'auto') -> str:
+        """Subdivision d'arrivée : au hasard en mode auto, sinon la première (ou 'A' si la classe n'en a pas)"""
+        if methode_subdivision == 'auto' and subdivisions:
+            return random.choice(subdivisions)
+        return subdivisions[0] if subdivisions else 'A'
+
+    @staticmethod
+    def charger_echelle() -> Dict[str, Dict[str, Any]]:
+        """Toutes les classes en une requête : informations utiles et classe suivante (niveau + 1, même typeClasse)"""
+        classes = list(Classe._get_collection().find(
+            {}, {'nom': 1, 'niveau': 1, 'typeClasse': 1, 'seuilPromotion': 1, 'subdivisions.nom': 1}
+        ).sort('_id', 1))
+
+        # Première classe trouvée par (niveau, typeClasse), comme le .first() du calcul unitaire
+        par_niveau = {}
+        for classe in classes:
+            par_niveau.setdefault((classe.get('niveau'), classe.get('typeClasse')), classe)
+
+        echelle = {}
+        for classe in classes:
+            suivante = None
+            if classe.get('niveau') is not None:
+                suivante = par_niveau.get((classe['niveau'] + 1, classe.get('typeClasse')))
+            echelle[str(classe['_id'])] = {
+                'seuil': classe.get('seuilPromotion') or 10,
+                'suivante': suivante and {
+                    'id': suivante['_id'],
+                    'nom': suivante.get('nom'),
+                    'subdivisions': [sub.get('nom') for sub in suivante.get('subdivisions', [])],
+                },
+            }
+        return echelle
+
+    @staticmethod
+    def moyennes_ponderees(annee_scolaire_id: str, eleve_ids: List[ObjectId] = None) -> Dict[str, float]:
+        """Moyenne générale pondérée par les coefficients de chaque élève, en une agrégation sur NoteAnnuelle"""
+        coefficients = {
+            matiere['_id']: matiere.get('coefficient') or 1
+            for matiere in Matiere._get_collection().find({}, {'coefficient': 1})
         }
 
-class NotificationService:
-    """Service pour la gestion des notifications automatiques"""
-    
+        filtre = {'anneeScolaire': ObjectId(annee_scolaire_id), 'noteFinale': {'$ne': None}}
+        if eleve_ids is not None:
+            filtre['eleve'] = {'$in': eleve_ids}
+        groupes = NoteAnnuelle.objects.aggregate([
+            {'$match': filtre},
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': '$eleve',
+                'notes': {'$push': {'matiere': '$matiere', 'note': '$noteFinale'}},
+            }},
+        ], allowDiskUse=True)
+
+        moyennes = {}
+        for groupe in groupes:
+            total_points = 0
+            total_coefficients = 0
+            for note in groupe['notes']:
+                coefficient = coefficients.get(note.get('matiere'), 1)
+                total_points += note['note'] * coefficient
+                total_coefficients += coefficient
+            moyennes[str(groupe['_id'])] = total_points / total_coefficients if total_coefficients > 0 else 0
+        return moyennes
+
     @staticmethod
-    def creer_notification_devoir(devoir_id: str):
-        """Crée des notifications pour un nouveau devoir"""
-        devoir = Devoir.objects.get(id=devoir_id)
-        
-        # Récupérer tous les élèves de la classe/subdivision concernée
-        eleves = Eleve.objects.filter(
-            classe=devoir.classe,
-            subdivision=devoir.subdivision
+    def promouvoir_lot(annee_scolaire_id: str, methode_subdivision: str = 'auto',
+                       classe_id: str = None) -> Dict[str, Any]:
+        """
+        Promotion de toute l'école (ou d'une classe) en quelques requêtes : moyennes pondérées agrégées,
+        échelle des classes préchargée, champs de promotion écrits par update_many groupés
+        """
+        filtre_eleves = {'classe': ObjectId(classe_id)} if classe_id else {}
+        eleves = list(Eleve._get_collection().find(filtre_eleves, {'nom': 1, 'prenom': 1, 'classe': 1}))
+
+        echelle = PromotionService.charger_echelle()
+        moyennes = PromotionService.moyennes_ponderees(
+            annee_scolaire_id, [eleve['_id'] for eleve in eleves] if classe_id else None
         )
-        
-        notifications_creees = 0
+
+        resultats = {'promus': [], 'non_promus': [], 'total': len(eleves)}
+        admis = {}
         for eleve in eleves:
-            # Notifier les parents de chaque élève
-            for parent in eleve.parents:
-                notification = Notification(
-                    destinataire=parent,
-                    type='devoir',
-                    referenceId=devoir_id,
-                    dateEnvoi=datetime.utcnow(),
-                    lu=False
+            eleve_id = str(eleve['_id'])
+            entree = {
+                'eleve_id': eleve_id,
+                'nom_complet': f"{eleve.get('prenom')} {eleve.get('nom')}",
+                'moyenne': moyennes.get(eleve_id, 0),
+            }
+            classe = echelle.get(str(eleve.get('classe')))
+
+            if classe is None:
+                resultats['non_promus'].append(dict(entree, raison='Pas de classe assignée'))
+            elif entree['moyenne'] < classe['seuil']:
+                resultats['non_promus'].append(dict(entree, raison=f"Moyenne insuffisante: {entree['moyenne']:.2f}/{classe['seuil']}"))
+            elif classe['suivante'] is None:
+                resultats['non_promus'].append(dict(entree, raison='Aucune classe suivante trouvée'))
+            else:
+                entree['nouvelle_classe'] = classe['suivante']['nom']
+                admis.setdefault(classe['suivante']['id'], (classe['suivante'], []))[1].append(entree)
+                resultats['promus'].append(entree)
+
+        # Mode auto : promus répartis de façon équilibrée entre les subdivisions de leur nouvelle classe,
+        # stratifiés par moyenne
+        groupes = {}
+        for classe_suivante, (suivante, entrees) in admis.items():
+            if methode_subdivision == 'auto' and suivante['subdivisions']:
+                subdivisions = SubdivisionService.repartir(
+                    [entree['eleve_id'] for entree in entrees], suivante['subdivisions'],
+                    moyennes={entree['eleve_id']: entree['moyenne'] for entree in entrees},
                 )
-                notification.save()
-                notifications_creees += 1
-        
-        return {'notifications_creees': notifications_creees}
-    
+            else:
+                choix = PromotionService.choisir_subdivision(suivante['subdivisions'], methode_subdivision)
+                subdivisions = {entree['eleve_id']: choix for entree in entrees}
+            for entree in entrees:
+                entree['nouvelle_subdivision'] = subdivisions[entree['eleve_id']]
+                groupes.setdefault((classe_suivante, entree['nouvelle_subdivision']), []).append(ObjectId(entree['eleve_id']))
+
+        maintenant = datetime.utcnow()
+        operations = [
+            UpdateMany(
+                {'eleve': {'$in': eleve_ids}, 'anneeScolaire': ObjectId(annee_scolaire_id)},
+                {'$set': {
+                    'promotionAutomatique': True,
+                    'nouvelleClasse': classe_suivante,
+                    'nouvelleSubdivision': subdivision,
+                    'updatedAt': maintenant,
+                }}
+            )
+            for (classe_suivante, subdivision), eleve_ids in groupes.items()
+        ]
+        if operations:
+            NoteAnnuelle._get_collection().bulk_write(operations, ordered=False)
+
+        resultats['promotions_reussies'] = len(resultats['promus'])
+        resultats['promotions_echouees'] = len(resultats['non_promus'])
+        return resultats
+
     @staticmethod
-    def creer_notification_message(message_id: str):
-        """Crée une notification pour un nouveau message"""
-        message = Message.objects.get(id=message_id)
+    def evaluer_promotion_eleve(eleve_id: str, annee_scolaire_id: str) -> Dict[str, Any]:
+        """
+        Évalue si un élève peut être promu automatiquement
+        """
+        eleve = Eleve.objects.get(id=eleve_id)
+        classe = eleve.classe
         
-        notification = Notification(
-            destinataire=message.receiver,
-            type='message',
-            referenceId=message_id,
-            dateEnvoi=datetime.utcnow(),
-            lu=False
-        )
+        # Récupérer toutes les notes annuelles de l'élève
+        notes_annuelles = NoteAnnuelle.objects.filter(
+            eleve=eleve_id,
+            anneeScolaire=annee_scolaire_id
+        )
+        
+        # Calculer la moyenne générale pondérée
+        total_points = 0
+        total_coefficients = 0
+        
+        for note in notes_annuelles:
+            matiere = note.matiere
+            coefficient = matiere.coefficient or 1
+            
+            total_points += note.noteFinale * coefficient
+            total_coefficients += coefficient
+        
+        moyenne_generale = total_points / total_coefficients if total_coefficients > 0 else 0
+        
+        # Vérifier si l'élève atteint le seuil de promotion
+        seuil = classe.seuilPromotion or 10  # Seuil par défaut : 10/20
+        promotion_automatique = moyenne_generale >= seuil
+        
+        return {
+            'moyenne_generale': moyenne_generale,
+            'seuil_promotion': seuil,
+            'promotion_automatique': promotion_automatique,
+            'nouvelle_classe': None,  # À déterminer selon la logique métier
+            'nouvelle_subdivision': None
+        }
+    
+    @staticmethod
+    def promouvoir_eleves_classe(classe_id: str, annee_scolaire_id: str, methode_subdivision: str = 'auto') -> Dict[str, Any]:
+        """
+        Promouvoir tous les élèves éligibles d'une classe
+        """
+        eleves = Eleve.objects.filter(classe=classe_id)
+        resultats = {
+            'promus': [],
+            'non_promus': [],
+            'total': len(eleves)
+        }
+        
+        for eleve in eleves:
+            evaluation = PromotionService.evaluer_promotion_eleve(str(eleve.id), annee_scolaire_id)
+            
+            if evaluation['promotion_automatique']:
+                # Logique pour déterminer la nouvelle classe
+                # (dépend de la structure des classes dans le système)
+                resultats['promus'].append({
+                    'eleve_id': str(eleve.id),
+                    'nom_complet': f"{eleve.prenom} {eleve.nom}",
+                    'moyenne': evaluation['moyenne_generale']
+                })
+            else:
+                resultats['non_promus'].append({
+                    'eleve_id': str(eleve.id),
+                    'nom_complet': f"{eleve.prenom} {eleve.nom}",
+                    'moyenne': evaluation['moyenne_generale']
+                })
+        
+        return resultats
+
+class SimulationPromotionService:
+    """
+    Simulation de promotion sans écriture : les moyennes pondérées d'une année sont chargées une
+    fois dans un instantané en mémoire (trié par classe), puis chaque seuil est évalué par bisection
+    """
+
+    _instantanes: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+    _verrou = threading.Lock()
+
+    @staticmethod
+    def charger(annee_scolaire_id: str) -> Dict[str, Any]:
+        """Construit l'instantané : par classe, les élèves triés par moyenne pondérée croissante"""
+        if not AnneeScolaire._get_collection().count_documents({'_id': ObjectId(annee_scolaire_id)}, limit=1):
+            raise ValueError("Année scolaire introuvable")
+
+        echelle = PromotionService.charger_echelle()
+        noms = {
+            str(classe['_id']): classe.get('nom')
+            for classe in Classe._get_collection().find({}, {'nom': 1})
+        }
+        moyennes = PromotionService.moyennes_ponderees(annee_scolaire_id)
+
+        classes = {}
+        for eleve in Eleve._get_collection().find({'classe': {'$ne': None}}, {'nom': 1, 'prenom': 1, 'classe': 1}):
+            classe_id = str(eleve['classe'])
+            if classe_id not in echelle:
+                continue
+            eleve_id = str(eleve['_id'])
+            classes.setdefault(classe_id, []).append(
+                (moyennes.get(eleve_id, 0), eleve_id, f"{eleve.get('prenom')} {eleve.get('nom')}")
+            )
+
+        instantane = {'annee_scolaire_id': annee_scolaire_id, 'dateChargement': datetime.utcnow(), 'classes': {}}
+        for classe_id, eleves in classes.items():
+            eleves.sort()
+            instantane['classes'][classe_id] = {
+                'nom': noms.get(classe_id),
+                'seuil': echelle[classe_id]['seuil'],
+                'moyennes': [eleve[0] for eleve in eleves],
+                'eleves': eleves,
+            }
+        return instantane
+
+    @staticmethod
+    def instantane(annee_scolaire_id: str, rafraichir: bool = False) -> Dict[str, Any]:
+        """
+        Instantané en cache pour l'année (rechargé après SIMULATION_PROMOTION_TTL secondes) ; le
+        cache garde les SIMULATION_PROMOTION_ANNEES années les plus récemment simulées
+        """
+        duree = getattr(settings, 'SIMULATION_PROMOTION_TTL', 300)
+        instantanes = SimulationPromotionService._instantanes
+        with SimulationPromotionService._verrou:
+            entree = instantanes.get(annee_scolaire_id)
+            if entree and not rafraichir and time.monotonic() - entree[0] < duree:
+                instantanes.move_to_end(annee_scolaire_id)
+                return entree[1]
+
+        instantane = SimulationPromotionService.charger(annee_scolaire_id)
+        with SimulationPromotionService._verrou:
+            instantanes[annee_scolaire_id] = (time.monotonic(), instantane)
+            instantanes.move_to_end(annee_scolaire_id)
+            while len(instantanes) > max(1, getattr(settings, 'SIMULATION_PROMOTION_ANNEES', 4)):
+                instantanes.popitem(last=False)
+        return instantane
+
+    @staticmethod
+    def invalider(annee_scolaire_id: str = None):
+        """Oublie l'instantané d'une année (ou de toutes) après un recalcul des notes annuelles"""
+        with SimulationPromotionService._verrou:
+            if annee_scolaire_id is None:
+                SimulationPromotionService._instantanes.clear()
+            else:
+                SimulationPromotionService._instantanes.pop(annee_scolaire_id, None)
+
+    @staticmethod
+    def simuler(annee_scolaire_id: str, seuils: Dict[str, float] = None, marge: float = 1.0,
+                classe_id: str = None, rafraichir: bool = False) -> Dict[str, Any]:
+        """
+        Nombre d'admis par classe pour les seuils donnés (seuil actuel de la classe sinon) et
+        élèves proches du seuil (moyenne dans [seuil - marge, seuil + marge[)
+        """
+        instantane = SimulationPromotionService.instantane(annee_scolaire_id, rafraichir)
+        seuils = seuils or {}
+
+        resultats = {'classes': [], 'effectif': 0, 'admis': 0, 'dateChargement': instantane['dateChargement']}
+        for id_classe, classe in instantane['classes'].items():
+            if classe_id and id_classe != classe_id:
+                continue
+            seuil = float(seuils.get(id_classe, classe['seuil']))
+            moyennes = classe['moyennes']
+            premier_admis = bisect_left(moyennes, seuil)
+            debut = bisect_left(moyennes, seuil - marge)
+            fin = bisect_left(moyennes, seuil + marge)
+
+            effectif = len(moyennes)
+            admis = effectif - premier_admis
+            resultats['classes'].append({
+                'classe_id': id_classe,
+                'nom': classe['nom'],
+                'seuil': seuil,
+                'seuil_actuel': classe['seuil'],
+                'effectif': effectif,
+                'admis': admis,
+                'non_admis': premier_admis,
+                'taux_reussite': round(100.0 * admis / effectif, 1) if effectif else 0.0,
+                'limites': [
+                    {'eleve_id': eleve_id, 'nom_complet': nom_complet, 'moyenne': moyenne, 'admis': moyenne >= seuil}
+                    for moyenne, eleve_id, nom_complet in classe['eleves'][debut:fin]
+                ],
+            })
+            resultats['effectif'] += effectif
+            resultats['admis'] += admis
+
+        resultats['classes'].sort(key=lambda classe: classe['nom'] or '')
+        resultats['non_admis'] = resultats['effectif'] - resultats['admis']
+        return resultats
+
+class NotificationService:
+    """Service pour la gestion des notifications automatiques"""
+    
+    @staticmethod
+    def creer_notification(destinataire_id: str, type_notif: str, reference_id: str):
+        """
+        Crée une nouvelle notification
+        """
+        notification = Notification(
+            destinataire=destinataire_id,
+            type=type_notif,
+            referenceId=reference_id,
+            lu=False,
+            dateEnvoi=datetime.utcnow()
+        )
+        notification.save()
+        CompteurService.incrementer(CompteurService.contribution_notification(notification))
+        abonnements.signaler()
+        return notification
+
+    @staticmethod
+    def notifications_devoir(devoir_id: str) -> List[Dict[str, Any]]:
+        """
+        Documents de notification d'un devoir : un par parent des élèves de la classe/subdivision,
+        un parent ayant plusieurs enfants concernés n'étant notifié qu'une fois
+        """
+        devoir = Devoir.objects.get(id=devoir_id)
+        classe_id = id_reference(devoir, 'classe')
+
+        # Identifiants des parents en une requête projetée, dédoublonnés dans l'ordre
+        parents = {}
+        for eleve in Eleve._get_collection().find(
+            {'classe': ObjectId(classe_id) if classe_id else None, 'subdivision': devoir.subdivision},
+            {'parents': 1}
+        ):
+            for parent in eleve.get('parents') or []:
+                parents.setdefault(parent, None)
+
+        maintenant = datetime.utcnow()
+        return [
+            {
+                'destinataire': parent,
+                'type': 'devoir',
+                'referenceId': ObjectId(devoir_id),
+                'lu': False,
+                'dateEnvoi': maintenant,
+                'createdAt': maintenant,
+                'updatedAt': maintenant,
+            }
+            for parent in parents
+        ]
+
+    @staticmethod
+    def inserer_notifications(documents: List[Dict[str, Any]]) -> int:
+        """
+        Insère les notifications en un seul insert_many, ou les fusionne dans les notifications
+        regroupées ouvertes si NOTIFICATIONS_REGROUPEMENT_FENETRE est défini
+        """
+        if not documents:
+            return 0
+        fenetre = getattr(settings, 'NOTIFICATIONS_REGROUPEMENT_FENETRE', 0)
+        if fenetre > 0:
+            nouvelles = NotificationService.regrouper_notifications(documents, fenetre)
+        else:
+            for document in documents:
+                document.setdefault('references', [document['referenceId']])
+            Notification._get_collection().insert_many(documents, ordered=False)
+            nouvelles = [document for document in documents if not document.get('lu')]
+
+        increments = {}
+        for document in nouvelles:
+            cle = (str(document['destinataire']), f"notifications.{document['type']}")
+            increments[cle] = increments.get(cle, 0) + 1
+        CompteurService.incrementer(increments)
+        abonnements.signaler()
+        return len(documents)
+
+    @staticmethod
+    def regrouper_notifications(documents: List[Dict[str, Any]], fenetre: int) -> List[Dict[str, Any]]:
+        """
+        Fusionne chaque notification dans la notification non lue du même type et du même
+        destinataire ouverte depuis moins de `fenetre` secondes ($addToSet sur references), ou
+        la crée (upsert). Un seul bulk_write ordonné : deux notifications d'un même lot pour le
+        même destinataire arrivent dans le même regroupement. Retourne les documents qui ont
+        créé un regroupement (seuls ceux-là comptent dans les non-lus).
+        """
+        maintenant = datetime.utcnow()
+        ouverture = maintenant - timedelta(seconds=fenetre)
+        resultat = Notification._get_collection().bulk_write([
+            UpdateOne(
+                {
+                    'destinataire': document['destinataire'],
+                    'type': document['type'],
+                    'lu': False,
+                    'dateEnvoi': {'$gte': ouverture},
+                },
+                {
+                    '$setOnInsert': {'dateEnvoi': document.get('dateEnvoi', maintenant), 'createdAt': maintenant},
+                    '$set': {'referenceId': document['referenceId'], 'updatedAt': maintenant},
+                    '$addToSet': {'references': document['referenceId']},
+                },
+                upsert=True,
+            )
+            for document in documents
+        ])
+        return [documents[index] for index in resultat.upserted_ids]
+
+    @staticmethod
+    def creer_notification_devoir(devoir_id: str):
+        """Crée des notifications pour un nouveau devoir"""
+        documents = NotificationService.notifications_devoir(devoir_id)
+        return {'notifications_creees': NotificationService.inserer_notifications(documents)}
+
+    @staticmethod
+    def notifier_nouveau_devoir(devoir_id: str):
+        """
+        Notifie les parents d'un nouveau devoir et retourne les notifications créées
+        """
+        documents = NotificationService.notifications_devoir(devoir_id)
+        NotificationService.inserer_notifications(documents)
+        return [Notification._from_son(document) for document in documents]
+    
+    @staticmethod
+    def creer_notification_message(message_id: str):
+        """Crée une notification pour un nouveau message"""
+        message = Message.objects.get(id=message_id)
+        
+        notification = Notification(
+            destinataire=message.receiver,
+            type='message',
+            referenceId=message_id,
+            dateEnvoi=datetime.utcnow(),
+            lu=False
+        )
         notification.save()
         
         return {'notification_creee': True}
     
     @staticmethod
-    def marquer_notifications_lues(user_id: str, type_notification: str = None):
-        """Marque toutes les notifications d'un utilisateur comme lues"""
-        query = {'destinataire': user_id}
-        if type_notification:
-            query['type'] = type_notification
+    def notifier_nouveau_message(message_id: str):
+        """
+        Notifie le destinataire d'un nouveau message
+        """
+        message = Message.objects.get(id=message_id)
         
-        notifications = Notification.objects.filter(**query)
-        count = 0
-        for notif in notifications:
-            if not notif.lu:
-                notif.lu = True
-                notif.save()
-                count += 1
+        notification = NotificationService.creer_notification(
+            id_reference(message, 'receiver'),
+            'message',
+            message_id
+        )
         
-        return {'notifications_marquees': count}
+        return notification
+    
+    @staticmethod
+    def marquer_notifications_lues(user_id: str, type_notification: str = None, reference_ids: List[str] = None,
+                                   avant: datetime = None):
+        """
+        Marque comme lues, en un seul update_many, les notifications non lues d'un utilisateur (filtres
+        optionnels : type, références, envoyées avant une date). Sans type, les non-lues sont d'abord
+        décomptées par type (aggregate) ; si l'update n'en modifie pas exactement autant (écriture
+        concurrente), le compteur est recalculé plutôt que décrémenté au hasard.
+        """
+        query = {'destinataire': ObjectId(user_id), 'lu': False}
+        if reference_ids is not None:
+            references = [ObjectId(reference_id) for reference_id in reference_ids]
+            query['$or'] = [{'referenceId': {'$in': references}}, {'references': {'$in': references}}]
+        if avant:
+            query['dateEnvoi'] = {'$lt': avant}
+
+        if type_notification:
+            query['type'] = type_notification
+        collection = Notification._get_collection()
+        par_type = None
+        if not type_notification:
+            par_type = {
+                groupe['_id']: groupe['total']
+                for groupe in collection.aggregate([
+                    {'$match': query}, {'$group': {'_id': '$type', 'total': {'$sum': 1}}},
+                ])
+            }
+            if not par_type:
+                return {'notifications_marquees': 0}
+
+        marquees = collection.update_many(query, {'$set': {'lu': True, 'updatedAt': datetime.utcnow()}}).modified_count
+        if par_type is None:
+            CompteurService.incrementer({(user_id, f'notifications.{type_notification}'): -marquees})
+        elif marquees == sum(par_type.values()):
+            CompteurService.incrementer({
+                (user_id, f'notifications.{type_notif}'): -total for type_notif, total in par_type.items()
+            })
+        else:
+            CompteurService.lire(user_id, recalculer=True)
+        return {'notifications_marquees': marquees}
+
+    @staticmethod
+    def marquer_notification_lue(user_id: str, notification_id: str) -> bool:
+        """Marque une notification de l'utilisateur comme lue ; False si elle n'existe pas"""
+        avant = Notification._get_collection().find_one_and_update(
+            {'_id': ObjectId(notification_id), 'destinataire': ObjectId(user_id)},
+            {'$set': {'lu': True, 'updatedAt': datetime.utcnow()}},
+            projection={'type': 1, 'lu': 1},
+        )
+        if avant is None:
+            return False
+        if not avant.get('lu'):
+            CompteurService.incrementer({(user_id, f"notifications.{avant.get('type')}"): -1})
+        return True
+
+class MessageService:
+    """Service pour l'état de lecture des messages"""
+
+    @staticmethod
+    def marquer_conversation_lue(user_id: str, interlocuteur_id: str, avant: datetime = None):
+        """
+        Marque comme lus les messages reçus de interlocuteur_id (et leurs notifications) : une lecture
+        des identifiants puis un update_many par collection
+        """
+        query = {'receiver': ObjectId(user_id), 'sender': ObjectId(interlocuteur_id), 'lu': False}
+        if avant:
+            query['createdAt'] = {'$lt': avant}
+
+        collection = Message._get_collection()
+        message_ids = [message['_id'] for message in collection.find(query, {'_id': 1})]
+        if not message_ids:
+            return {'messages_marques': 0, 'notifications_marquees': 0}
+
+        resultat = collection.update_many(
+            {'_id': {'$in': message_ids}, 'lu': False},
+            {'$set': {'lu': True, 'updatedAt': datetime.utcnow()}}
+        )
+        CompteurService.incrementer({(user_id, 'messages'): -resultat.modified_count})
+        Conversation._get_collection().update_one(
+            {'cle': ConversationService.cle(user_id, interlocuteur_id)},
+            {'$inc': {f'nonLus.{user_id}': -resultat.modified_count}}
+        )
+        notifications = NotificationService.marquer_notifications_lues(user_id, 'message', message_ids)
+        return {'messages_marques': resultat.modified_count, **notifications}
+
+class ConversationService:
+    """Conversations (une par paire d'utilisateurs) : boîte de réception et fils paginés par curseur"""
+
+    LONGUEUR_APERCU = 100
+    TAILLE_PAGE = 20
+    TAILLE_PAGE_MAX = 100
+
+    @staticmethod
+    def cle(user_id: str, interlocuteur_id: str) -> str:
+        """Clé d'une paire d'utilisateurs, identique dans les deux sens"""
+        return ':'.join(sorted([str(user_id), str(interlocuteur_id)]))
+
+    @staticmethod
+    def participants(cle: str) -> List[ObjectId]:
+        return [ObjectId(user_id) for user_id in dict.fromkeys(cle.split(':'))]
+
+    @staticmethod
+    def curseur(date: datetime, document_id: ObjectId) -> str:
+        """Curseur d'une page : date (millisecondes) et _id du dernier élément retourné"""
+        return f"{int((date - EPOQUE).total_seconds() * 1000)}:{document_id}"
+
+    @staticmethod
+    def lire_curseur(curseur: str) -> Tuple[datetime, ObjectId]:
+        """Inverse de curseur() ; ValueError si le curseur est invalide"""
+        millisecondes, _, document_id = curseur.partition(':')
+        if not millisecondes.isdigit() or not ObjectId.is_valid(document_id):
+            raise ValueError("Curseur invalide")
+        return EPOQUE + timedelta(milliseconds=int(millisecondes)), ObjectId(document_id)
+
+    @staticmethod
+    def page(collection, query: Dict[str, Any], champ: str, curseur: str = None, limite: int = None):
+        """
+        Page par clé (keyset) triée par champ puis _id décroissants : la suite d'une page reprend
+        après le dernier élément au lieu de sauter des documents. Retourne (documents, curseur suivant).
+        """
+        limite = max(1, min(limite or ConversationService.TAILLE_PAGE, ConversationService.TAILLE_PAGE_MAX))
+        if curseur:
+            date, dernier_id = ConversationService.lire_curseur(curseur)
+            query = dict(query, **{'$or': [{champ: {'$lt': date}}, {champ: date, '_id': {'$lt': dernier_id}}]})
+
+        documents = list(collection.find(query).sort([(champ, -1), ('_id', -1)]).limit(limite + 1))
+        suivant = None
+        if len(documents) > limite:
+            documents = documents[:limite]
+            suivant = ConversationService.curseur(documents[-1][champ], documents[-1]['_id'])
+        return documents, suivant
+
+    @staticmethod
+    def enregistrer_message(message) -> Optional[str]:
+        """
+        Rattache un nouveau message à sa conversation : clé sur le message, puis un bulk_write sur la
+        conversation (création et non-lus du destinataire, puis dernier message s'il est le plus récent)
+        """
+        sender_id, receiver_id = id_reference(message, 'sender'), id_reference(message, 'receiver')
+        if not sender_id or not receiver_id:
+            return None
+
+        cle = ConversationService.cle(sender_id, receiver_id)
+        Message._get_collection().update_one({'_id': message.id}, {'$set': {'conversation': cle}})
+        message.conversation = cle
+
+        maintenant = datetime.utcnow()
+        date = message.createdAt or maintenant
+        Conversation._get_collection().bulk_write([
+            UpdateOne({'cle': cle}, {
+                '$setOnInsert': {'participants': ConversationService.participants(cle), 'createdAt': maintenant},
+                '$inc': {f'nonLus.{receiver_id}': 0 if message.lu else 1},
+                '$set': {'updatedAt': maintenant},
+            }, upsert=True),
+            # Un message plus ancien écrit en concurrence ne remplace pas le dernier message
+            UpdateOne({'cle': cle, '$or': [{'derniereActivite': {'$lte': date}}, {'derniereActivite': None}]}, {'$set': {
+                'dernierMessage': message.id,
+                'expediteur': ObjectId(sender_id),
+                'apercu': (message.contenu or '')[:ConversationService.LONGUEUR_APERCU],
+                'derniereActivite': date,
+            }}),
+        ])
+        return cle
+
+    @staticmethod
+    def ajuster(message, non_lus: int = 0, supprime: bool = False):
+        """Reporte la modification (variation des non-lus du destinataire) ou la suppression d'un message"""
+        sender_id, receiver_id = id_reference(message, 'sender'), id_reference(message, 'receiver')
+        if not sender_id or not receiver_id:
+            return
+        cle = message.conversation or ConversationService.cle(sender_id, receiver_id)
+        if supprime:
+            ConversationService.reconstruire([cle])
+        elif non_lus:
+            Conversation._get_collection().update_one({'cle': cle}, {'$inc': {f'nonLus.{receiver_id}': non_lus}})
+
+    @staticmethod
+    def indexer_messages() -> int:
+        """Complète les anciens messages : clé de conversation et createdAt (date de l'ObjectId) manquants"""
+        collection = Message._get_collection()
+        operations = []
+        for message in collection.find(
+            {'$or': [{'conversation': None}, {'createdAt': None}], 'sender': {'$ne': None}, 'receiver': {'$ne': None}},
+            {'sender': 1, 'receiver': 1, 'createdAt': 1}
+        ):
+            champs = {'conversation': ConversationService.cle(message['sender'], message['receiver'])}
+            if not message.get('createdAt'):
+                champs['createdAt'] = message['_id'].generation_time.replace(tzinfo=None)
+            operations.append(UpdateOne({'_id': message['_id']}, {'$set': champs}))
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    @staticmethod
+    def reconstruire(cles: List[str] = None) -> int:
+        """
+        Recalcule les conversations (toutes, ou celles de cles) depuis les messages : dernier message
+        par l'index conversation/createdAt, non-lus par destinataire ; une conversation sans message
+        est supprimée
+        """
+        messages = Message._get_collection()
+        filtre = {'conversation': {'$in': cles}} if cles is not None else {'conversation': {'$ne': None}}
+
+        non_lus = {}
+        for groupe in messages.aggregate([
+            {'$match': dict(filtre, lu=False)},
+            {'$group': {'_id': {'conversation': '$conversation', 'receiver': '$receiver'}, 'total': {'$sum': 1}}},
+        ], allowDiskUse=True):
+            non_lus.setdefault(groupe['_id']['conversation'], {})[str(groupe['_id']['receiver'])] = groupe['total']
+
+        maintenant = datetime.utcnow()
+        operations = [
+            UpdateOne({'cle': dernier['_id']}, {
+                '$setOnInsert': {'participants': ConversationService.participants(dernier['_id']), 'createdAt': maintenant},
+                '$set': {
+                    'dernierMessage': dernier['message'],
+                    'expediteur': dernier['expediteur'],
+                    'apercu': (dernier.get('contenu') or '')[:ConversationService.LONGUEUR_APERCU],
+                    'derniereActivite': dernier['date'],
+                    'nonLus': non_lus.get(dernier['_id'], {}),
+                    'updatedAt': maintenant,
+                },
+            }, upsert=True)
+            for dernier in messages.aggregate([
+                {'$match': filtre},
+                {'$sort': {'conversation': 1, 'createdAt': -1, '_id': -1}},
+                {'$group': {
+                    '_id': '$conversation',
+                    'message': {'$first': '$_id'},
+                    'expediteur': {'$first': '$sender'},
+                    'contenu': {'$first': '$contenu'},
+                    'date': {'$first': '$createdAt'},
+                }},
+            ], allowDiskUse=True)
+        ]
+
+        collection = Conversation._get_collection()
+        if operations:
+            collection.bulk_write(operations, ordered=False)
+        if cles is not None:
+            vides = set(cles) - {operation._filter['cle'] for operation in operations}
+            if vides:
+                collection.delete_many({'cle': {'$in': list(vides)}})
+        return len(operations)
+
+    @staticmethod
+    def boite_reception(user_id: str, curseur: str = None, limite: int = None) -> Dict[str, Any]:
+        """Conversations de l'utilisateur, la plus récente d'abord (index participants/derniereActivite)"""
+        documents, suivant = ConversationService.page(
+            Conversation._get_collection(), {'participants': ObjectId(user_id)}, 'derniereActivite', curseur, limite
+        )
+
+        # Noms des interlocuteurs de la page en une requête projetée
+        interlocuteurs = {}
+        for document in documents:
+            autres = [participant for participant in document.get('participants', []) if str(participant) != user_id]
+            interlocuteurs[document['_id']] = autres[0] if autres else ObjectId(user_id)
+        utilisateurs = {
+            utilisateur['_id']: utilisateur
+            for utilisateur in User._get_collection().find(
+                {'_id': {'$in': list(set(interlocuteurs.values()))}}, {'nom': 1, 'prenom': 1, 'role': 1}
+            )
+        }
+
+        conversations = []
+        for document in documents:
+            interlocuteur = utilisateurs.get(interlocuteurs[document['_id']], {'_id': interlocuteurs[document['_id']]})
+            conversations.append({
+                'id': str(document['_id']),
+                'interlocuteur': {
+                    'id': str(interlocuteur['_id']),
+                    'nom': interlocuteur.get('nom'),
+                    'prenom': interlocuteur.get('prenom'),
+                    'role': interlocuteur.get('role'),
+                },
+                'dernierMessage': {
+                    'id': str(document['dernierMessage']) if document.get('dernierMessage') else None,
+                    'expediteur': str(document['expediteur']) if document.get('expediteur') else None,
+                    'apercu': document.get('apercu'),
+                },
+                'derniereActivite': document.get('derniereActivite'),
+                'nonLus': document.get('nonLus', {}).get(user_id, 0),
+            })
+        return {'conversations': conversations, 'suivant': suivant}
+
+    @staticmethod
+    def fil(user_id: str, interlocuteur_id: str, curseur: str = None, limite: int = None) -> Dict[str, Any]:
+        """Messages d'une conversation, du plus récent au plus ancien (index conversation/createdAt)"""
+        documents, suivant = ConversationService.page(
+            Message._get_collection(), {'conversation': ConversationService.cle(user_id, str(ObjectId(interlocuteur_id)))},
+            'createdAt', curseur, limite
+        )
+        return {'messages': [Message._from_son(document) for document in documents], 'suivant': suivant}
+
+class CompteurService:
+    """Compteurs de non-lus par utilisateur (CompteurNonLus), mis à jour par $inc"""
+
+    @staticmethod
+    def incrementer(increments: Dict[Tuple[str, str], int]):
+        """
+        Applique {(user_id, champ): delta} en un bulk_write. Un compteur pas encore initialisé n'est
+        pas créé : il sera calculé à sa première lecture. Chaque $inc augmente aussi version, ce qui
+        fait échouer (et reprendre) un calcul en cours sur le même compteur.
+        """
+        par_utilisateur = {}
+        for (user_id, champ), delta in increments.items():
+            if delta and user_id:
+                champs = par_utilisateur.setdefault(str(user_id), {})
+                champs[champ] = champs.get(champ, 0) + delta
+        if not par_utilisateur:
+            return
+
+        maintenant = datetime.utcnow()
+        CompteurNonLus._get_collection().bulk_write([
+            UpdateOne({'utilisateur': ObjectId(user_id)},
+                      {'$inc': dict(champs, version=1), '$set': {'updatedAt': maintenant}})
+            for user_id, champs in par_utilisateur.items()
+        ], ordered=False)
+
+    @staticmethod
+    def contribution_notification(notification) -> Dict[Tuple[str, str], int]:
+        """Part d'une notification dans les compteurs (rien si elle est lue)"""
+        if notification is None or notification.lu:
+            return {}
+        return {(id_reference(notification, 'destinataire'), f'notifications.{notification.type}'): 1}
+
+    @staticmethod
+    def contribution_message(message) -> Dict[Tuple[str, str], int]:
+        """Part d'un message dans les compteurs de son destinataire (rien s'il est lu)"""
+        if message is None or message.lu:
+            return {}
+        return {(id_reference(message, 'receiver'), 'messages'): 1}
+
+    @staticmethod
+    def difference(avant: Dict[Tuple[str, str], int], apres: Dict[Tuple[str, str], int]) -> Dict[Tuple[str, str], int]:
+        """Variation des compteurs entre deux états d'un document"""
+        return {cle: apres.get(cle, 0) - avant.get(cle, 0) for cle in set(avant) | set(apres)}
+
+    @staticmethod
+    def calculer(user_id: str) -> Dict[str, Any]:
+        """Recompte les non-lus depuis les collections (index destinataire/lu/type et receiver/sender/lu)"""
+        notifications = {
+            groupe['_id']: groupe['total']
+            for groupe in Notification._get_collection().aggregate([
+                {'$match': {'destinataire': ObjectId(user_id), 'lu': False}},
+                {'$group': {'_id': '$type', 'total': {'$sum': 1}}},
+            ])
+        }
+        messages = Message._get_collection().count_documents({'receiver': ObjectId(user_id), 'lu': False})
+        return {'notifications': notifications, 'messages': messages}
+
+    @staticmethod
+    def initialiser(user_id: str, tentatives: int = 3) -> Dict[str, Any]:
+        """
+        Calcule (ou recalcule) le compteur sans perdre les $inc concurrents. Le document est d'abord
+        créé vide ($setOnInsert, initialise=False) pour que incrementer s'y applique dès ce moment ;
+        le recomptage est ensuite ajouté par $inc de l'écart avec l'état lu juste avant lui. Le champ
+        version, augmenté par chaque $inc et chaque calcul, sert de compare-and-set : si le compteur a
+        changé pendant le recomptage (increment concurrent, déjà vu ou non par le recomptage, ou autre
+        calcul), l'écart n'est pas appliqué et le calcul reprend.
+        """
+        collection = CompteurNonLus._get_collection()
+        filtre = {'utilisateur': ObjectId(user_id)}
+        for _ in range(tentatives):
+            base = collection.find_one_and_update(
+                filtre,
+                {'$setOnInsert': {'notifications': {}, 'messages': 0, 'initialise': False, 'version': 0}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            calcule = CompteurService.calculer(user_id)
+
+            ecarts = {
+                f'notifications.{type_notif}': calcule['notifications'].get(type_notif, 0) - total
+                for type_notif, total in base.get('notifications', {}).items()
+            }
+            for type_notif, total in calcule['notifications'].items():
+                ecarts.setdefault(f'notifications.{type_notif}', total)
+            ecarts['messages'] = calcule['messages'] - base.get('messages', 0)
+            ecarts = {champ: delta for champ, delta in ecarts.items() if delta}
+            ecarts['version'] = 1
+
+            compteur = collection.find_one_and_update(
+                dict(filtre, version=base.get('version')),
+                {'$inc': ecarts, '$set': {'initialise': True, 'updatedAt': datetime.utcnow()}},
+                return_document=ReturnDocument.AFTER,
+            )
+            if compteur is not None:
+                return compteur
+        # Compteur trop sollicité pour un calcul stable : l'état courant est rendu, le calcul sera repris
+        # à la prochaine lecture s'il n'a jamais abouti (initialise=False)
+        return collection.find_one(filtre) or base
+
+    @staticmethod
+    def lire(user_id: str, recalculer: bool = False) -> Dict[str, Any]:
+        """Compteurs de l'utilisateur : une lecture indexée, calculés et enregistrés la première fois"""
+        compteur = None if recalculer else CompteurNonLus._get_collection().find_one({'utilisateur': ObjectId(user_id)})
+        if compteur is None or not compteur.get('initialise', True):
+            compteur = CompteurService.initialiser(user_id)
+
+        notifications = {type_notif: compteur.get('notifications', {}).get(type_notif, 0)
+                         for type_notif in Notification.type.choices}
+        return {
+            'notifications': notifications,
+            'notifications_total': sum(notifications.values()),
+            'messages': compteur.get('messages', 0),
+        }
+
+class RetentionNotificationService:
+    """Archivage des notifications lues et expiration de l'archive (index TTL)"""
+
+    INDEX_EXPIRATION = 'expiration_dateEnvoi'
+
+    @staticmethod
+    def statistiques(collection) -> Dict[str, int]:
+        """Taille d'une collection (collStats) : documents, données, stockage et index, en octets"""
+        stats = collection.database.command('collStats', collection.name)
+        return {cle: int(stats.get(cle, 0)) for cle in ('count', 'size', 'storageSize', 'totalIndexSize')}
+
+    @staticmethod
+    def indexer_expiration(jours: int = None) -> Optional[int]:
+        """
+        Crée (ou ajuste par collMod) l'index TTL de l'archive sur dateEnvoi. Retourne le délai
+        d'expiration en secondes, ou None si l'archive est conservée sans limite (jours = 0).
+        """
+        if jours is None:
+            jours = getattr(settings, 'NOTIFICATIONS_ARCHIVE_JOURS', 365)
+        collection = NotificationArchivee._get_collection()
+        if jours <= 0:
+            if RetentionNotificationService.INDEX_EXPIRATION in collection.index_information():
+                collection.drop_index(RetentionNotificationService.INDEX_EXPIRATION)
+            return None
+
+        secondes = jours * 86400
+        try:
+            collection.create_index('dateEnvoi', name=RetentionNotificationService.INDEX_EXPIRATION,
+                                    expireAfterSeconds=secondes)
+        except OperationFailure:
+            # L'index existe avec un autre délai : collMod le modifie sans le reconstruire
+            collection.database.command({'collMod': collection.name, 'index': {
+                'name': RetentionNotificationService.INDEX_EXPIRATION, 'expireAfterSeconds': secondes,
+            }})
+        return secondes
+
+    @staticmethod
+    def archiver(jours: int = None, taille_lot: int = 1000) -> Dict[str, int]:
+        """
+        Déplace par lots les notifications lues envoyées avant la limite (index lu/dateEnvoi) :
+        chaque lot est recopié dans l'archive (ReplaceOne upsert, donc rejouable après une
+        interruption) puis supprimé de la collection active. Les non-lues ne sont jamais
+        déplacées : les compteurs de non-lus restent justes.
+        """
+        if jours is None:
+            jours = getattr(settings, 'NOTIFICATIONS_RETENTION_JOURS', 60)
+        maintenant = datetime.utcnow()
+        filtre = {'lu': True, 'dateEnvoi': {'$lt': maintenant - timedelta(days=jours)}}
+        active = Notification._get_collection()
+        archive = NotificationArchivee._get_collection()
+
+        archivees, lots = 0, 0
+        while True:
+            documents = list(active.find(filtre).sort('dateEnvoi', 1).limit(taille_lot))
+            if not documents:
+                break
+            for document in documents:
+                document['dateArchivage'] = maintenant
+            archive.bulk_write([
+                ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in documents
+            ], ordered=False)
+            # lu: True dans le filtre : une notification repassée non lue entre-temps reste active
+            resultat = active.delete_many({'_id': {'$in': [document['_id'] for document in documents]}, 'lu': True})
+            archivees += resultat.deleted_count
+            lots += 1
+        return {'archivees': archivees, 'lots': lots}
+
+    @staticmethod
+    def compacter(jours: int = None, taille_lot: int = 1000, compaction: bool = False) -> Dict[str, Any]:
+        """
+        Archive, met à jour l'index TTL de l'archive et, si demandé, lance `compact` sur la
+        collection active. Le rapport compare la taille de la collection active avant et après.
+        """
+        active = Notification._get_collection()
+        avant = RetentionNotificationService.statistiques(active)
+        rapport = RetentionNotificationService.archiver(jours, taille_lot)
+        rapport['expiration_archive'] = RetentionNotificationService.indexer_expiration()
+
+        rapport['compaction'] = None
+        if compaction:
+            try:
+                active.database.command('compact', active.name)
+                rapport['compaction'] = 'effectuee'
+            except OperationFailure as e:
+                rapport['compaction'] = f"impossible : {e}"
+
+        apres = RetentionNotificationService.statistiques(active)
+        rapport.update({
+            'avant': avant,
+            'apres': apres,
+            'recupere': {cle: avant[cle] - apres[cle] for cle in avant},
+            'archive': RetentionNotificationService.statistiques(NotificationArchivee._get_collection()),
+        })
+        return rapport
+
+class RechercheService:
+    """Recherche plein texte (index texte MongoDB, langue française) dans les messages et les devoirs"""
+
+    TAILLE_PAGE = 20
+    PROFONDEUR_MAX = 500  # page * limite : au-delà, la requête doit être précisée
+    LARGEUR_EXTRAIT = 160
+
+    @staticmethod
+    def portee_devoirs(user) -> Optional[Dict[str, Any]]:
+        """
+        Filtre des devoirs visibles : tous pour l'administration, ceux du professeur ou de ses
+        matières, ceux des classes/subdivisions des enfants d'un parent. None : aucun filtre.
+        """
+        user_id = ObjectId(str(user.id))
+        if user.role in ['admin', 'developpeur']:
+            return None
+        if user.role == 'professeur':
+            matieres = [matiere['_id'] for matiere in Matiere._get_collection().find({'professeur': user_id}, {'_id': 1})]
+            return {'$or': [{'professeur': user_id}, {'matiere': {'$in': matieres}}]}
+
+        inscriptions = {}
+        for eleve in Eleve._get_collection().find({'parents': user_id}, {'classe': 1, 'subdivision': 1}):
+            if eleve.get('classe'):
+                # Un devoir sans subdivision concerne toute la classe
+                inscriptions.setdefault(eleve['classe'], {None}).add(eleve.get('subdivision'))
+        if not inscriptions:
+            return {'_id': {'$in': []}}
+        return {'$or': [
+            {'classe': classe, 'subdivision': {'$in': list(subdivisions)}}
+            for classe, subdivisions in inscriptions.items()
+        ]}
+
+    @staticmethod
+    def normaliser(texte: str) -> str:
+        """Minuscules sans accents, caractère par caractère (mêmes positions que le texte d'origine)"""
+        return ''.join(unicodedata.normalize('NFKD', caractere)[:1].lower() or caractere for caractere in texte)
+
+    @staticmethod
+    def extrait(texte: str, termes: List[str], largeur: int = None) -> str:
+        """
+        Passage du texte autour de la première occurrence d'un terme recherché. Les termes sont
+        cherchés par leur racine (l'index texte retrouve aussi les formes fléchies).
+        """
+        largeur = largeur or RechercheService.LARGEUR_EXTRAIT
+        texte = ' '.join((texte or '').split())
+        if len(texte) <= largeur:
+            return texte
+
+        normalise = RechercheService.normaliser(texte)
+        positions = [
+            position
+            for terme in termes
+            for position in [normalise.find(RechercheService.normaliser(terme)[:max(4, len(terme) - 2)])]
+            if position >= 0
+        ]
+        debut = max(0, min(positions) - largeur // 3) if positions else 0
+        fin = min(len(texte), debut + largeur)
+        debut = max(0, fin - largeur)
+        return ('…' if debut else '') + texte[debut:fin].strip() + ('…' if fin < len(texte) else '')
+
+    @staticmethod
+    def rechercher(user, texte: str, types: List[str] = None, page: int = 1, limite: int = None) -> Dict[str, Any]:
+        """
+        Résultats classés par pertinence (textScore) parmi ce que l'utilisateur peut voir : ses
+        messages envoyés ou reçus, les devoirs de sa portée. Chaque collection retourne au plus
+        page * limite + 1 résultats, fusionnés par score.
+        """
+        limite = max(1, min(limite or RechercheService.TAILLE_PAGE, 100))
+        page = max(1, page)
+        if page * limite > RechercheService.PROFONDEUR_MAX:
+            raise ValueError("Page trop lointaine : préciser la recherche")
+        types = types or ['message', 'devoir']
+        termes = [terme for terme in re.findall(r'\w+', texte) if len(terme) > 1]
+        user_id = ObjectId(str(user.id))
+        profondeur = page * limite + 1
+        score = {'score': {'$meta': 'textScore'}}
+
+        resultats = []
+        if 'message' in types:
+            for message in Message._get_collection().find(
+                {'$text': {'$search': texte}, '$or': [{'sender': user_id}, {'receiver': user_id}]},
+                dict(score, sender=1, receiver=1, contenu=1, createdAt=1)
+            ).sort([('score', {'$meta': 'textScore'})]).limit(profondeur):
+                resultats.append({
+                    'type': 'message',
+                    'id': str(message['_id']),
+                    'score': message['score'],
+                    'extrait': RechercheService.extrait(message.get('contenu'), termes),
+                    'sender': str(message['sender']) if message.get('sender') else None,
+                    'receiver': str(message['receiver']) if message.get('receiver') else None,
+                    'createdAt': message.get('createdAt'),
+                })
+
+        if 'devoir' in types:
+            query = {'$text': {'$search': texte}}
+            portee = RechercheService.portee_devoirs(user)
+            if portee:
+                query.update(portee)
+            for devoir in Devoir._get_collection().find(
+                query, dict(score, titre=1, description=1, classe=1, subdivision=1, matiere=1, dateLimite=1, createdAt=1)
+            ).sort([('score', {'$meta': 'textScore'})]).limit(profondeur):
+                resultats.append({
+                    'type': 'devoir',
+                    'id': str(devoir['_id']),
+                    'score': devoir['score'],
+                    'titre': devoir.get('titre'),
+                    'extrait': RechercheService.extrait(devoir.get('description') or devoir.get('titre'), termes),
+                    'classe': str(devoir['classe']) if devoir.get('classe') else None,
+                    'subdivision': devoir.get('subdivision'),
+                    'matiere': str(devoir['matiere']) if devoir.get('matiere') else None,
+                    'dateLimite': devoir.get('dateLimite'),
+                    'createdAt': devoir.get('createdAt'),
+                })
+
+        resultats.sort(key=lambda resultat: resultat['score'], reverse=True)
+        debut = (page - 1) * limite
+        return {
+            'resultats': resultats[debut:debut + limite],
+            'page': page,
+            'limite': limite,
+            'suivante': len(resultats) > debut + limite,
+        }
 
 class AuthTokenService:
     """Service pour la gestion des tokens d'authentification"""
     
     @staticmethod
-    def create_token(user):
-        """Crée un token pour un utilisateur"""
+    def create_token(user, appareil=None):
+        """
+        Crée un token (une nouvelle session) pour un utilisateur : une seule insertion, les autres
+        sessions de l'utilisateur restent ouvertes. Il expire après AUTH_TOKEN_DUREE_JOURS jours.
+        """
         from .models import AuthToken
         
-        # Supprimer les anciens tokens de cet utilisateur (optionnel)
-        AuthToken.objects.filter(user=user).delete()
-        
-        # Créer un nouveau token
-        token = AuthToken(user=user)
-        token.save()
+        duree = getattr(settings, 'AUTH_TOKEN_DUREE_JOURS', 30)
+        token = AuthToken(
+            user=user,
+            appareil=(appareil or '')[:200] or None,
+            expiresAt=datetime.utcnow() + timedelta(days=duree),
+        )
+        token.save(force_insert=True)
         
         return token
     
     @staticmethod
-    def get_user_by_token(token_key):
-        """Récupère un utilisateur par sa clé de token"""
+    def sessions(user, token_key=None, session_id=None) -> List[Dict[str, Any]]:
+        """
+        Sessions ouvertes d'un utilisateur, la plus récente d'abord (sans les clés) ; `actuelle` marque
+        celle de token_key (token opaque) ou de session_id (sid d'un jeton signé)
+        """
+        from .models import AuthToken
+        
+        documents = AuthToken._get_collection().find(
+            {'user': ObjectId(str(user.id)), '$or': [{'expiresAt': None}, {'expiresAt': {'$gt': datetime.utcnow()}}]},
+            {'key': 1, 'created': 1, 'expiresAt': 1, 'appareil': 1},
+        ).sort('created', -1)
+        return [
+            {
+                'id': str(document['_id']),
+                'created': document.get('created'),
+                'expiresAt': document.get('expiresAt'),
+                'appareil': document.get('appareil'),
+                'actuelle': document['key'] == token_key or str(document['_id']) == session_id,
+            }
+            for document in documents
+        ]
+    
+    @staticmethod
+    def revoke_session(user, session_id) -> bool:
+        """Ferme une session de l'utilisateur ; False si elle n'existe pas ou ne lui appartient pas"""
+        from .models import AuthToken
+        
+        document = AuthToken._get_collection().find_one_and_delete(
+            {'_id': ObjectId(str(session_id)), 'user': ObjectId(str(user.id))}, {'key': 1}
+        )
+        if document is None:
+            return False
+        cache_tokens.invalider(document['key'])
+        return True
+    
+    @staticmethod
+    def revoke_other_sessions(user, token_key=None, session_id=None) -> int:
+        """
+        Ferme toutes les sessions de l'utilisateur sauf la courante, désignée par token_key (token
+        opaque) ou session_id (sid d'un jeton signé) ; sans l'un ni l'autre, les ferme toutes.
+        Retourne leur nombre.
+        """
+        from .models import AuthToken
+        
+        filtre = {'user': ObjectId(str(user.id))}
+        if session_id is not None:
+            filtre['_id'] = {'$ne': ObjectId(str(session_id))}
+        elif token_key is not None:
+            filtre['key'] = {'$ne': token_key}
+        resultat = AuthToken._get_collection().delete_many(filtre)
+        if resultat.deleted_count:
+            cache_tokens.invalider_utilisateur(user.id)
+        return resultat.deleted_count
+    
+    @staticmethod
+    def create_access_token(user, session_id=None):
+        """Jeton d'accès signé de courte durée (format "signe") lié à la session session_id, vérifié sans lecture de la base"""
+        jeton, expiration = signer_jeton(user, session_id)
+        return {'token': jeton, 'expiresAt': datetime.utcfromtimestamp(expiration)}
+
+    @staticmethod
+    def refresh_access_token(refresh_key):
+        """Nouveau jeton d'accès pour un token de rafraîchissement (AuthToken) valide ; None sinon"""
+        token = AuthTokenService.get_token(refresh_key)
+        if token is None:
+            return None
+        return AuthTokenService.create_access_token(token.user, token.id)
+
+    @staticmethod
+    def revoke_access_token(charge):
+        """Révoque un jeton d'accès signé jusqu'à son expiration (déconnexion)"""
+        revocations.revoquer(charge['jti'], charge['exp'])
+
+    @staticmethod
+    def get_token(token_key):
+        """Token (AuthToken) non expiré de clé token_key ; None sinon"""
         from .models import AuthToken
         
         try:
             token = AuthToken.objects.get(key=token_key)
-            return token.user
         except AuthToken.DoesNotExist:
             return None
+        # L'index TTL supprime les tokens expirés avec un délai (tâche de fond de MongoDB)
+        if token.expiresAt and token.expiresAt <= datetime.utcnow():
+            return None
+        return token
+
+    @staticmethod
+    def get_user_by_token(token_key):
+        """Récupère un utilisateur par sa clé de token"""
+        token = AuthTokenService.get_token(token_key)
+        return token.user if token else None
     
     @staticmethod
     def delete_token(token_key):
         """Supprime un token"""
         from .models import AuthToken
         
-        try:
-            token = AuthToken.objects.get(key=token_key)
-            token.delete()
-            return True
-        except AuthToken.DoesNotExist:
-            return False
+        supprime = AuthToken.objects(key=token_key).delete() > 0
+        cache_tokens.invalider(token_key)
+        return supprime
     
     @staticmethod
     def validate_token(token_key):
@@ -305,14 +2214,18 @@ class AuthTokenService:
     
     @staticmethod
     def cleanup_expired_tokens(days_old=30):
-        """Nettoie les tokens expirés (optionnel)"""
+        """
+        Supprime les tokens sans expiration (créés avant expiresAt) plus anciens que days_old jours ;
+        les autres sont supprimés par l'index TTL et n'ont pas besoin de ce nettoyage
+        """
         from .models import AuthToken
-        from datetime import timedelta
         
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-        expired_tokens = AuthToken.objects.filter(created__lt=cutoff_date)
-        count = len(expired_tokens)
-        expired_tokens.delete()
+        count = AuthToken._get_collection().delete_many(
+            {'expiresAt': None, 'created': {'$lt': cutoff_date}}
+        ).deleted_count
+        if count:
+            cache_tokens.vider()
         
         return {'tokens_supprimes': count}
         return total / len(interrogations)
@@ -385,171 +2298,65 @@ class AuthTokenService:
             'details': details_trimestres
         }
 
-class PromotionService:
-    """Service pour la promotion automatique des élèves"""
-    
-    @staticmethod
-    def evaluer_promotion_eleve(eleve_id: str, annee_scolaire_id: str) -> Dict[str, Any]:
-        """
-        Évalue si un élève peut être promu automatiquement
-        """
-        eleve = Eleve.objects.get(id=eleve_id)
-        classe = eleve.classe
-        
-        # Récupérer toutes les notes annuelles de l'élève
-        notes_annuelles = NoteAnnuelle.objects.filter(
-            eleve=eleve_id,
-            anneeScolaire=annee_scolaire_id
-        )
-        
-        # Calculer la moyenne générale pondérée
-        total_points = 0
-        total_coefficients = 0
-        
-        for note in notes_annuelles:
-            matiere = note.matiere
-            coefficient = matiere.coefficient or 1
-            
-            total_points += note.noteFinale * coefficient
-            total_coefficients += coefficient
-        
-        moyenne_generale = total_points / total_coefficients if total_coefficients > 0 else 0
-        
-        # Vérifier si l'élève atteint le seuil de promotion
-        seuil = classe.seuilPromotion or 10  # Seuil par défaut : 10/20
-        promotion_automatique = moyenne_generale >= seuil
-        
-        return {
-            'moyenne_generale': moyenne_generale,
-            'seuil_promotion': seuil,
-            'promotion_automatique': promotion_automatique,
-            'nouvelle_classe': None,  # À déterminer selon la logique métier
-            'nouvelle_subdivision': None
-        }
+class SubdivisionService:
+    """Service pour la gestion des subdivisions"""
     
     @staticmethod
-    def promouvoir_eleves_classe(classe_id: str, annee_scolaire_id: str, methode_subdivision: str = 'auto') -> Dict[str, Any]:
+    def repartir(eleves_ids: List[str], subdivisions: List[str], effectifs: Dict[str, int] = None,
+                 moyennes: Dict[str, float] = None) -> Dict[str, str]:
         """
-        Promouvoir tous les élèves éligibles d'une classe
+        Répartition équilibrée en une passe : chaque élève va dans la subdivision la moins remplie
+        (à égalité, celle servie le moins récemment). Avec des moyennes, les élèves sont pris par
+        moyenne décroissante, ce qui répartit les niveaux ; sinon dans un ordre aléatoire.
         """
-        eleves = Eleve.objects.filter(classe=classe_id)
-        resultats = {
-            'promus': [],
-            'non_promus': [],
-            'total': len(eleves)
-        }
-        
-        for eleve in eleves:
-            evaluation = PromotionService.evaluer_promotion_eleve(str(eleve.id), annee_scolaire_id)
-            
-            if evaluation['promotion_automatique']:
-                # Logique pour déterminer la nouvelle classe
-                # (dépend de la structure des classes dans le système)
-                resultats['promus'].append({
-                    'eleve_id': str(eleve.id),
-                    'nom_complet': f"{eleve.prenom} {eleve.nom}",
-                    'moyenne': evaluation['moyenne_generale']
-                })
-            else:
-                resultats['non_promus'].append({
-                    'eleve_id': str(eleve.id),
-                    'nom_complet': f"{eleve.prenom} {eleve.nom}",
-                    'moyenne': evaluation['moyenne_generale']
-                })
-        
-        return resultats
+        if not subdivisions:
+            raise ValueError("Aucune subdivision définie pour cette classe")
 
-class NotificationService:
-    """Service pour la gestion des notifications"""
-    
-    @staticmethod
-    def creer_notification(destinataire_id: str, type_notif: str, reference_id: str):
-        """
-        Crée une nouvelle notification
-        """
-        notification = Notification(
-            destinataire=destinataire_id,
-            type=type_notif,
-            referenceId=reference_id,
-            lu=False,
-            dateEnvoi=datetime.utcnow()
-        )
-        notification.save()
-        return notification
-    
-    @staticmethod
-    def notifier_nouveau_devoir(devoir_id: str):
-        """
-        Notifie les parents et élèves d'un nouveau devoir
-        """
-        devoir = Devoir.objects.get(id=devoir_id)
-        
-        # Trouver tous les élèves de la classe/subdivision concernée
-        eleves = Eleve.objects.filter(
-            classe=devoir.classe,
-            subdivision=devoir.subdivision
-        )
-        
-        notifications_creees = []
-        
-        for eleve in eleves:
-            # Notifier les parents
-            for parent in eleve.parents:
-                notif = NotificationService.creer_notification(
-                    str(parent.id),
-                    'devoir',
-                    devoir_id
-                )
-                notifications_creees.append(notif)
-        
-        return notifications_creees
-    
-    @staticmethod
-    def notifier_nouveau_message(message_id: str):
-        """
-        Notifie le destinataire d'un nouveau message
-        """
-        message = Message.objects.get(id=message_id)
-        
-        notification = NotificationService.creer_notification(
-            str(message.receiver.id),
-            'message',
-            message_id
-        )
-        
-        return notification
+        effectifs = effectifs or {}
+        tas = [(effectifs.get(nom, 0), rang, nom) for rang, nom in enumerate(subdivisions)]
+        heapq.heapify(tas)
+
+        ordre = [str(eleve_id) for eleve_id in eleves_ids]
+        if moyennes is not None:
+            ordre.sort(key=lambda eleve_id: moyennes.get(eleve_id, 0), reverse=True)
+        else:
+            random.shuffle(ordre)
+
+        affectations = {}
+        for rang, eleve_id in enumerate(ordre, start=len(subdivisions)):
+            effectif, _, nom = heapq.heappop(tas)
+            affectations[eleve_id] = nom
+            heapq.heappush(tas, (effectif + 1, rang, nom))
+        return {str(eleve_id): affectations[str(eleve_id)] for eleve_id in eleves_ids}
 
-class SubdivisionService:
-    """Service pour la gestion des subdivisions"""
-    
     @staticmethod
-    def affecter_subdivision_automatique(eleves_ids: List[str], classe_id: str):
+    def affecter_subdivision_automatique(eleves_ids: List[str], classe_id: str, equilibre: bool = False,
+                                         annee_scolaire_id: str = None):
         """
-        Affecte automatiquement et aléatoirement les élèves aux subdivisions
+        Affecte automatiquement les élèves aux subdivisions : aléatoirement, ou de façon équilibrée
+        (en tenant compte des élèves déjà affectés, stratifiée par la moyenne de annee_scolaire_id si fourni)
         """
         classe = Classe.objects.get(id=classe_id)
         subdivisions_noms = [sub.nom for sub in classe.subdivisions]
         
         if not subdivisions_noms:
             raise ValueError("Aucune subdivision définie pour cette classe")
-        
-        resultats = []
-        
-        for eleve_id in eleves_ids:
-            eleve = Eleve.objects.get(id=eleve_id)
-            subdivision_choisie = random.choice(subdivisions_noms)
-            
-            eleve.subdivision = subdivision_choisie
-            eleve.methodeSubdivision = 'auto'
-            eleve.save()
-            
-            resultats.append({
-                'eleve_id': eleve_id,
-                'nom_complet': f"{eleve.prenom} {eleve.nom}",
-                'subdivision': subdivision_choisie
-            })
-        
-        return resultats
+
+        ids = [ObjectId(eleve_id) for eleve_id in eleves_ids]
+        if equilibre:
+            effectifs = {
+                groupe['_id']: groupe['effectif']
+                for groupe in Eleve._get_collection().aggregate([
+                    {'$match': {'classe': classe.id, '_id': {'$nin': ids}, 'subdivision': {'$in': subdivisions_noms}}},
+                    {'$group': {'_id': '$subdivision', 'effectif': {'$sum': 1}}},
+                ])
+            }
+            moyennes = PromotionService.moyennes_ponderees(annee_scolaire_id, ids) if annee_scolaire_id else None
+            affectations = SubdivisionService.repartir(eleves_ids, subdivisions_noms, effectifs, moyennes)
+        else:
+            affectations = {str(eleve_id): random.choice(subdivisions_noms) for eleve_id in eleves_ids}
+
+        return SubdivisionService.enregistrer(affectations, 'auto')
     
     @staticmethod
     def affecter_subdivision_manuelle(affectations: List[Dict[str, str]]):
@@ -557,18 +2364,37 @@ class SubdivisionService:
         Affecte manuellement les élèves aux subdivisions
         affectations: [{'eleve_id': 'xxx', 'subdivision': 'A'}, ...]
         """
-        resultats = []
-        
-        for affectation in affectations:
-            eleve = Eleve.objects.get(id=affectation['eleve_id'])
-            eleve.subdivision = affectation['subdivision']
-            eleve.methodeSubdivision = 'manuel'
-            eleve.save()
-            
-            resultats.append({
-                'eleve_id': affectation['eleve_id'],
-                'nom_complet': f"{eleve.prenom} {eleve.nom}",
-                'subdivision': affectation['subdivision']
-            })
-        
-        return resultats
+        return SubdivisionService.enregistrer(
+            {affectation['eleve_id']: affectation['subdivision'] for affectation in affectations}, 'manuel'
+        )
+
+    @staticmethod
+    def enregistrer(affectations: Dict[str, str], methode: str) -> List[Dict[str, str]]:
+        """Écrit toutes les affectations {eleve_id: subdivision} en un seul bulk_write"""
+        if not affectations:
+            return []
+
+        collection = Eleve._get_collection()
+        noms = {
+            str(eleve['_id']): f"{eleve.get('prenom')} {eleve.get('nom')}"
+            for eleve in collection.find(
+                {'_id': {'$in': [ObjectId(eleve_id) for eleve_id in affectations]}}, {'nom': 1, 'prenom': 1}
+            )
+        }
+        manquants = [eleve_id for eleve_id in affectations if eleve_id not in noms]
+        if manquants:
+            raise Eleve.DoesNotExist(f"Élève(s) introuvable(s) : {', '.join(manquants)}")
+
+        maintenant = datetime.utcnow()
+        collection.bulk_write([
+            UpdateOne(
+                {'_id': ObjectId(eleve_id)},
+                {'$set': {'subdivision': subdivision, 'methodeSubdivision': methode, 'updatedAt': maintenant}}
+            )
+            for eleve_id, subdivision in affectations.items()
+        ], ordered=False)
+
+        return [
+            {'eleve_id': eleve_id, 'nom_complet': noms[eleve_id], 'subdivision': subdivision}
+            for eleve_id, subdivision in affectations.items()
+        ]
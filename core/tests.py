@@ -1,12 +1,27 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
 from rest_framework.test import APITestCase
-from rest_framework import status
+from rest_framework import exceptions, status
 from django.urls import reverse
+from unittest import skipIf
 from unittest.mock import patch
+from datetime import datetime
+import asyncio
 import json
+import time
+
+from bson import ObjectId
 
 from .models import User, Eleve, Classe, Matiere, NoteTrimestrielle
-from .services import NoteService, PromotionService, NotificationService
+from .services import (
+    np, NoteService, NoteVectoriseeService, NoteBulkWriter, StatistiquesService, PromotionService,
+    SimulationPromotionService, SubdivisionService, NotificationService, CompteurService,
+    RetentionNotificationService, ConversationService, RechercheService, AuthTokenService, SuiviNotesService
+)
+from .jobs import JobService, TYPES_JOBS
+from .diffusion import DiffusionService
+from .events import Abonnements
+from .authentication import CacheTokens, MongoTokenAuthentication, identifier, signer_jeton
+from .parallel import CalculParalleleService, morceaux_classes
 
 
 class AuthenticationTestCase(APITestCase):
@@ -83,6 +98,156 @@ class AuthenticationTestCase(APITestCase):
         self.assertEqual(response.status_code, 400)
 
 
+class CacheTokensTestCase(TestCase):
+    """Tests pour le cache des tokens validés"""
+
+    def test_lru_ttl_et_invalidation(self):
+        """Test : la plus ancienne entrée est évincée, une entrée expirée est relue, invalidation par utilisateur"""
+        user1, user2 = {'_id': ObjectId()}, {'_id': ObjectId()}
+        cache = CacheTokens(taille=2, ttl=60)
+        cache.enregistrer('a', {'utilisateur': user1, 'token': {}})
+        cache.enregistrer('b', {'utilisateur': user2, 'token': {}})
+        self.assertIsNotNone(cache.lire('a'))
+        cache.enregistrer('c', {'utilisateur': user1, 'token': {}})
+
+        self.assertIsNone(cache.lire('b'))
+        cache.invalider_utilisateur(user1['_id'])
+        self.assertIsNone(cache.lire('a'))
+        self.assertIsNone(cache.lire('c'))
+
+        cache.enregistrer('d', {'utilisateur': user2, 'token': {}})
+        with patch('core.authentication.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.lire('d'))
+        statistiques = cache.statistiques()
+        self.assertEqual((statistiques['succes'], statistiques['echecs']), (1, 4))
+        self.assertEqual((statistiques['evictions'], statistiques['expirations'], statistiques['invalidations']), (1, 1, 2))
+        self.assertEqual(statistiques['entrees'], 0)
+
+
+class IdentificationRequeteTestCase(TestCase):
+    """Tests pour la résolution unique du token d'une requête"""
+
+    @patch('core.authentication.cache_tokens')
+    @patch.object(MongoTokenAuthentication, 'charger')
+    def test_token_resolu_une_fois(self, mock_charger, mock_cache):
+        """Test : middleware, DRF et vues relisent l'identité gardée sur la requête"""
+        from .middleware import MongoAuthenticationMiddleware
+
+        mock_cache.lire.return_value = None
+        user_id = ObjectId()
+        mock_charger.return_value = {
+            'utilisateur': {'_id': user_id, 'role': 'admin', 'email': 'a@b.fr'},
+            'token': {'_id': ObjectId(), 'key': 'abc', 'user': user_id},
+        }
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='Token abc')
+        MongoAuthenticationMiddleware(lambda r: None).process_request(request)
+
+        self.assertEqual(request.user.id, user_id)
+        user, token = MongoTokenAuthentication().authenticate(request)
+        self.assertEqual((user.id, token.key), (user_id, 'abc'))
+        mock_charger.assert_called_once_with('abc')
+
+        mock_charger.return_value = None
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION='Bearer inconnu')
+        for _ in range(2):
+            with self.assertRaises(exceptions.AuthenticationFailed):
+                identifier(request)
+        self.assertEqual(mock_charger.call_count, 2)
+
+
+class SessionsTestCase(TestCase):
+    """Tests pour les sessions (tokens) multiples d'un utilisateur"""
+
+    @patch('core.models.AuthToken')
+    def test_connexion_sans_fermer_les_autres_sessions(self, mock_token):
+        """Test : un login insère un token qui expire, sans supprimer ceux de l'utilisateur"""
+        user = User(id=ObjectId(), role='parent')
+        AuthTokenService.create_token(user, 'navigateur')
+
+        _, kwargs = mock_token.call_args
+        self.assertEqual((kwargs['user'], kwargs['appareil']), (user, 'navigateur'))
+        self.assertGreater(kwargs['expiresAt'], datetime.utcnow())
+        mock_token.return_value.save.assert_called_once_with(force_insert=True)
+        mock_token.objects.filter.assert_not_called()
+
+    @patch('core.models.AuthToken')
+    def test_fermeture_et_nettoyage(self, mock_token):
+        """Test : fermer les autres sessions garde la courante, le nettoyage supprime sans charger les tokens"""
+        collection = mock_token._get_collection.return_value
+        collection.delete_many.return_value.deleted_count = 2
+        user = User(id=ObjectId(), role='parent')
+
+        self.assertEqual(AuthTokenService.revoke_other_sessions(user, 'courant'), 2)
+        collection.delete_many.assert_called_with({'user': user.id, 'key': {'$ne': 'courant'}})
+        session_id = ObjectId()
+        AuthTokenService.revoke_other_sessions(user, session_id=str(session_id))
+        collection.delete_many.assert_called_with({'user': user.id, '_id': {'$ne': session_id}})
+
+        self.assertEqual(AuthTokenService.cleanup_expired_tokens(), {'tokens_supprimes': 2})
+        filtre = collection.delete_many.call_args[0][0]
+        self.assertIsNone(filtre['expiresAt'])
+        mock_token.objects.filter.assert_not_called()
+
+    @patch('core.services.AuthTokenService.revoke_other_sessions', return_value=1)
+    def test_fermeture_avec_jeton_signe(self, mock_revoquer):
+        """Test : avec un jeton signé, la session de son sid est gardée ; sans sid, 400 et rien n'est fermé"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import sessions
+
+        user, session_id = User(id=ObjectId(), role='parent'), str(ObjectId())
+        for charge, attendu in (({'id': str(user.id), 'sid': session_id}, 200), ({'id': str(user.id)}, 400)):
+            request = APIRequestFactory().delete('/api/auth/sessions/')
+            force_authenticate(request, user=user, token=charge)
+            self.assertEqual(sessions(request).status_code, attendu)
+        mock_revoquer.assert_called_once_with(user, None, session_id)
+
+    @patch('core.services.AuthTokenService.revoke_other_sessions')
+    @patch('core.views.ChangePasswordSerializer')
+    @patch('core.views.utilisateur_complet', side_effect=lambda user: user)
+    def test_changement_mot_de_passe_ferme_les_autres_sessions(self, mock_complet, mock_serializer, mock_revoquer):
+        """Test : un changement de mot de passe ferme les autres sessions, pas la courante"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .models import AuthToken
+        from .views import change_password
+
+        user = User(id=ObjectId(), role='parent')
+        request = APIRequestFactory().post('/api/auth/change-password/', {}, format='json')
+        force_authenticate(request, user=user, token=AuthToken(key='courant'))
+
+        self.assertEqual(change_password(request).status_code, 200)
+        mock_revoquer.assert_called_once_with(user, 'courant', None)
+
+
+class JetonSigneTestCase(TestCase):
+    """Tests pour les jetons d'accès signés"""
+
+    @patch('core.authentication.JetonRevoque')
+    def test_signature_expiration_revocation(self, mock_revoque):
+        """Test : jeton valide sans lecture du token, refusé s'il est altéré, expiré ou révoqué"""
+        mock_revoque._get_collection.return_value.find.return_value = []
+        user = User(id=ObjectId(), role='professeur')
+        jeton, _ = signer_jeton(user)
+        authentification = MongoTokenAuthentication()
+
+        utilisateur, charge = authentification.authenticate_credentials(jeton)
+        self.assertEqual((utilisateur.id, utilisateur.role), (user.id, 'professeur'))
+        self.assertNotIn('sid', charge)
+        session_id = ObjectId()
+        self.assertEqual(authentification.authenticate_credentials(signer_jeton(user, session_id)[0])[1]['sid'],
+                         str(session_id))
+
+        with self.assertRaisesMessage(exceptions.AuthenticationFailed, "Token non valide."):
+            authentification.authenticate_credentials(jeton[:-1] + ('A' if jeton[-1] != 'A' else 'B'))
+        with patch('core.authentication.time.time', return_value=charge['exp'] + 1):
+            with self.assertRaisesMessage(exceptions.AuthenticationFailed, "Token expiré."):
+                authentification.authenticate_credentials(jeton)
+
+        AuthTokenService.revoke_access_token(charge)
+        mock_revoque._get_collection.return_value.update_one.assert_called_once()
+        with self.assertRaisesMessage(exceptions.AuthenticationFailed, "Token révoqué."):
+            authentification.authenticate_credentials(jeton)
+
+
 class NoteServiceTestCase(TestCase):
     """Tests pour le service de calcul des notes"""
     
@@ -121,6 +286,279 @@ class NoteServiceTestCase(TestCase):
         
         self.assertEqual(moyenne, 0.0)
 
+    @patch('core.models.Examen.objects')
+    @patch('core.models.Interrogation.objects')
+    @patch('core.models.Trimestre.objects')
+    def test_calculer_notes_trimestrielles_lot(self, mock_trimestres, mock_interrogations, mock_examens):
+        """Test du calcul par agrégation : mêmes règles que le calcul élève par élève"""
+        periode1 = type('MockPeriode', (), {'id': ObjectId()})()
+        periode2 = type('MockPeriode', (), {'id': ObjectId()})()
+        mock_trimestres.get.return_value = type('MockTrimestre', (), {
+            'id': ObjectId(), 'periodes': [periode1, periode2]
+        })()
+
+        eleve, matiere = ObjectId(), ObjectId()
+        mock_interrogations.aggregate.return_value = [
+            {'_id': {'eleve': eleve, 'matiere': matiere, 'periode': periode1.id}, 'notes': [15.0, 12.0]},
+            {'_id': {'eleve': eleve, 'matiere': matiere, 'periode': periode2.id}, 'notes': [0.0]},
+        ]
+        mock_examens.aggregate.return_value = [
+            {'_id': {'eleve': eleve, 'matiere': matiere}, 'note': 9.0},
+        ]
+
+        autre_matiere = str(ObjectId())
+        resultats = NoteService.calculer_notes_trimestrielles_lot(
+            self.trimestre_id, [(str(eleve), str(matiere)), (str(eleve), autre_matiere)]
+        )
+
+        # La période 2 (moyenne nulle) est ignorée comme dans calculer_note_trimestrielle
+        self.assertEqual(resultats[(str(eleve), str(matiere))], {
+            'note_finale': 11.25, 'moyenne_travaux': 13.5, 'note_examen': 9.0
+        })
+        self.assertEqual(resultats[(str(eleve), autre_matiere)], {
+            'note_finale': 0.0, 'moyenne_travaux': 0.0, 'note_examen': 0.0
+        })
+
+    @patch('core.models.NoteTrimestrielle._get_collection')
+    @patch('core.models.AnneeScolaire.objects')
+    def test_calculer_notes_annuelles_lot(self, mock_annees, mock_notes):
+        """Test du calcul annuel en lot : première note par trimestre, trimestres sans note ignorés"""
+        trimestres = [type('MockTrimestre', (), {'id': ObjectId()})() for _ in range(3)]
+        mock_annees.get.return_value = type('MockAnnee', (), {'trimestres': trimestres})()
+
+        eleve, matiere = ObjectId(), ObjectId()
+        mock_notes.return_value.find.return_value.sort.return_value = [
+            {'eleve': eleve, 'matiere': matiere, 'trimestre': trimestres[0].id, 'noteFinale': 12.0},
+            {'eleve': eleve, 'matiere': matiere, 'trimestre': trimestres[0].id, 'noteFinale': 3.0},
+            {'eleve': eleve, 'matiere': matiere, 'trimestre': trimestres[2].id, 'noteFinale': 15.0},
+        ]
+
+        resultats = NoteService.calculer_notes_annuelles_lot('annee_id', [(str(eleve), str(matiere))])
+
+        self.assertEqual(resultats[(str(eleve), str(matiere))], {
+            'note_finale': 13.5,
+            'details': [
+                {'trimestre': str(trimestres[0].id), 'note_trimestre': 12.0},
+                {'trimestre': str(trimestres[2].id), 'note_trimestre': 15.0},
+            ],
+            'nb_trimestres': 2,
+        })
+
+    @patch('core.models.Matiere._get_collection')
+    @patch('core.models.Eleve._get_collection')
+    def test_planifier_inscriptions(self, mock_eleves, mock_matieres):
+        """Test du plan : uniquement les matières de la classe de chaque élève"""
+        classe_a, classe_b = ObjectId(), ObjectId()
+        eleve_a, eleve_b = ObjectId(), ObjectId()
+        maths_a, maths_b = ObjectId(), ObjectId()
+        mock_eleves.return_value.find.return_value = [
+            {'_id': eleve_a, 'classe': classe_a},
+            {'_id': eleve_b, 'classe': classe_b},
+        ]
+        mock_matieres.return_value.find.return_value = [
+            {'_id': maths_a, 'classe': classe_a},
+            {'_id': maths_b, 'classe': classe_b},
+        ]
+
+        plan = NoteService.planifier_inscriptions()
+
+        self.assertEqual(sorted(NoteService.paires_inscriptions(plan)), sorted([
+            (str(eleve_a), str(maths_a)), (str(eleve_b), str(maths_b))
+        ]))
+
+
+@skipIf(np is None, "NumPy non installé")
+class NoteVectoriseeServiceTestCase(TestCase):
+    """Tests pour le noyau vectorisé du calcul trimestriel"""
+
+    def test_calculer_identique_au_calcul_par_paire(self):
+        """Test : même résultat que combiner_note_trimestrielle"""
+        interrogations = [
+            ('e1', 'm1', 'p1', 15.0), ('e1', 'm1', 'p1', 12.0), ('e1', 'm1', 'p2', 0.0),
+            ('e2', 'm1', 'p2', 8.0), ('e3', 'm1', 'p1', 20.0),
+        ]
+        examens = [('e1', 'm1', 9.0), ('e1', 'm1', 18.0), ('e2', 'm1', None)]
+        notes = {
+            'periode_ids': ['p1', 'p2'],
+            'interrogations': NoteVectoriseeService.colonnes(
+                [dict(zip(('eleve', 'matiere', 'periode', 'note'), ligne)) for ligne in interrogations],
+                ['eleve', 'matiere', 'periode']
+            ),
+            'examens': NoteVectoriseeService.colonnes(
+                [dict(zip(('eleve', 'matiere', 'note'), ligne)) for ligne in examens], ['eleve', 'matiere']
+            ),
+        }
+        paires = [('e1', 'm1'), ('e2', 'm1'), ('e2', 'm2')]
+
+        resultats = NoteVectoriseeService.calculer(notes, paires)
+
+        self.assertEqual(resultats[('e1', 'm1')], NoteService.combiner_note_trimestrielle(
+            {'p1': [15.0, 12.0], 'p2': [0.0]}, ['p1', 'p2'], 9.0
+        ))
+        self.assertEqual(resultats[('e2', 'm1')], NoteService.combiner_note_trimestrielle(
+            {'p2': [8.0]}, ['p1', 'p2'], None
+        ))
+        self.assertEqual(resultats[('e2', 'm2')]['note_finale'], 0.0)
+        self.assertNotIn(('e3', 'm1'), resultats)
+
+
+class NoteBulkWriterTestCase(TestCase):
+    """Tests pour l'écriture des notes par lots"""
+
+    @patch('core.models.NoteTrimestrielle._get_collection')
+    def test_flush_rapport(self, mock_collection):
+        """Test du regroupement des upserts et du rapport inséré/modifié/inchangé"""
+        mock_collection.return_value.bulk_write.return_value = type('MockResultat', (), {
+            'upserted_count': 1, 'modified_count': 1, 'matched_count': 2
+        })()
+
+        writer = NoteBulkWriter(taille_lot=10)
+        resultat = {'note_finale': 12.0, 'moyenne_travaux': 14.0, 'note_examen': 10.0}
+        for _ in range(3):
+            writer.ajouter_note_trimestrielle(str(ObjectId()), str(ObjectId()), str(ObjectId()), resultat)
+
+        rapport = writer.flush()
+
+        # Une seule requête bulk_write non ordonnée pour les trois notes
+        mock_collection.return_value.bulk_write.assert_called_once()
+        operations = mock_collection.return_value.bulk_write.call_args[0][0]
+        self.assertEqual(len(operations), 3)
+        self.assertFalse(mock_collection.return_value.bulk_write.call_args[1]['ordered'])
+        self.assertEqual(rapport, {'inseres': 1, 'modifies': 1, 'inchanges': 1})
+
+
+class SuiviNotesServiceTestCase(TestCase):
+    """Tests pour le suivi des notes à recalculer et le recalcul incrémental"""
+
+    @patch('core.services.NoteModifiee._get_collection')
+    def test_marquer_upsert_par_cle(self, mock_collection):
+        """Test : une clé marquée deux fois est un upsert sur le même filtre (une seule entrée)"""
+        cle = (str(ObjectId()), str(ObjectId()), str(ObjectId()))
+
+        self.assertEqual(SuiviNotesService.marquer({cle}), 1)
+        self.assertEqual(SuiviNotesService.marquer({cle}), 1)
+
+        premier, second = [appel[0][0][0] for appel in mock_collection.return_value.bulk_write.call_args_list]
+        self.assertEqual(premier._filter, second._filter)
+        self.assertEqual(premier._filter['eleve'], ObjectId(cle[0]))
+        self.assertTrue(premier._upsert and second._upsert)
+        self.assertIn('dateModification', premier._doc['$set'])
+
+    @patch('core.services.SuiviNotesService.marquer')
+    @patch('core.services.SuiviNotesService.cles_interrogation')
+    def test_apres_ecriture_ancienne_et_nouvelle_cle(self, mock_cles, mock_marquer):
+        """Test : modifier une interrogation marque la clé d'avant et celle d'après"""
+        from .views import InterrogationAPIView
+
+        ancienne, nouvelle = ('e', 'm', 't1'), ('e', 'm', 't2')
+        mock_cles.return_value = {nouvelle}
+
+        InterrogationAPIView().apres_ecriture(object(), avant={ancienne})
+
+        mock_marquer.assert_called_once_with({ancienne, nouvelle})
+
+    @patch('core.services.SimulationPromotionService.invalider')
+    @patch('core.services.StatistiquesService.rafraichir', return_value=0)
+    @patch('core.services.NoteService.calculer_notes_annuelles_lot')
+    @patch('core.services.NoteService.calculer_notes_trimestrielles_lot')
+    @patch('core.services.NoteBulkWriter.flush', return_value={})
+    @patch('core.services.NoteAnnuelle._get_collection')
+    @patch('core.services.Trimestre._get_collection')
+    @patch('core.services.Eleve._get_collection')
+    @patch('core.services.NoteModifiee._get_collection')
+    def test_recalculer(self, mock_modifiees, mock_eleves, mock_trimestres, mock_annuelles, mock_flush,
+                        mock_trimestriel, mock_annuel, mock_rafraichir, mock_invalider):
+        """Test : annuelles recalculées seulement si elles existent, simulation invalidée, suppression gardée par dateModification"""
+        eleve1, eleve2, matiere = ObjectId(), ObjectId(), ObjectId()
+        trimestre, annee = ObjectId(), ObjectId()
+        date = datetime(2025, 1, 15, 10, 0)
+        entrees = [
+            {'_id': ObjectId(), 'eleve': eleve, 'matiere': matiere, 'trimestre': trimestre, 'dateModification': date}
+            for eleve in (eleve1, eleve2)
+        ]
+        mock_modifiees.return_value.find.return_value.sort.return_value = entrees
+        mock_eleves.return_value.distinct.return_value = [ObjectId()]
+        mock_trimestres.return_value.find.return_value = [{'_id': trimestre, 'anneeScolaire': annee}]
+        # Seul eleve1 a déjà une note annuelle
+        mock_annuelles.return_value.find.return_value = [{'eleve': eleve1, 'matiere': matiere}]
+        mock_trimestriel.return_value = {}
+        mock_annuel.return_value = {(str(eleve1), str(matiere)): {'note_finale': 12.0, 'details': []}}
+
+        rapport = SuiviNotesService.recalculer()
+
+        self.assertEqual(rapport['cles_recalculees'], 2)
+        self.assertEqual(sorted(mock_trimestriel.call_args[0][1]), sorted([(str(eleve1), str(matiere)), (str(eleve2), str(matiere))]))
+        self.assertEqual(mock_annuel.call_args[0][1], [(str(eleve1), str(matiere))])
+        # La simulation de promotion de l'année recalculée est invalidée
+        mock_invalider.assert_called_once_with(str(annee))
+
+        # Une clé re-marquée pendant le recalcul a une date plus récente : le filtre ne la supprime pas
+        suppressions = mock_modifiees.return_value.bulk_write.call_args[0][0]
+        self.assertEqual([operation._filter for operation in suppressions], [
+            {'_id': entree['_id'], 'dateModification': date} for entree in entrees
+        ])
+
+
+class StatistiquesServiceTestCase(TestCase):
+    """Tests pour les statistiques de classe"""
+
+    def test_classer_ex_aequo(self):
+        """Test : les ex aequo partagent le rang, le suivant est décalé"""
+        self.assertEqual(StatistiquesService.classer({'a': 10.0, 'b': 12.0, 'c': 10.0, 'd': 5.0}), {
+            'a': (2, 66.7), 'b': (1, 100.0), 'c': (2, 66.7), 'd': (4, 0.0)
+        })
+
+    def test_construire_moyenne_ponderee(self):
+        """Test : moyenne générale pondérée par les coefficients, statistiques par matière"""
+        classe, trimestre = str(ObjectId()), str(ObjectId())
+        eleve1, eleve2 = str(ObjectId()), str(ObjectId())
+        maths, francais = str(ObjectId()), str(ObjectId())
+        notes = {
+            (eleve1, maths): 16.0, (eleve1, francais): 10.0,
+            (eleve2, maths): 8.0, (eleve2, francais): 14.0,
+        }
+
+        document = StatistiquesService.construire(
+            trimestre, classe, [eleve1, eleve2], [maths, francais], notes, {maths: 3, francais: 1}
+        )
+
+        self.assertEqual(document['effectif'], 2)
+        self.assertEqual(document['noteMax'], 14.5)
+        self.assertEqual(document['noteMin'], 9.5)
+        self.assertEqual(document['classement'][0]['eleve'], ObjectId(eleve1))
+        self.assertEqual(document['classement'][1]['matieres'][1]['rang'], 1)
+        self.assertEqual(document['matieres'][0]['moyenne'], 12.0)
+
+
+    @patch('core.models.StatistiquesClasse._get_collection')
+    @patch('core.models.Eleve._get_collection')
+    def test_parent_limite_aux_classes_de_ses_enfants(self, mock_eleves, mock_statistiques):
+        """Test : 403 hors des classes des enfants, sinon classement réduit aux enfants"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import StatistiquesClasseAPIView
+
+        classe, trimestre, enfant, autre = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+        parent = User(id=ObjectId(), role='parent', email='p@ecole.fr', enfants=[enfant])
+        mock_statistiques.return_value.find_one.return_value = {
+            'classe': classe, 'trimestre': trimestre, 'classement': [
+                {'eleve': enfant, 'rang': 2, 'matieres': []}, {'eleve': autre, 'rang': 1, 'matieres': []},
+            ],
+        }
+
+        def consulter():
+            request = APIRequestFactory().get(f'/api/classes/{classe}/statistiques/', {'trimestre': str(trimestre)})
+            force_authenticate(request, user=parent)
+            return StatistiquesClasseAPIView.as_view()(request, pk=str(classe))
+
+        mock_eleves.return_value.count_documents.return_value = 0
+        self.assertEqual(consulter().status_code, status.HTTP_403_FORBIDDEN)
+        mock_statistiques.return_value.find_one.assert_not_called()
+
+        mock_eleves.return_value.count_documents.return_value = 1
+        response = consulter()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([entree['eleve'] for entree in response.data['classement']], [str(enfant)])
+
 
 class PromotionServiceTestCase(TestCase):
     """Tests pour le service de promotion"""
@@ -150,37 +588,656 @@ class PromotionServiceTestCase(TestCase):
         peut_etre_promu = moyenne_generale >= seuil_promotion
         self.assertTrue(peut_etre_promu)
 
+    @patch('core.services.Classe._get_collection')
+    def test_charger_echelle(self, mock_collection):
+        """Test : classe suivante = première classe du niveau supérieur et du même type"""
+        cp, ce1, ce1_bis, sixieme = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+        mock_collection.return_value.find.return_value.sort.return_value = [
+            {'_id': cp, 'nom': 'CP', 'niveau': 1, 'typeClasse': 'primaire', 'seuilPromotion': 12},
+            {'_id': ce1, 'nom': 'CE1', 'niveau': 2, 'typeClasse': 'primaire', 'subdivisions': [{'nom': 'A'}, {'nom': 'B'}]},
+            {'_id': ce1_bis, 'nom': 'CE1 bis', 'niveau': 2, 'typeClasse': 'primaire'},
+            {'_id': sixieme, 'nom': '6e', 'niveau': 1, 'typeClasse': 'secondaire'},
+        ]
+
+        echelle = PromotionService.charger_echelle()
+
+        self.assertEqual(echelle[str(cp)]['seuil'], 12)
+        self.assertEqual(echelle[str(cp)]['suivante'], {'id': ce1, 'nom': 'CE1', 'subdivisions': ['A', 'B']})
+        self.assertEqual(echelle[str(ce1)]['seuil'], 10)
+        self.assertIsNone(echelle[str(ce1)]['suivante'])
+        self.assertIsNone(echelle[str(sixieme)]['suivante'])
+
+    def promouvoir_lot(self, methode_subdivision, repartition=None):
+        """
+        Promotion par lot d'une école fictive : CP (seuil 12) -> CE1 (subdivisions A et B), CE1 sans
+        suivante. Élèves 0 à 2 admis, 3 insuffisant, 4 sans classe suivante, 5 sans classe.
+        Retourne (résultats, opérations du bulk_write, mock de repartir).
+        """
+        cp = ObjectId()
+        classes = [cp, cp, cp, cp, self.ce1, None]
+        echelle = {
+            str(cp): {'seuil': 12, 'suivante': {'id': self.ce1, 'nom': 'CE1', 'subdivisions': ['A', 'B']}},
+            str(self.ce1): {'seuil': 10, 'suivante': None},
+        }
+        moyennes = dict(zip(map(str, self.eleves), [14, 13, 15, 8, 16, 11]))
+
+        with patch('core.services.Eleve._get_collection') as mock_eleves, \
+                patch('core.services.NoteAnnuelle._get_collection') as mock_notes, \
+                patch('core.services.PromotionService.charger_echelle', return_value=echelle), \
+                patch('core.services.PromotionService.moyennes_ponderees', return_value=moyennes), \
+                patch('core.services.SubdivisionService.repartir', return_value=repartition) as mock_repartir:
+            mock_eleves.return_value.find.return_value = [
+                {'_id': eleve_id, 'nom': 'Nom', 'prenom': f'Eleve{rang}', 'classe': classe}
+                for rang, (eleve_id, classe) in enumerate(zip(self.eleves, classes))
+            ]
+            resultats = PromotionService.promouvoir_lot(str(self.annee), methode_subdivision)
+
+        return resultats, mock_notes.return_value.bulk_write.call_args[0][0], mock_repartir
+
+    def assert_operation(self, operation, eleve_ids, subdivision):
+        self.assertEqual(operation._filter, {'eleve': {'$in': eleve_ids}, 'anneeScolaire': self.annee})
+        self.assertEqual(dict(operation._doc['$set'], updatedAt=None), {
+            'promotionAutomatique': True, 'nouvelleClasse': self.ce1, 'nouvelleSubdivision': subdivision,
+            'updatedAt': None,
+        })
+
+    def test_promouvoir_lot_auto(self):
+        """Test : raisons des non-promus, répartition du mode auto, un UpdateMany par (classe suivante, subdivision)"""
+        self.ce1, self.annee = ObjectId(), ObjectId()
+        self.eleves = [ObjectId() for _ in range(6)]
+        e1, e2, e3 = map(str, self.eleves[:3])
+
+        resultats, operations, mock_repartir = self.promouvoir_lot('auto', {e1: 'A', e2: 'B', e3: 'A'})
+
+        self.assertEqual(resultats['total'], 6)
+        self.assertEqual([(promu['eleve_id'], promu['nouvelle_classe'], promu['nouvelle_subdivision'])
+                          for promu in resultats['promus']], [(e1, 'CE1', 'A'), (e2, 'CE1', 'B'), (e3, 'CE1', 'A')])
+        self.assertEqual([(non_promu['eleve_id'], non_promu['raison']) for non_promu in resultats['non_promus']], [
+            (str(self.eleves[3]), 'Moyenne insuffisante: 8.00/12'),
+            (str(self.eleves[4]), 'Aucune classe suivante trouvée'),
+            (str(self.eleves[5]), 'Pas de classe assignée'),
+        ])
+        self.assertEqual((resultats['promotions_reussies'], resultats['promotions_echouees']), (3, 3))
+        mock_repartir.assert_called_once_with([e1, e2, e3], ['A', 'B'], moyennes={e1: 14, e2: 13, e3: 15})
+
+        self.assertEqual(len(operations), 2)
+        self.assert_operation(operations[0], [self.eleves[0], self.eleves[2]], 'A')
+        self.assert_operation(operations[1], [self.eleves[1]], 'B')
+
+    def test_promouvoir_lot_premiere_subdivision(self):
+        """Test : hors mode auto, pas de répartition, tous les admis en un seul UpdateMany"""
+        self.ce1, self.annee = ObjectId(), ObjectId()
+        self.eleves = [ObjectId() for _ in range(6)]
+
+        resultats, operations, mock_repartir = self.promouvoir_lot('premiere')
+
+        mock_repartir.assert_not_called()
+        self.assertEqual({promu['nouvelle_subdivision'] for promu in resultats['promus']}, {'A'})
+        self.assertEqual(len(operations), 1)
+        self.assert_operation(operations[0], self.eleves[:3], 'A')
+
+    @patch('core.models.Eleve.objects')
+    @patch('core.services.PromotionService.promouvoir_eleves', return_value={'promotions_reussies': 1})
+    @patch('core.parallel.CalculParalleleService.promouvoir', return_value={'promotions_reussies': 2})
+    def test_options_de_promotion(self, mock_parallele, mock_unitaire, mock_eleves):
+        """Test : parallele choisit le mode unitaire, classe_id y est transmis, combinaisons non prises en charge refusées"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import PromotionAutomatiqueAPIView
+
+        annee, classe, eleve = str(ObjectId()), str(ObjectId()), ObjectId()
+        mock_eleves.return_value.only.return_value = [User(id=eleve)]
+
+        def promouvoir(**donnees):
+            request = APIRequestFactory().post('/api/promotion-automatique/', dict(donnees, annee_scolaire_id=annee),
+                                               format='json')
+            force_authenticate(request, user=User(id=ObjectId(), role='admin'))
+            return PromotionAutomatiqueAPIView.as_view()(request)
+
+        reponse = promouvoir(parallele=True, processus=2)
+        self.assertEqual((reponse.status_code, reponse.data['promotions_reussies']), (200, 2))
+        mock_parallele.assert_called_once_with(annee, 'auto', processus=2, par_subdivision=False)
+
+        reponse = promouvoir(mode='unitaire', classe_id=classe)
+        self.assertEqual((reponse.status_code, reponse.data['promotions_reussies']), (200, 1))
+        mock_eleves.assert_called_once_with(classe=classe)
+        mock_unitaire.assert_called_once_with([str(eleve)], annee, 'auto')
+
+        for donnees in ({'parallele': True, 'mode': 'lot'}, {'parallele': True, 'classe_id': classe},
+                        {'asynchrone': True, 'classe_id': classe}):
+            self.assertEqual(promouvoir(**donnees).status_code, 400)
+        self.assertEqual(mock_parallele.call_count, 1)
+
+
+class SimulationPromotionServiceTestCase(TestCase):
+    """Tests pour la simulation de promotion"""
+
+    @patch('core.services.SimulationPromotionService.instantane')
+    def test_simuler_seuils(self, mock_instantane):
+        """Test : admis comptés par bisection, élèves proches du seuil listés"""
+        eleves = [(6.0, 'e1', 'A'), (9.5, 'e2', 'B'), (10.0, 'e3', 'C'), (10.4, 'e4', 'D'), (15.0, 'e5', 'E')]
+        mock_instantane.return_value = {
+            'dateChargement': None,
+            'classes': {'c1': {'nom': 'CP', 'seuil': 10, 'moyennes': [e[0] for e in eleves], 'eleves': eleves}},
+        }
+
+        actuel = SimulationPromotionService.simuler('annee')
+        simule = SimulationPromotionService.simuler('annee', {'c1': 9.5}, marge=1.0)
+
+        self.assertEqual(actuel['admis'], 3)
+        self.assertEqual(simule['classes'][0]['admis'], 4)
+        self.assertEqual(simule['classes'][0]['seuil_actuel'], 10)
+        self.assertEqual([e['eleve_id'] for e in simule['classes'][0]['limites']], ['e2', 'e3', 'e4'])
+
+    @override_settings(SIMULATION_PROMOTION_ANNEES=2)
+    @patch('core.services.SimulationPromotionService.charger', side_effect=lambda annee: {'annee': annee})
+    def test_cache_borne(self, mock_charger):
+        """Test : au-delà de SIMULATION_PROMOTION_ANNEES, l'année la moins récemment simulée est oubliée"""
+        SimulationPromotionService.invalider()
+        for annee in ('a1', 'a2', 'a1', 'a3'):
+            SimulationPromotionService.instantane(annee)
+
+        self.assertEqual(list(SimulationPromotionService._instantanes), ['a1', 'a3'])
+        self.assertEqual(mock_charger.call_count, 3)
+        SimulationPromotionService.invalider()
+
+
+class SubdivisionServiceTestCase(TestCase):
+    """Tests pour l'affectation des subdivisions"""
+
+    def test_repartir_equilibre_stratifie(self):
+        """Test : effectifs équilibrés en tenant compte de l'existant, niveaux répartis"""
+        moyennes = {'e1': 18.0, 'e2': 16.0, 'e3': 14.0, 'e4': 12.0, 'e5': 10.0}
+
+        affectations = SubdivisionService.repartir(list(moyennes), ['A', 'B', 'C'], {'A': 2}, moyennes)
+
+        self.assertEqual(affectations, {'e1': 'B', 'e2': 'C', 'e3': 'B', 'e4': 'C', 'e5': 'A'})
+
+    def test_repartir_sans_subdivision(self):
+        """Test : une classe sans subdivision est refusée"""
+        with self.assertRaises(ValueError):
+            SubdivisionService.repartir(['e1'], [])
+
 
 class NotificationServiceTestCase(TestCase):
     """Tests pour le service de notifications"""
     
+    @patch('core.services.CompteurService.incrementer')
+    @patch('core.models.Notification._get_collection')
+    @patch('core.models.Eleve._get_collection')
     @patch('core.models.Devoir.objects')
-    @patch('core.models.Eleve.objects')
-    @patch('core.models.Notification')
-    def test_creer_notification_devoir(self, mock_notification, mock_eleve, mock_devoir):
+    def test_creer_notification_devoir(self, mock_devoir, mock_eleves, mock_notifications, mock_compteurs):
         """Test de création de notifications pour un devoir"""
         # Mock du devoir
+        classe_id = ObjectId()
         mock_devoir_instance = type('MockDevoir', (), {
-            'classe': 'test_classe',
+            '_data': {'classe': classe_id},
             'subdivision': 'A'
         })()
         mock_devoir.get.return_value = mock_devoir_instance
         
-        # Mock des élèves avec leurs parents
-        mock_parent = type('MockParent', (), {})()
-        mock_eleve_instance = type('MockEleve', (), {
-            'parents': [mock_parent]
-        })()
-        mock_eleve.filter.return_value = [mock_eleve_instance]
-        
-        # Mock de la sauvegarde de notification
-        mock_notification_instance = mock_notification.return_value
-        mock_notification_instance.save.return_value = None
+        # Mock des élèves avec leurs parents : un parent a deux enfants dans la classe
+        parent1, parent2 = ObjectId(), ObjectId()
+        mock_eleves.return_value.find.return_value = [
+            {'parents': [parent1]},
+            {'parents': [parent1, parent2]},
+            {},
+        ]
         
-        result = NotificationService.creer_notification_devoir("test_devoir_id")
+        devoir_id = str(ObjectId())
+        result = NotificationService.creer_notification_devoir(devoir_id)
         
-        # Vérifier qu'une notification a été créée
-        self.assertEqual(result['notifications_creees'], 1)
+        # Une notification par parent, insérées en une seule fois
+        self.assertEqual(result['notifications_creees'], 2)
+        mock_eleves.return_value.find.assert_called_once_with(
+            {'classe': classe_id, 'subdivision': 'A'}, {'parents': 1}
+        )
+        documents = mock_notifications.return_value.insert_many.call_args[0][0]
+        self.assertEqual([document['destinataire'] for document in documents], [parent1, parent2])
+        self.assertEqual(documents[0]['referenceId'], ObjectId(devoir_id))
+        mock_compteurs.assert_called_once_with({
+            (str(parent1), 'notifications.devoir'): 1, (str(parent2), 'notifications.devoir'): 1
+        })
+
+
+    @patch('core.services.CompteurService.incrementer')
+    @patch('core.models.Notification._get_collection')
+    def test_marquer_notifications_lues_filtres(self, mock_collection, mock_compteurs):
+        """Test : une seule requête update_many avec les filtres demandés, compteur décrémenté d'autant"""
+        mock_collection.return_value.update_many.return_value.modified_count = 7
+        user_id, reference_id = ObjectId(), ObjectId()
+        avant = datetime(2025, 1, 15)
+
+        result = NotificationService.marquer_notifications_lues(str(user_id), 'devoir', [str(reference_id)], avant)
+
+        self.assertEqual(result, {'notifications_marquees': 7})
+        filtre = mock_collection.return_value.update_many.call_args[0][0]
+        self.assertEqual(filtre, {
+            'destinataire': user_id, 'lu': False, 'type': 'devoir', 'dateEnvoi': {'$lt': avant},
+            '$or': [{'referenceId': {'$in': [reference_id]}}, {'references': {'$in': [reference_id]}}],
+        })
+        mock_compteurs.assert_called_once_with({(str(user_id), 'notifications.devoir'): -7})
+
+    @patch('core.services.CompteurService.lire')
+    @patch('core.services.CompteurService.incrementer')
+    @patch('core.models.Notification._get_collection')
+    def test_marquer_notifications_lues_sans_type(self, mock_collection, mock_compteurs, mock_lire):
+        """Test : sans type, un décompte par type puis un seul update_many ; recalcul si l'écart diffère"""
+        user_id = str(ObjectId())
+        mock_collection.return_value.aggregate.return_value = [
+            {'_id': 'devoir', 'total': 2}, {'_id': 'message', 'total': 1},
+        ]
+        mock_collection.return_value.update_many.return_value.modified_count = 3
+
+        result = NotificationService.marquer_notifications_lues(user_id)
+
+        self.assertEqual(result, {'notifications_marquees': 3})
+        mock_collection.return_value.update_many.assert_called_once()
+        mock_compteurs.assert_called_once_with({
+            (user_id, 'notifications.devoir'): -2, (user_id, 'notifications.message'): -1,
+        })
+        mock_lire.assert_not_called()
+
+        mock_compteurs.reset_mock()
+        mock_collection.return_value.update_many.return_value.modified_count = 4
+        NotificationService.marquer_notifications_lues(user_id)
+        mock_compteurs.assert_not_called()
+        mock_lire.assert_called_once_with(user_id, recalculer=True)
+
+    @override_settings(NOTIFICATIONS_REGROUPEMENT_FENETRE=3600)
+    @patch('core.services.CompteurService.incrementer')
+    @patch('core.models.Notification._get_collection')
+    def test_regroupement_addtoset(self, mock_collection, mock_compteurs):
+        """Test : fenêtre définie, $addToSet dans le regroupement ouvert ; seul un nouveau regroupement compte comme non lu"""
+        parent1, parent2, devoir_id = ObjectId(), ObjectId(), ObjectId()
+        documents = [
+            {'destinataire': parent, 'type': 'devoir', 'referenceId': devoir_id, 'lu': False,
+             'dateEnvoi': datetime(2025, 1, 15)}
+            for parent in (parent1, parent2)
+        ]
+        mock_collection.return_value.bulk_write.return_value.upserted_ids = {1: ObjectId()}
+
+        result = NotificationService.inserer_notifications(documents)
+
+        self.assertEqual(result, 2)
+        mock_collection.return_value.insert_many.assert_not_called()
+        operations = mock_collection.return_value.bulk_write.call_args[0][0]
+        self.assertEqual(operations[0]._filter['destinataire'], parent1)
+        self.assertFalse(operations[0]._filter['lu'])
+        self.assertIn('$gte', operations[0]._filter['dateEnvoi'])
+        self.assertEqual(operations[0]._doc['$addToSet'], {'references': devoir_id})
+        self.assertTrue(operations[0]._upsert)
+        mock_compteurs.assert_called_once_with({(str(parent2), 'notifications.devoir'): 1})
+
+
+    @patch('core.services.NotificationService.marquer_notifications_lues')
+    def test_date_impossible_refusee(self, mock_marquer):
+        """Test : une date bien formée mais impossible donne 400, pas une erreur serveur"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import GestionNotificationsAPIView
+
+        for avant in ('2025-13-45T00:00', 'hier'):
+            request = APIRequestFactory().post('/api/notifications/marquer-lues/', {'avant': avant}, format='json')
+            force_authenticate(request, user=User(id=ObjectId(), role='parent'))
+            response = GestionNotificationsAPIView.as_view()(request)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_marquer.assert_not_called()
+
+class ConversationServiceTestCase(TestCase):
+    """Tests pour la boîte de réception et les fils de conversation"""
+
+    @patch('core.models.Message._get_collection')
+    def test_fil_pagination_par_curseur(self, mock_collection):
+        """Test : la page suivante reprend après le dernier message (createdAt, _id), limite + 1 pour détecter la suite"""
+        user_id, interlocuteur_id = str(ObjectId()), str(ObjectId())
+        dernier = {'_id': ObjectId(), 'contenu': 'b', 'createdAt': datetime(2025, 1, 15, 10, 0)}
+        documents = [{'_id': ObjectId(), 'contenu': 'a', 'createdAt': datetime(2025, 1, 15, 11, 0)}, dernier, {'_id': ObjectId()}]
+        mock_collection.return_value.find.return_value.sort.return_value.limit.return_value = documents
+        curseur = ConversationService.curseur(datetime(2025, 1, 15, 12, 0), ObjectId())
+
+        result = ConversationService.fil(user_id, interlocuteur_id, curseur, limite=2)
+
+        query = mock_collection.return_value.find.call_args[0][0]
+        self.assertEqual(query['conversation'], ConversationService.cle(interlocuteur_id, user_id))
+        date, document_id = ConversationService.lire_curseur(curseur)
+        self.assertEqual(query['$or'], [{'createdAt': {'$lt': date}}, {'createdAt': date, '_id': {'$lt': document_id}}])
+        mock_collection.return_value.find.return_value.sort.return_value.limit.assert_called_once_with(3)
+        self.assertEqual([message.contenu for message in result['messages']], ['a', 'b'])
+        self.assertEqual(ConversationService.lire_curseur(result['suivant']), (dernier['createdAt'], dernier['_id']))
+
+
+class RechercheServiceTestCase(TestCase):
+    """Tests pour la recherche plein texte"""
+
+    @patch('core.models.Eleve._get_collection')
+    @patch('core.models.Devoir._get_collection')
+    @patch('core.models.Message._get_collection')
+    def test_rechercher_fusion_par_score(self, mock_messages, mock_devoirs, mock_eleves):
+        """Test : messages de l'utilisateur et devoirs des classes de ses enfants, classés par score"""
+        parent = User(id=ObjectId(), nom='Test', prenom='Parent', email='p@test.com', motDePasse='x', role='parent')
+        classe_id = ObjectId()
+        mock_eleves.return_value.find.return_value = [{'classe': classe_id, 'subdivision': 'A'}]
+        mock_messages.return_value.find.return_value.sort.return_value.limit.return_value = [
+            {'_id': ObjectId(), 'score': 1.2, 'contenu': 'Résultats de Léa', 'sender': parent.id},
+        ]
+        mock_devoirs.return_value.find.return_value.sort.return_value.limit.return_value = [
+            {'_id': ObjectId(), 'score': 2.5, 'titre': 'Exercices', 'description': 'Résultats attendus', 'classe': classe_id},
+            {'_id': ObjectId(), 'score': 0.8, 'titre': 'Lecture', 'classe': classe_id},
+        ]
+
+        result = RechercheService.rechercher(parent, 'résultats', limite=2)
+
+        self.assertEqual([(r['type'], r['score']) for r in result['resultats']], [('devoir', 2.5), ('message', 1.2)])
+        self.assertTrue(result['suivante'])
+        query = mock_devoirs.return_value.find.call_args[0][0]
+        self.assertEqual(query['$text'], {'$search': 'résultats'})
+        self.assertEqual(query['$or'][0]['classe'], classe_id)
+        self.assertCountEqual(query['$or'][0]['subdivision']['$in'], ['A', None])
+        self.assertEqual(mock_messages.return_value.find.call_args[0][0]['$or'],
+                         [{'sender': parent.id}, {'receiver': parent.id}])
+
+
+class CompteurServiceTestCase(TestCase):
+    """Tests pour les compteurs de non-lus"""
+
+    @patch('core.models.CompteurNonLus._get_collection')
+    def test_incrementer_regroupe_par_utilisateur(self, mock_collection):
+        """Test : un $inc par utilisateur, variations nulles ignorées, pas de création de compteur"""
+        user1, user2 = str(ObjectId()), str(ObjectId())
+        lecture = CompteurService.difference({(user1, 'notifications.devoir'): 1}, {})
+
+        CompteurService.incrementer({**lecture, (user1, 'messages'): 2, (user2, 'messages'): 0})
+
+        operations = mock_collection.return_value.bulk_write.call_args[0][0]
+        self.assertEqual(len(operations), 1)
+        self.assertEqual(operations[0]._filter, {'utilisateur': ObjectId(user1)})
+        self.assertEqual(operations[0]._doc['$inc'], {'notifications.devoir': -1, 'messages': 2, 'version': 1})
+        self.assertFalse(operations[0]._upsert)
+
+    @patch('core.services.CompteurService.calculer')
+    @patch('core.models.CompteurNonLus._get_collection')
+    def test_initialiser_conserve_les_increments(self, mock_collection, mock_calculer):
+        """Test : création par $setOnInsert, puis $inc de l'écart avec l'état lu avant le calcul"""
+        user_id = ObjectId()
+        final = {'notifications': {'devoir': 3, 'message': 1}, 'messages': 2, 'initialise': True, 'version': 1}
+        mock_collection.return_value.find_one_and_update.side_effect = [
+            {'notifications': {'devoir': 1, 'annonce': 1}, 'messages': 0, 'initialise': False, 'version': 0}, final,
+        ]
+        mock_calculer.return_value = {'notifications': {'devoir': 3, 'message': 1}, 'messages': 2}
+
+        self.assertEqual(CompteurService.initialiser(str(user_id)), final)
+
+        creation, application = mock_collection.return_value.find_one_and_update.call_args_list
+        self.assertIn('$setOnInsert', creation[0][1])
+        self.assertNotIn('$set', creation[0][1])
+        self.assertTrue(creation[1]['upsert'])
+        self.assertEqual(application[0][0], {'utilisateur': user_id, 'version': 0})
+        self.assertEqual(application[0][1]['$inc'], {
+            'notifications.devoir': 2, 'notifications.annonce': -1, 'notifications.message': 1,
+            'messages': 2, 'version': 1,
+        })
+
+    @patch('core.services.CompteurService.calculer')
+    @patch('core.models.CompteurNonLus._get_collection')
+    def test_increment_pendant_le_recomptage(self, mock_collection, mock_calculer):
+        """Test : un $inc arrivé pendant le recomptage fait échouer le compare-and-set, le calcul reprend"""
+        user_id = str(ObjectId())
+        documents = [{'notifications': {}, 'messages': 0, 'initialise': False, 'version': 0}]
+
+        def find_one_and_update(filtre, mise_a_jour, **kwargs):
+            document = documents[0]
+            if '$setOnInsert' in mise_a_jour:
+                return dict(document)
+            if filtre.get('version') != document['version']:
+                return None
+            for champ, delta in mise_a_jour['$inc'].items():
+                if champ.startswith('notifications.'):
+                    type_notif = champ.split('.', 1)[1]
+                    document['notifications'][type_notif] = document['notifications'].get(type_notif, 0) + delta
+                else:
+                    document[champ] = document.get(champ, 0) + delta
+            document.update(mise_a_jour['$set'])
+            return dict(document)
+
+        def calculer(_):
+            if mock_calculer.call_count == 1:
+                # Nouvelle notification : insérée (vue par le recomptage) puis comptée par incrementer
+                documents[0]['notifications']['devoir'] = 1
+                documents[0]['version'] += 1
+            return {'notifications': {'devoir': 1}, 'messages': 0}
+
+        mock_collection.return_value.find_one_and_update.side_effect = find_one_and_update
+        mock_calculer.side_effect = calculer
+
+        compteur = CompteurService.initialiser(user_id)
+
+        self.assertEqual(compteur['notifications'], {'devoir': 1})
+        self.assertTrue(compteur['initialise'])
+        self.assertEqual(mock_calculer.call_count, 2)
+        self.assertEqual(mock_collection.return_value.find_one_and_update.call_count, 4)
+
+
+class RetentionNotificationServiceTestCase(TestCase):
+    """Tests pour l'archivage des notifications lues"""
+
+    @patch('core.models.NotificationArchivee._get_collection')
+    @patch('core.models.Notification._get_collection')
+    def test_archiver_par_lots(self, mock_active, mock_archive):
+        """Test : chaque lot est recopié dans l'archive puis supprimé, seules les lues sont visées"""
+        lot1 = [{'_id': ObjectId(), 'lu': True}, {'_id': ObjectId(), 'lu': True}]
+        lot2 = [{'_id': ObjectId(), 'lu': True}]
+        mock_active.return_value.find.return_value.sort.return_value.limit.side_effect = [lot1, lot2, []]
+        mock_active.return_value.delete_many.return_value.deleted_count = 1
+
+        rapport = RetentionNotificationService.archiver(jours=30, taille_lot=2)
+
+        self.assertEqual(rapport, {'archivees': 2, 'lots': 2})
+        filtre = mock_active.return_value.find.call_args[0][0]
+        self.assertTrue(filtre['lu'])
+        self.assertIn('$lt', filtre['dateEnvoi'])
+        operations = mock_archive.return_value.bulk_write.call_args_list[0][0][0]
+        self.assertEqual([operation._filter for operation in operations], [{'_id': d['_id']} for d in lot1])
+        self.assertTrue(all(operation._upsert for operation in operations))
+        self.assertEqual(mock_active.return_value.delete_many.call_args_list[1][0][0],
+                         {'_id': {'$in': [lot2[0]['_id']]}, 'lu': True})
+
+
+class DiffusionServiceTestCase(TestCase):
+    """Tests pour la file d'attente des notifications"""
+
+    @patch('core.models.NotificationEnAttente._get_collection')
+    @patch('core.diffusion.DiffusionService.diffuser')
+    @patch('core.diffusion.DiffusionService.reserver')
+    def test_traiter_lot_reporte_puis_abandonne(self, mock_reserver, mock_diffuser, mock_collection):
+        """Test : une erreur reporte l'entrée, la dernière tentative l'abandonne, les autres sont envoyées"""
+        entrees = [
+            {'_id': ObjectId(), 'type': 'devoir', 'referenceId': ObjectId(), 'tentatives': 1},
+            {'_id': ObjectId(), 'type': 'devoir', 'referenceId': ObjectId(), 'tentatives': 5},
+            {'_id': ObjectId(), 'type': 'message', 'referenceId': ObjectId(), 'tentatives': 1},
+        ]
+        mock_reserver.side_effect = entrees + [None]
+        mock_diffuser.side_effect = [Exception("indisponible"), Exception("indisponible"), 1]
+        mock_collection.return_value.update_many.return_value.modified_count = 0
+
+        rapport = DiffusionService.traiter_lot(limite=10)
+
+        self.assertEqual(rapport, {
+            'traitees': 3, 'envoyees': 1, 'reportees': 1, 'echouees': 1, 'notifications_creees': 1
+        })
+        statuts = [appel[0][1]['$set']['statut'] for appel in mock_collection.return_value.update_one.call_args_list]
+        self.assertEqual(statuts, ['en_attente', 'echouee', 'envoyee'])
+
+    @patch('core.models.NotificationEnAttente._get_collection')
+    def test_verrou_expire_limite_aux_tentatives(self, mock_collection):
+        """Test : une entrée interrompue n'est reprise que sous la limite, au-delà elle est échouée"""
+        collection = mock_collection.return_value
+        collection.find_one_and_update.return_value = None
+        collection.update_many.return_value.modified_count = 1
+
+        rapport = DiffusionService.traiter_lot(limite=10)
+
+        reprise = collection.find_one_and_update.call_args[0][0]['$or'][1]
+        self.assertEqual(reprise['tentatives'], {'$lt': 5})
+        filtre, mise_a_jour = collection.update_many.call_args[0]
+        self.assertEqual((filtre['statut'], filtre['tentatives']), ('en_cours', {'$gte': 5}))
+        self.assertEqual(mise_a_jour['$set']['statut'], 'echouee')
+        self.assertEqual((rapport['echouees'], rapport['traitees']), (1, 0))
+
+
+class EvenementsTestCase(TestCase):
+    """Tests pour le flux SSE des notifications"""
+
+    def test_signal_distribue_au_destinataire(self):
+        """Test : un signal réveille la lecture, la notification n'arrive que dans les files de son destinataire"""
+        user1, user2 = str(ObjectId()), str(ObjectId())
+        notification = {'_id': ObjectId(), 'destinataire': ObjectId(user1), 'type': 'devoir',
+                        'referenceId': ObjectId(), 'lu': False, 'dateEnvoi': datetime(2024, 1, 8),
+                        'updatedAt': datetime(2024, 1, 8)}
+        abonnements = Abonnements()
+
+        async def scenario():
+            file1 = await abonnements.abonner(user1)
+            file2 = await abonnements.abonner(user2)
+            abonnements.signaler()
+            identifiant, recu = await asyncio.wait_for(file1.get(), timeout=1)
+            abonnements.desabonner(user1, file1)
+            abonnements.desabonner(user2, file2)
+            return identifiant, recu, file2.empty()
+
+        with patch.object(Abonnements, 'lire', side_effect=[[notification]] + [[]] * 10) as mock_lire:
+            identifiant, recu, file2_vide = asyncio.run(scenario())
+
+        self.assertEqual(sorted(mock_lire.call_args_list[0][0][0]), sorted([user1, user2]))
+        self.assertEqual(recu['id'], str(notification['_id']))
+        self.assertEqual(identifiant, f"{notification['_id']}:1704672000000")
+        self.assertEqual(recu['type'], 'devoir')
+        self.assertEqual(recu['dateEnvoi'], '2024-01-08T00:00:00')
+        self.assertTrue(file2_vide)
+        self.assertEqual(abonnements.files, {})
+
+    @patch('core.authentication.JetonRevoque')
+    @patch('core.authentication.MongoTokenAuthentication.charger')
+    def test_parametre_token_limite_au_jeton_signe(self, mock_charger, mock_revoque):
+        """Test : le token opaque est refusé dans l'URL sans être lu, le jeton signé est accepté"""
+        from .views import notifications_stream
+        mock_revoque._get_collection.return_value.find.return_value = []
+        factory = RequestFactory()
+
+        reponse = asyncio.run(notifications_stream(factory.get('/api/notifications/stream/', {'token': 'a' * 40})))
+        self.assertEqual(reponse.status_code, 401)
+        mock_charger.assert_not_called()
+
+        jeton, _ = signer_jeton(User(id=ObjectId(), role='parent'))
+        reponse = asyncio.run(notifications_stream(factory.get('/api/notifications/stream/', {'token': jeton})))
+        self.assertEqual(reponse.status_code, 200)
+        self.assertEqual(reponse['Content-Type'], 'text/event-stream')
+
+
+class JobServiceTestCase(TestCase):
+    """Tests pour l'exécution des jobs par morceaux"""
+
+    @patch('core.models.Job._get_collection')
+    def test_executer_reprend_apres_dernier_morceau(self, mock_collection):
+        """Test : les morceaux déjà terminés sont sautés, une erreur n'arrête pas le job"""
+        job_id = ObjectId()
+        mock_collection.return_value.find_one_and_update.return_value = {
+            '_id': job_id,
+            'type': 'calcul_notes_trimestrielles',
+            'parametres': {'trimestre_id': 't1'},
+            'morceaux': ['c1', 'c2', 'c3'],
+            'morceauxTermines': ['c1'],
+        }
+
+        def traiter(parametres, morceau):
+            if morceau == 'c3':
+                raise ValueError("Classe invalide")
+            return {'notes_calculees': 4}
+
+        with patch.dict(TYPES_JOBS['calcul_notes_trimestrielles'], {'traiter': traiter}):
+            JobService.executer(str(job_id))
+
+        mises_a_jour = [appel[0][1] for appel in mock_collection.return_value.update_one.call_args_list]
+        self.assertEqual(mises_a_jour[0]['$addToSet'], {'morceauxTermines': 'c2'})
+        self.assertEqual(mises_a_jour[0]['$inc'], {'compteurs.notes_calculees': 4})
+        self.assertEqual(mises_a_jour[1]['$push']['erreurs']['morceau'], 'c3')
+        self.assertEqual(mises_a_jour[-1]['$set']['statut'], 'echoue')
+        self.assertEqual(mises_a_jour[-1]['$set']['progression'], 66.7)
+
+    @patch('core.models.Job._get_collection')
+    def test_executer_job_deja_reserve(self, mock_collection):
+        """Test : un job pris par un autre worker n'est pas exécuté deux fois"""
+        mock_collection.return_value.find_one_and_update.return_value = None
+
+        self.assertIsNone(JobService.executer(str(ObjectId())))
+        mock_collection.return_value.update_one.assert_not_called()
+
+    def test_identifiant_job_invalide(self):
+        """Test : un identifiant mal formé donne 400, pas une erreur serveur"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from .views import JobAPIView
+
+        request = APIRequestFactory().get('/api/jobs/pas-un-id/')
+        force_authenticate(request, user=User(id=ObjectId(), role='admin'))
+        response = JobAPIView.as_view()(request, pk='pas-un-id')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CalculParalleleTestCase(TestCase):
+    """Tests pour le découpage des calculs parallèles"""
+
+    @patch('core.models.Eleve._get_collection')
+    def test_morceaux_par_subdivision(self, mock_eleves):
+        """Test : une classe contenant des élèves sans subdivision reste un seul morceau"""
+        classe_a, classe_b = ObjectId(), ObjectId()
+        mock_eleves.return_value.aggregate.return_value = [
+            {'_id': {'classe': classe_a, 'subdivision': 'B'}},
+            {'_id': {'classe': classe_a, 'subdivision': 'A'}},
+            {'_id': {'classe': classe_b, 'subdivision': 'A'}},
+            {'_id': {'classe': classe_b}},
+        ]
+
+        morceaux = morceaux_classes(par_subdivision=True)
+
+        self.assertEqual(sorted(morceaux, key=str), sorted([
+            (str(classe_a), 'A'), (str(classe_a), 'B'), (str(classe_b), None)
+        ], key=str))
+
+    @patch('core.parallel.StatistiquesService.enregistrer', return_value=1)
+    @patch('core.parallel.NoteBulkWriter')
+    @patch('core.parallel._notes_trimestrielles_morceau')
+    @patch('core.parallel.morceaux_classes')
+    def test_calculer_trimestre_fusionne_les_morceaux(self, mock_morceaux, mock_morceau, mock_writer, mock_statistiques):
+        """Test : deux subdivisions d'une classe sont recomposées en une classe pour les statistiques"""
+        mock_morceaux.return_value = [('c1', 'A'), ('c1', 'B')]
+        resultat = {'note_finale': 12.0, 'moyenne_travaux': 12.0, 'note_examen': 12.0}
+        mock_morceau.side_effect = [
+            ({'c1': {'eleve_ids': ['e1'], 'matiere_ids': ['m1']}}, {('e1', 'm1'): resultat}),
+            ({'c1': {'eleve_ids': ['e2'], 'matiere_ids': ['m1']}}, {('e2', 'm1'): resultat}),
+        ]
+
+        rapport = CalculParalleleService.calculer_trimestre('t1', processus=1, par_subdivision=True)
+
+        self.assertEqual((rapport['notes_calculees'], rapport['classes'], rapport['morceaux']), (2, 1, 2))
+        self.assertEqual(mock_writer.return_value.ajouter_note_trimestrielle.call_count, 2)
+        plan, resultats = mock_statistiques.call_args[0][1:3]
+        self.assertEqual(plan, {'c1': {'eleve_ids': ['e1', 'e2'], 'matiere_ids': ['m1']}})
+        self.assertEqual(set(resultats), {('e1', 'm1'), ('e2', 'm1')})
+
+    @patch('core.parallel.NoteAnnuelle._get_collection')
+    @patch('core.parallel._promotion_morceau')
+    @patch('core.parallel.morceaux_classes')
+    def test_promouvoir_fusionne_les_morceaux(self, mock_morceaux, mock_morceau, mock_collection):
+        """Test : compteurs additionnés et écritures de tous les morceaux groupées en un bulk_write"""
+        mock_morceaux.return_value = [('c1', None), ('c2', None)]
+        mock_morceau.side_effect = [
+            ({'promotions_reussies': 2, 'promotions_echouees': 1}, ['op1', 'op2']),
+            ({'promotions_reussies': 1, 'promotions_echouees': 0}, ['op3']),
+        ]
+
+        rapport = CalculParalleleService.promouvoir('a1', processus=1)
+
+        self.assertEqual(rapport, {'promotions_reussies': 3, 'promotions_echouees': 1})
+        mock_collection.return_value.bulk_write.assert_called_once_with(['op1', 'op2', 'op3'], ordered=False)
 
 
 class APIEndpointsTestCase(APITestCase):
@@ -10,6 +10,9 @@ urlpatterns = [
     path('api/auth/change-password/', views.change_password, name='change_password'),
     path('api/auth/token-info/', views.token_info, name='token_info'),
     path('api/auth/refresh-token/', views.refresh_token, name='refresh_token'),
+    path('api/auth/cache-stats/', views.cache_stats, name='cache_stats'),
+    path('api/auth/sessions/', views.sessions, name='sessions'),
+    path('api/auth/sessions/<str:pk>/', views.session_detail, name='session_detail'),
     
     # CRUD API
     path('api/users/', views.UserAPIView.as_view(), name='user-list'),
@@ -20,6 +23,7 @@ urlpatterns = [
     
     path('api/classes/', views.ClasseAPIView.as_view(), name='classe-list'),
     path('api/classes/<str:pk>/', views.ClasseAPIView.as_view(), name='classe-detail'),
+    path('api/classes/<str:pk>/statistiques/', views.StatistiquesClasseAPIView.as_view(), name='classe-statistiques'),
     
     path('api/matieres/', views.MatiereAPIView.as_view(), name='matiere-list'),
     path('api/matieres/<str:pk>/', views.MatiereAPIView.as_view(), name='matiere-detail'),
@@ -49,9 +53,14 @@ urlpatterns = [
     path('api/notes-annuelles/<str:pk>/', views.NoteAnnuelleAPIView.as_view(), name='noteannuelle-detail'),
     
     path('api/messages/', views.MessageAPIView.as_view(), name='message-list'),
+    path('api/messages/conversations/', views.BoiteReceptionAPIView.as_view(), name='boite-reception'),
     path('api/messages/<str:pk>/', views.MessageAPIView.as_view(), name='message-detail'),
+    path('api/messages/conversation/<str:pk>/', views.FilConversationAPIView.as_view(), name='conversation-fil'),
+    path('api/messages/conversation/<str:pk>/lue/', views.ConversationLueAPIView.as_view(), name='conversation-lue'),
     
     path('api/notifications/', views.NotificationAPIView.as_view(), name='notification-list'),
+    path('api/notifications/compteurs/', views.CompteursNotificationsAPIView.as_view(), name='notification-compteurs'),
+    path('api/notifications/stream/', views.notifications_stream, name='notification-stream'),
     path('api/notifications/<str:pk>/', views.NotificationAPIView.as_view(), name='notification-detail'),
     
     path('api/emplois-du-temps/', views.EmploiDuTempsAPIView.as_view(), name='emploidutemps-list'),
@@ -59,11 +68,15 @@ urlpatterns = [
     
     # Opérations complexes
     path('api/calcul-notes-trimestrielles/', views.CalculNotesTrimestriellesAPIView.as_view(), name='calcul-notes'),
+    path('api/calcul-notes-annuelles/', views.CalculNotesAnnuellesAPIView.as_view(), name='calcul-notes-annuelles'),
     path('api/promotion-automatique/', views.PromotionAutomatiqueAPIView.as_view(), name='promotion-auto'),
+    path('api/promotion-simulation/', views.SimulationPromotionAPIView.as_view(), name='promotion-simulation'),
+    path('api/jobs/<str:pk>/', views.JobAPIView.as_view(), name='job-detail'),
     path('api/affecter-parent/', views.AffecterParentAPIView.as_view(), name='affecter-parent'),
     path('api/gestion-notifications/', views.GestionNotificationsAPIView.as_view(), name='gestion-notifications'),
     path('api/marquer-notification-lue/<str:pk>/', views.GestionNotificationsAPIView.as_view(), name='marquer-notification-lue'),
     path('api/affecter-professeur/', views.AffecterProfesseurAPIView.as_view(), name='affecter-professeur'),
+    path('api/recherche/', views.RechercheAPIView.as_view(), name='recherche'),
     
     # Interface DRF
     path('api-auth/', include('rest_framework.urls')),
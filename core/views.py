@@ -1,14 +1,26 @@
 from rest_framework.views import APIView
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework import exceptions
 from django.contrib.auth.hashers import check_password
+from django.http import JsonResponse, StreamingHttpResponse
+from django.conf import settings
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from asgiref.sync import sync_to_async
+import asyncio
+import json
 import random
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
 
 from .models import (
     User,
+    AuthToken,
     Eleve,
     Classe,
     Matiere,
@@ -23,6 +35,8 @@ from .models import (
     Message,
     Notification,
     EmploiDuTemps,
+    Job,
+    StatistiquesClasse,
 )
 from .serializers import (
     UserSerializer,
@@ -47,10 +61,22 @@ from .serializers import (
 )
 from .services import (
     NoteService,
+    SuiviNotesService,
     PromotionService,
+    SimulationPromotionService,
     NotificationService,
+    MessageService,
+    ConversationService,
+    CompteurService,
+    RechercheService,
     AuthTokenService,
+    id_reference,
 )
+from .authentication import MongoTokenAuthentication, cache_tokens, cle_requete, identifier, utilisateur_complet
+from .events import abonnements, rattrapage
+from .jobs import JobService
+from .diffusion import DiffusionService
+from .parallel import CalculParalleleService
 
 try:
     from .permissions import (
@@ -74,6 +100,15 @@ except ImportError:
 # ============ VUES D'AUTHENTIFICATION ============
 
 
+def session_courante(request):
+    """(clé du token, identifiant de session) de la requête : la clé d'un token opaque ou le sid d'un jeton signé"""
+    if isinstance(request.auth, AuthToken):
+        return request.auth.key, None
+    if isinstance(request.auth, dict):
+        return None, request.auth.get("sid")
+    return None, None
+
+
 @api_view(["POST"])
 @permission_classes([AllowAny])
 def register(request):
@@ -81,7 +116,7 @@ def register(request):
     serializer = UserRegistrationSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.save()
-        token = AuthTokenService.create_token(user)
+        token = AuthTokenService.create_token(user, request.META.get("HTTP_USER_AGENT"))
         return Response(
             {
                 "message": "Utilisateur créé avec succès",
@@ -106,23 +141,25 @@ def login(request):
     serializer = UserLoginSerializer(data=request.data)
     if serializer.is_valid():
         user = serializer.validated_data["user"]
-        token = AuthTokenService.create_token(user)
-
-        return Response(
-            {
-                "message": "Connexion réussie",
-                "user": {
-                    "id": str(user.id),
-                    "nom": user.nom,
-                    "prenom": user.prenom,
-                    "email": user.email,
-                    "role": user.role,
-                    "telephone": user.telephone,
-                },
-                "token": token.key,
+        token = AuthTokenService.create_token(user, request.META.get("HTTP_USER_AGENT"))
+
+        data = {
+            "message": "Connexion réussie",
+            "user": {
+                "id": str(user.id),
+                "nom": user.nom,
+                "prenom": user.prenom,
+                "email": user.email,
+                "role": user.role,
+                "telephone": user.telephone,
             },
-            status=status.HTTP_200_OK,
-        )
+            "token": token.key,
+        }
+        if request.data.get("format") == "signe":
+            # Jeton d'accès signé de courte durée ; le token opaque sert au rafraîchissement
+            acces = AuthTokenService.create_access_token(user, token.id)
+            data.update(format="signe", token=acces["token"], expiresAt=acces["expiresAt"], refresh=token.key)
+        return Response(data, status=status.HTTP_200_OK)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -130,13 +167,18 @@ def login(request):
 @permission_classes([IsAuthenticated])
 def logout(request):
     """Déconnexion d'un utilisateur"""
-    auth_header = request.META.get("HTTP_AUTHORIZATION", "")
-    if auth_header.startswith("Token "):
-        token_key = auth_header.split(" ")[1]
-        if AuthTokenService.delete_token(token_key):
-            return Response(
-                {"message": "Déconnexion réussie"}, status=status.HTTP_200_OK
-            )
+    if isinstance(request.auth, dict):
+        # Jeton signé : révoqué jusqu'à son expiration, avec le token de rafraîchissement fourni
+        AuthTokenService.revoke_access_token(request.auth)
+        if request.data.get("refresh"):
+            AuthTokenService.delete_token(request.data["refresh"])
+        return Response({"message": "Déconnexion réussie"}, status=status.HTTP_200_OK)
+
+    # request.auth : token déjà résolu par l'authentification, l'en-tête n'est pas relu
+    if isinstance(request.auth, AuthToken) and AuthTokenService.delete_token(request.auth.key):
+        return Response(
+            {"message": "Déconnexion réussie"}, status=status.HTTP_200_OK
+        )
     return Response(
         {"message": "Erreur lors de la déconnexion"}, status=status.HTTP_400_BAD_REQUEST
     )
@@ -146,7 +188,7 @@ def logout(request):
 @permission_classes([IsAuthenticated])
 def profile(request):
     """Consultation et modification du profil utilisateur"""
-    user = request.user
+    user = utilisateur_complet(request.user)
     if request.method == "GET":
         serializer = UserProfileSerializer(user)
         return Response(serializer.data)
@@ -154,6 +196,7 @@ def profile(request):
         serializer = UserProfileSerializer(user, data=request.data, partial=True)
         if serializer.is_valid():
             serializer.save()
+            cache_tokens.invalider_utilisateur(user.id)
             return Response(
                 {"message": "Profil mis à jour avec succès", "user": serializer.data}
             )
@@ -164,11 +207,15 @@ def profile(request):
 @permission_classes([IsAuthenticated])
 def change_password(request):
     """Changement de mot de passe"""
+    request.user = utilisateur_complet(request.user)
     serializer = ChangePasswordSerializer(
         data=request.data, context={"request": request}
     )
     if serializer.is_valid():
         serializer.save()
+        # Les autres sessions (tokens de rafraîchissement compris) sont fermées, la courante est gardée
+        AuthTokenService.revoke_other_sessions(request.user, *session_courante(request))
+        cache_tokens.invalider_utilisateur(request.user.id)
         return Response({"message": "Mot de passe modifié avec succès"})
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -177,41 +224,102 @@ def change_password(request):
 @permission_classes([IsAuthenticated])
 def token_info(request):
     """Informations sur le token actuel"""
-    auth_header = request.META.get("HTTP_AUTHORIZATION", "")
-    if auth_header.startswith("Bearer "):
-        token_key = auth_header.split(" ")[1]
-        from .models import AuthToken
+    if isinstance(request.auth, dict):
+        return Response(
+            {
+                "format": "signe",
+                "expiresAt": datetime.utcfromtimestamp(request.auth["exp"]),
+                "user": {"id": request.auth["id"], "role": request.auth["role"]},
+            }
+        )
+    if isinstance(request.auth, AuthToken):
+        token = request.auth
+        return Response(
+            {
+                "token_key": token.key[:10] + "...",
+                "created": token.created,
+                "user": {
+                    "id": str(request.user.id),
+                    "email": request.user.email,
+                    "role": request.user.role,
+                },
+            }
+        )
+    return Response({"error": "Aucun token fourni"}, status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            token = AuthToken.objects.get(key=token_key)
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def refresh_token(request):
+    """
+    Actualiser le token. Avec "refresh" (format signé) : nouveau jeton d'accès, sans en-tête (le
+    jeton expiré n'est pas vérifié). Sinon : remplace le token opaque présenté en Bearer.
+    """
+    refresh = request.data.get("refresh")
+    if refresh:
+        acces = AuthTokenService.refresh_access_token(refresh)
+        if acces is None:
             return Response(
-                {
-                    "token_key": token.key[:10] + "...",
-                    "created": token.created,
-                    "user": {
-                        "id": str(token.user.id),
-                        "email": token.user.email,
-                        "role": token.user.role,
-                    },
-                }
+                {"error": "Token de rafraîchissement invalide"}, status=status.HTTP_401_UNAUTHORIZED
             )
-        except AuthToken.DoesNotExist:
+        return Response({"message": "Token actualisé avec succès", "format": "signe", **acces})
+
+    try:
+        resultat = identifier(request)
+    except exceptions.AuthenticationFailed as e:
+        return Response({"error": str(e.detail)}, status=status.HTTP_401_UNAUTHORIZED)
+    if resultat is None:
+        return Response({"error": "Aucun token fourni"}, status=status.HTTP_401_UNAUTHORIZED)
+
+    user, token = resultat
+    if isinstance(token, dict):
+        return Response(
+            {"error": "Un jeton signé se renouvelle avec le champ refresh"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    AuthTokenService.delete_token(token.key)
+    new_token = AuthTokenService.create_token(user, request.META.get("HTTP_USER_AGENT"))
+    return Response({"message": "Token actualisé avec succès", "token": new_token.key})
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def cache_stats(request):
+    """Statistiques du cache des tokens de ce processus (succès, échecs, expirations, évictions)"""
+    if request.user.role not in ["admin", "developpeur"]:
+        return Response(
+            {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
+        )
+    return Response(cache_tokens.statistiques())
+
+
+@api_view(["GET", "DELETE"])
+@permission_classes([IsAuthenticated])
+def sessions(request):
+    """Sessions ouvertes de l'utilisateur (GET) ; DELETE ferme toutes les autres que la session courante"""
+    token_key, session_id = session_courante(request)
+    if request.method == "DELETE":
+        if token_key is None and session_id is None:
             return Response(
-                {"error": "Token invalide"}, status=status.HTTP_400_BAD_REQUEST
+                {"error": "Session courante inconnue : reconnectez-vous pour obtenir un jeton lié à sa session"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
-    return Response({"error": "Aucun token fourni"}, status=status.HTTP_400_BAD_REQUEST)
+        fermees = AuthTokenService.revoke_other_sessions(request.user, token_key, session_id)
+        return Response({"message": "Autres sessions fermées", "sessions_fermees": fermees})
+    return Response(AuthTokenService.sessions(request.user, token_key, session_id))
 
 
-@api_view(["POST"])
+@api_view(["DELETE"])
 @permission_classes([IsAuthenticated])
-def refresh_token(request):
-    """Actualiser le token"""
-    auth_header = request.META.get("HTTP_AUTHORIZATION", "")
-    if auth_header.startswith("Bearer "):
-        old_token_key = auth_header.split(" ")[1]
-        AuthTokenService.delete_token(old_token_key)
-    new_token = AuthTokenService.create_token(request.user)
-    return Response({"message": "Token actualisé avec succès", "token": new_token.key})
+def session_detail(request, pk):
+    """Ferme une session de l'utilisateur"""
+    try:
+        fermee = AuthTokenService.revoke_session(request.user, pk)
+    except InvalidId:
+        return Response({"error": "Identifiant invalide"}, status=status.HTTP_400_BAD_REQUEST)
+    if not fermee:
+        return Response({"error": "Session non trouvée"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 # ============ APIView DE BASE POUR CRUD ============
@@ -240,11 +348,20 @@ class BaseMongoAPIView(APIView):
             serializer = self.serializer_class([obj for obj in objects], many=True)
             return Response(serializer.data)
 
+    def avant_ecriture(self, obj):
+        """Appelé avant la modification ou la suppression d'un objet ; le retour est passé à apres_ecriture"""
+        return None
+
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Appelé après la création, la modification ou la suppression (supprime=True) d'un objet"""
+        pass
+
     def post(self, request):
         """Créer un nouvel objet"""
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            obj = serializer.save()
+            self.apres_ecriture(obj)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -254,7 +371,9 @@ class BaseMongoAPIView(APIView):
             obj = self.model_class.objects.get(id=pk)
             serializer = self.serializer_class(obj, data=request.data)
             if serializer.is_valid():
-                serializer.save()
+                avant = self.avant_ecriture(obj)
+                obj = serializer.save()
+                self.apres_ecriture(obj, avant)
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except self.model_class.DoesNotExist:
@@ -268,7 +387,9 @@ class BaseMongoAPIView(APIView):
             obj = self.model_class.objects.get(id=pk)
             serializer = self.serializer_class(obj, data=request.data, partial=True)
             if serializer.is_valid():
-                serializer.save()
+                avant = self.avant_ecriture(obj)
+                obj = serializer.save()
+                self.apres_ecriture(obj, avant)
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except self.model_class.DoesNotExist:
@@ -280,7 +401,9 @@ class BaseMongoAPIView(APIView):
         """Supprimer un objet"""
         try:
             obj = self.model_class.objects.get(id=pk)
+            avant = self.avant_ecriture(obj)
             obj.delete()
+            self.apres_ecriture(obj, avant, supprime=True)
             return Response(status=status.HTTP_204_NO_CONTENT)
         except self.model_class.DoesNotExist:
             return Response(
@@ -295,6 +418,10 @@ class UserAPIView(BaseMongoAPIView):
     serializer_class = UserSerializer
     model_class = User
 
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Un utilisateur modifié ou supprimé n'est plus servi depuis le cache des tokens"""
+        cache_tokens.invalider_utilisateur(obj.id)
+
 
 class EleveAPIView(BaseMongoAPIView):
     serializer_class = EleveSerializer
@@ -320,8 +447,8 @@ class DevoirAPIView(BaseMongoAPIView):
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             devoir = serializer.save()
-            # Créer des notifications pour les parents
-            NotificationService.creer_notification_devoir(str(devoir.id))
+            # Notifications des parents diffusées en arrière-plan
+            DiffusionService.publier("devoir", str(devoir.id))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -345,11 +472,25 @@ class InterrogationAPIView(BaseMongoAPIView):
     serializer_class = InterrogationSerializer
     model_class = Interrogation
 
+    def avant_ecriture(self, obj):
+        return SuiviNotesService.cles_interrogation(obj)
+
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Marque l'ancienne et la nouvelle clé de l'interrogation pour le recalcul incrémental"""
+        SuiviNotesService.marquer((avant or set()) | SuiviNotesService.cles_interrogation(obj))
+
 
 class ExamenAPIView(BaseMongoAPIView):
     serializer_class = ExamenSerializer
     model_class = Examen
 
+    def avant_ecriture(self, obj):
+        return SuiviNotesService.cles_examen(obj)
+
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Marque l'ancienne et la nouvelle clé de l'examen pour le recalcul incrémental"""
+        SuiviNotesService.marquer((avant or set()) | SuiviNotesService.cles_examen(obj))
+
 
 class NoteTrimestrielleAPIView(BaseMongoAPIView):
     serializer_class = NoteTrimestrielleSerializer
@@ -365,21 +506,61 @@ class MessageAPIView(BaseMongoAPIView):
     serializer_class = MessageSerializer
     model_class = Message
 
+    def get(self, request, pk=None):
+        """Récupérer uniquement les messages envoyés ou reçus par l'utilisateur connecté"""
+        participant = {"$or": [{"sender": request.user.id}, {"receiver": request.user.id}]}
+        if pk:
+            try:
+                message = Message.objects(__raw__=participant).get(id=pk)
+                serializer = self.serializer_class(message)
+                return Response(serializer.data)
+            except Message.DoesNotExist:
+                return Response(
+                    {"error": "Message non trouvé"}, status=status.HTTP_404_NOT_FOUND
+                )
+        else:
+            messages = Message.objects(__raw__=participant)
+            serializer = self.serializer_class([message for message in messages], many=True)
+            return Response(serializer.data)
+
     def post(self, request):
         """Créer un message avec notification"""
         serializer = self.serializer_class(data=request.data)
         if serializer.is_valid():
             message = serializer.save()
-            # Créer une notification pour le destinataire
-            NotificationService.creer_notification_message(str(message.id))
+            self.apres_ecriture(message)
+            ConversationService.enregistrer_message(message)
+            # Notification du destinataire diffusée en arrière-plan
+            DiffusionService.publier("message", str(message.id))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    def avant_ecriture(self, obj):
+        return CompteurService.contribution_message(obj)
+
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Reporte le changement d'état de lecture dans le compteur de messages et la conversation du destinataire"""
+        difference = CompteurService.difference(
+            avant or {}, {} if supprime else CompteurService.contribution_message(obj)
+        )
+        CompteurService.incrementer(difference)
+        if avant is not None:
+            ConversationService.ajuster(obj, sum(difference.values()), supprime)
+
 
 class NotificationAPIView(BaseMongoAPIView):
     serializer_class = NotificationSerializer
     model_class = Notification
 
+    def avant_ecriture(self, obj):
+        return CompteurService.contribution_notification(obj)
+
+    def apres_ecriture(self, obj, avant=None, supprime=False):
+        """Reporte la création, la lecture ou la suppression dans les compteurs de non-lus"""
+        CompteurService.incrementer(CompteurService.difference(
+            avant or {}, {} if supprime else CompteurService.contribution_notification(obj)
+        ))
+
     def get(self, request, pk=None):
         """Récupérer uniquement les notifications de l'utilisateur connecté"""
         if pk:
@@ -410,6 +591,107 @@ class EmploiDuTempsAPIView(BaseMongoAPIView):
 # ============ APIView POUR OPÉRATIONS COMPLEXES ============
 
 
+def job_soumis(job):
+    """Réponse 202 commune aux opérations lancées en arrière-plan"""
+    return {
+        "message": "Job soumis",
+        "job_id": str(job.id),
+        "statut": job.statut,
+        "morceaux": len(job.morceaux),
+    }
+
+
+def options_paralleles(data):
+    """Options communes du mode parallèle : nombre de processus et découpage par subdivision"""
+    processus = data.get("processus")
+    return {
+        "processus": int(processus) if processus else None,
+        "par_subdivision": bool(data.get("par_subdivision")),
+    }
+
+
+def lire_date(valeur):
+    """Date ISO 8601 d'un paramètre ; None si elle est mal formée ou impossible (2025-13-45)"""
+    try:
+        return parse_datetime(valeur)
+    except (TypeError, ValueError):
+        return None
+
+
+class StatistiquesClasseAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        """Statistiques d'une classe pour un trimestre (calculées avec les notes trimestrielles)"""
+        trimestre_id = request.query_params.get("trimestre")
+        if not trimestre_id:
+            return Response(
+                {"error": "trimestre required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            classe_id, trimestre_id = ObjectId(pk), ObjectId(trimestre_id)
+        except InvalidId:
+            return Response({"error": "Identifiant invalide"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Un parent ne voit que les classes de ses enfants, et dans le classement que ses enfants
+        enfants = None
+        if request.user.role == "parent":
+            enfants = {
+                str(getattr(enfant, "id", enfant))
+                for enfant in utilisateur_complet(request.user)._data.get("enfants") or []
+            }
+            if not Eleve._get_collection().count_documents(
+                {"_id": {"$in": [ObjectId(enfant) for enfant in enfants]}, "classe": classe_id}, limit=1
+            ):
+                return Response(
+                    {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
+                )
+
+        statistiques = StatistiquesClasse._get_collection().find_one({
+            "classe": classe_id,
+            "trimestre": trimestre_id,
+            "subdivision": request.query_params.get("subdivision"),
+        })
+
+        if not statistiques:
+            return Response(
+                {"error": "Statistiques non calculées pour ce trimestre"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        classement = statistiques.get("classement", [])
+        if enfants is not None:
+            classement = [entree for entree in classement if str(entree["eleve"]) in enfants]
+
+        return Response(
+            {
+                "classe": str(statistiques["classe"]),
+                "subdivision": statistiques.get("subdivision"),
+                "trimestre": str(statistiques["trimestre"]),
+                "effectif": statistiques.get("effectif"),
+                "moyenne": statistiques.get("moyenne"),
+                "noteMin": statistiques.get("noteMin"),
+                "noteMax": statistiques.get("noteMax"),
+                "matieres": [
+                    dict(matiere, matiere=str(matiere["matiere"]))
+                    for matiere in statistiques.get("matieres", [])
+                ],
+                "classement": [
+                    dict(
+                        entree,
+                        eleve=str(entree["eleve"]),
+                        matieres=[
+                            dict(rang, matiere=str(rang["matiere"])) for rang in entree.get("matieres", [])
+                        ],
+                    )
+                    for entree in classement
+                ],
+                "dateCalcul": statistiques.get("dateCalcul"),
+            }
+        )
+
+
 class CalculNotesTrimestriellesAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -420,6 +702,27 @@ class CalculNotesTrimestriellesAPIView(APIView):
                 {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
             )
 
+        # "agregation" : quelques pipelines $group pour tout le trimestre
+        # "unitaire" : ancien calcul élève par élève, conservé pour comparaison
+        # "vectorise" : notes brutes chargées une fois puis réduites avec NumPy
+        # "incremental" : uniquement les notes touchées depuis le dernier recalcul
+        mode = request.data.get("mode", "agregation")
+        if mode not in ["agregation", "unitaire", "vectorise", "incremental"]:
+            return Response(
+                {"error": "mode must be 'agregation', 'unitaire', 'vectorise' or 'incremental'"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        if mode == "incremental":
+            try:
+                limite = request.data.get("limite")
+                rapport = SuiviNotesService.recalculer(int(limite) if limite else None)
+                return Response(
+                    {"message": f"{rapport['cles_recalculees']} notes recalculées", **rapport}
+                )
+            except Exception as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         trimestre_id = request.data.get("trimestre_id")
         if not trimestre_id:
             return Response(
@@ -427,37 +730,100 @@ class CalculNotesTrimestriellesAPIView(APIView):
             )
 
         try:
-            trimestre = Trimestre.objects.get(id=trimestre_id)
-            eleves = Eleve.objects.all()
-            matieres = Matiere.objects.all()
-
-            notes_calculees = 0
-            for eleve in eleves:
-                for matiere in matieres:
-                    resultat = NoteService.calculer_note_trimestrielle(
-                        str(eleve.id), str(matiere.id), trimestre_id
-                    )
+            Trimestre.objects.get(id=trimestre_id)
+            if request.data.get("asynchrone"):
+                job = JobService.soumettre(
+                    "calcul_notes_trimestrielles",
+                    {
+                        "trimestre_id": trimestre_id,
+                        "classe_id": request.data.get("classe_id"),
+                        "subdivision": request.data.get("subdivision"),
+                        "mode": mode,
+                    },
+                    request.user,
+                )
+                return Response(job_soumis(job), status=status.HTTP_202_ACCEPTED)
+
+            if request.data.get("parallele"):
+                rapport = CalculParalleleService.calculer_trimestre(
+                    trimestre_id,
+                    classe_id=request.data.get("classe_id"),
+                    subdivision=request.data.get("subdivision"),
+                    mode=mode,
+                    **options_paralleles(request.data),
+                )
+            else:
+                rapport = NoteService.calculer_trimestre(
+                    trimestre_id,
+                    classe_id=request.data.get("classe_id"),
+                    subdivision=request.data.get("subdivision"),
+                    mode=mode,
+                )
 
-                    note_trim, created = NoteTrimestrielle.objects.get_or_create(
-                        eleve=eleve,
-                        matiere=matiere,
-                        trimestre=trimestre,
-                        defaults={
-                            "noteFinale": resultat["note_finale"],
-                            "details": {
-                                "moyenneTravaux": resultat["moyenne_travaux"],
-                                "noteExamen": resultat["note_examen"],
-                            },
-                        },
-                    )
+            return Response(
+                {
+                    "message": f"{rapport['notes_calculees']} notes calculées",
+                    "classes": rapport["classes"],
+                    "ecriture": rapport["ecriture"],
+                }
+            )
 
-                    if not created:
-                        note_trim.noteFinale = resultat["note_finale"]
-                        note_trim.save()
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-                    notes_calculees += 1
 
-            return Response({"message": f"{notes_calculees} notes calculées"})
+class CalculNotesAnnuellesAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """Calcul des notes annuelles de toute une année scolaire"""
+        if not (request.user.role in ["admin", "developpeur", "professeur"]):
+            return Response(
+                {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        annee_id = request.data.get("annee_scolaire_id")
+        if not annee_id:
+            return Response(
+                {"error": "annee_scolaire_id required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            AnneeScolaire.objects.get(id=annee_id)
+            if request.data.get("asynchrone"):
+                job = JobService.soumettre(
+                    "calcul_notes_annuelles",
+                    {
+                        "annee_scolaire_id": annee_id,
+                        "classe_id": request.data.get("classe_id"),
+                        "subdivision": request.data.get("subdivision"),
+                    },
+                    request.user,
+                )
+                return Response(job_soumis(job), status=status.HTTP_202_ACCEPTED)
+
+            if request.data.get("parallele"):
+                rapport = CalculParalleleService.calculer_annee(
+                    annee_id,
+                    classe_id=request.data.get("classe_id"),
+                    subdivision=request.data.get("subdivision"),
+                    **options_paralleles(request.data),
+                )
+            else:
+                rapport = NoteService.calculer_annee(
+                    annee_id,
+                    classe_id=request.data.get("classe_id"),
+                    subdivision=request.data.get("subdivision"),
+                )
+
+            return Response(
+                {
+                    "message": f"{rapport['notes_calculees']} notes annuelles calculées",
+                    "classes": rapport["classes"],
+                    "ecriture": rapport["ecriture"],
+                }
+            )
 
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -482,33 +848,133 @@ class PromotionAutomatiqueAPIView(APIView):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+        # "lot" : moyennes pondérées agrégées et écriture groupée
+        # "unitaire" : ancienne évaluation élève par élève, parallélisable (parallele)
+        parallele = bool(request.data.get("parallele"))
+        classe_id = request.data.get("classe_id")
+        mode = request.data.get("mode") or ("unitaire" if parallele else "lot")
+        if mode not in ["lot", "unitaire"]:
+            return Response(
+                {"error": "mode must be 'lot' or 'unitaire'"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # Options incompatibles refusées plutôt qu'ignorées
+        if parallele and mode == "lot":
+            return Response(
+                {"error": "parallele requires mode 'unitaire'"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if parallele and classe_id:
+            return Response(
+                {"error": "classe_id is not supported with parallele"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if request.data.get("asynchrone") and (parallele or classe_id):
+            return Response(
+                {"error": "asynchrone promotes the whole school, without parallele or classe_id"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
         try:
-            eleves = Eleve.objects.all()
-            promotions_reussies = 0
-            promotions_echouees = 0
+            if request.data.get("asynchrone"):
+                job = JobService.soumettre(
+                    "promotion_automatique",
+                    {"annee_scolaire_id": annee_id, "methode_subdivision": methode_subdivision, "mode": mode},
+                    request.user,
+                )
+                return Response(job_soumis(job), status=status.HTTP_202_ACCEPTED)
 
-            for eleve in eleves:
-                resultat = PromotionService.promouvoir_eleve(
-                    str(eleve.id), annee_id, methode_subdivision
+            if mode == "lot":
+                rapport = PromotionService.promouvoir_lot(annee_id, methode_subdivision, classe_id=classe_id)
+            elif parallele:
+                rapport = CalculParalleleService.promouvoir(
+                    annee_id, methode_subdivision, **options_paralleles(request.data)
                 )
+            else:
+                eleves = Eleve.objects(classe=classe_id) if classe_id else Eleve.objects
+                rapport = PromotionService.promouvoir_eleves(
+                    [str(eleve.id) for eleve in eleves.only("id")],
+                    annee_id,
+                    methode_subdivision,
+                )
+
+            return Response({"message": "Promotion automatique terminée", **rapport})
+
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
 
-                if resultat["promotion_effectuee"]:
-                    promotions_reussies += 1
-                else:
-                    promotions_echouees += 1
+class SimulationPromotionAPIView(APIView):
+    permission_classes = [IsAuthenticated]
 
+    def post(self, request):
+        """Simulation de promotion avec d'autres seuils, sans écriture"""
+        if not (request.user.role in ["admin", "developpeur"]):
             return Response(
-                {
-                    "message": "Promotion automatique terminée",
-                    "promotions_reussies": promotions_reussies,
-                    "promotions_echouees": promotions_echouees,
-                }
+                {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
             )
 
-        except Exception as e:
+        annee_id = request.data.get("annee_scolaire_id")
+        if not annee_id:
+            return Response(
+                {"error": "annee_scolaire_id required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            seuils = {
+                classe_id: float(seuil)
+                for classe_id, seuil in (request.data.get("seuils") or {}).items()
+            }
+            resultats = SimulationPromotionService.simuler(
+                annee_id,
+                seuils=seuils,
+                marge=float(request.data.get("marge", 1.0)),
+                classe_id=request.data.get("classe_id"),
+                rafraichir=bool(request.data.get("rafraichir")),
+            )
+            return Response(resultats)
+
+        except (TypeError, ValueError, AttributeError, InvalidId) as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class JobAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        """État d'avancement d'un job"""
+        if not ObjectId.is_valid(pk):
+            return Response({"error": "Identifiant invalide"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            job = Job.objects.get(id=pk)
+        except Job.DoesNotExist:
+            return Response({"error": "Job non trouvé"}, status=status.HTTP_404_NOT_FOUND)
+
+        if request.user.role not in ["admin", "developpeur"] and id_reference(job, "demandePar") != str(request.user.id):
+            return Response(
+                {"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN
+            )
+
+        return Response(
+            {
+                "id": str(job.id),
+                "type": job.type,
+                "statut": job.statut,
+                "progression": job.progression,
+                "morceaux": len(job.morceaux),
+                "morceaux_termines": len(job.morceauxTermines),
+                "compteurs": job.compteurs,
+                "erreurs": [
+                    {"morceau": erreur.morceau, "message": erreur.message, "date": erreur.date}
+                    for erreur in job.erreurs
+                ],
+                "parametres": job.parametres,
+                "date_debut": job.dateDebut,
+                "date_fin": job.dateFin,
+                "derniere_activite": job.derniereActivite,
+            }
+        )
+
+
 class AffecterParentAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -579,21 +1045,198 @@ class GestionNotificationsAPIView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        """Marquer toutes les notifications comme lues"""
-        result = NotificationService.marquer_notifications_lues(str(request.user.id))
+        """Marquer toutes les notifications comme lues (filtres optionnels : type, referenceId, avant)"""
+        avant = request.data.get("avant")
+        if avant:
+            avant = lire_date(avant)
+            if avant is None:
+                return Response(
+                    {"error": "avant must be an ISO 8601 date"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+        reference_id = request.data.get("referenceId")
+        try:
+            result = NotificationService.marquer_notifications_lues(
+                str(request.user.id),
+                type_notification=request.data.get("type"),
+                reference_ids=[reference_id] if reference_id else None,
+                avant=avant,
+            )
+        except InvalidId:
+            return Response(
+                {"error": "referenceId invalide"}, status=status.HTTP_400_BAD_REQUEST
+            )
         return Response(result)
 
     def patch(self, request, pk):
         """Marquer une notification spécifique comme lue"""
         try:
-            notification = Notification.objects.get(id=pk, destinataire=request.user)
-            notification.lu = True
-            notification.save()
-            return Response({"status": "notification marquée comme lue"})
-        except Notification.DoesNotExist:
+            if NotificationService.marquer_notification_lue(str(request.user.id), pk):
+                return Response({"status": "notification marquée comme lue"})
+        except InvalidId:
+            pass
+        return Response(
+            {"error": "Notification introuvable"}, status=status.HTTP_404_NOT_FOUND
+        )
+
+
+class CompteursNotificationsAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Nombre de notifications (par type) et de messages non lus de l'utilisateur connecté"""
+        recalculer = request.query_params.get("recalculer") in ["1", "true"]
+        return Response(CompteurService.lire(str(request.user.id), recalculer))
+
+
+class ConversationLueAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk):
+        """Marquer comme lus tous les messages reçus d'un interlocuteur (filtre optionnel : avant)"""
+        avant = request.data.get("avant")
+        if avant:
+            avant = lire_date(avant)
+            if avant is None:
+                return Response(
+                    {"error": "avant must be an ISO 8601 date"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+        try:
+            result = MessageService.marquer_conversation_lue(str(request.user.id), pk, avant)
+        except InvalidId:
             return Response(
-                {"error": "Notification introuvable"}, status=status.HTTP_404_NOT_FOUND
+                {"error": "Interlocuteur invalide"}, status=status.HTTP_400_BAD_REQUEST
             )
+        return Response(result)
+
+
+class BoiteReceptionAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Conversations de l'utilisateur connecté, la plus récente d'abord (pagination : curseur, limite)"""
+        try:
+            result = ConversationService.boite_reception(
+                str(request.user.id), request.query_params.get("curseur"), int(request.query_params.get("limite", 0))
+            )
+        except ValueError:
+            return Response(
+                {"error": "curseur ou limite invalide"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(result)
+
+
+class FilConversationAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        """Messages échangés avec un interlocuteur, du plus récent au plus ancien (pagination : curseur, limite)"""
+        try:
+            result = ConversationService.fil(
+                str(request.user.id), pk,
+                request.query_params.get("curseur"), int(request.query_params.get("limite", 0))
+            )
+        except InvalidId:
+            return Response(
+                {"error": "Interlocuteur invalide"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        except ValueError:
+            return Response(
+                {"error": "curseur ou limite invalide"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({
+            "messages": MessageSerializer(result["messages"], many=True).data,
+            "suivant": result["suivant"],
+        })
+
+
+class RechercheAPIView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Recherche plein texte dans les messages et les devoirs visibles par l'utilisateur (q, type, page, limite)"""
+        texte = request.query_params.get("q", "").strip()
+        if not texte:
+            return Response({"error": "q required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        types = [t for t in request.query_params.get("type", "").split(",") if t]
+        if any(t not in ["message", "devoir"] for t in types):
+            return Response(
+                {"error": "type must be message and/or devoir"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            page = int(request.query_params.get("page", 1))
+            limite = int(request.query_params.get("limite", 0))
+        except ValueError:
+            return Response(
+                {"error": "page ou limite invalide"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            result = RechercheService.rechercher(request.user, texte, types, page, limite)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+
+async def notifications_stream(request):
+    """
+    Flux Server-Sent Events des nouvelles notifications de l'utilisateur (serveur ASGI requis).
+    Le token est lu dans l'en-tête Authorization (Bearer) ou, pour EventSource, dans le paramètre token :
+    seul un jeton d'accès signé (courte durée) y est accepté, une URL finissant dans les journaux.
+    """
+    if request.method != "GET":
+        return JsonResponse({"error": "Méthode non autorisée"}, status=405)
+
+    try:
+        if cle_requete(request):
+            identite = await sync_to_async(identifier)(request)
+        elif request.GET.get("token"):
+            if ":" not in request.GET["token"]:
+                return JsonResponse({"error": "Seul un jeton d'accès signé est accepté dans l'URL"}, status=401)
+            identite = await sync_to_async(MongoTokenAuthentication().authenticate_credentials)(request.GET["token"])
+        else:
+            return JsonResponse({"error": "Aucun token fourni"}, status=401)
+    except exceptions.AuthenticationFailed as e:
+        return JsonResponse({"error": str(e.detail)}, status=401)
+    user = identite[0]
+
+    user_id = str(user.id)
+    dernier_id = request.headers.get("Last-Event-ID")
+    manquees = []
+    if dernier_id:
+        manquees = await sync_to_async(rattrapage)(user_id, dernier_id)
+
+    def message(identifiant, notification):
+        return f"id: {identifiant}\nevent: notification\ndata: {json.dumps(notification)}\n\n"
+
+    async def flux():
+        file = await abonnements.abonner(user_id)
+        try:
+            yield "retry: 5000\n\n"
+            for identifiant, notification in manquees:
+                yield message(identifiant, notification)
+            while True:
+                try:
+                    identifiant, notification = await asyncio.wait_for(
+                        file.get(), timeout=getattr(settings, "NOTIFICATIONS_STREAM_HEARTBEAT", 20)
+                    )
+                except asyncio.TimeoutError:
+                    # Commentaire SSE : garde la connexion ouverte à travers les proxys
+                    yield ": ping\n\n"
+                    continue
+                yield message(identifiant, notification)
+        finally:
+            abonnements.desabonner(user_id, file)
+
+    response = StreamingHttpResponse(flux(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
 
 
 class AffecterProfesseurAPIView(APIView):
@@ -173,3 +173,52 @@ CORS_ALLOW_HEADERS = [
 # Configuration pour servir les fichiers média
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+
+# Nombre de threads exécutant les jobs en arrière-plan (calcul des notes, promotion)
+JOBS_WORKERS = int(os.environ.get("JOBS_WORKERS", "2"))
+
+# Nombre de processus pour les calculs parallèles (par défaut : nombre de cœurs)
+CALCUL_PARALLELISME = int(os.environ.get("CALCUL_PARALLELISME", "0")) or None
+
+# Durée de validité (secondes) de l'instantané des moyennes utilisé par la simulation de promotion
+SIMULATION_PROMOTION_TTL = int(os.environ.get("SIMULATION_PROMOTION_TTL", "300"))
+# Nombre maximum d'années gardées en cache (les moins récemment simulées sont oubliées)
+SIMULATION_PROMOTION_ANNEES = int(os.environ.get("SIMULATION_PROMOTION_ANNEES", "4"))
+
+# Diffusion des notifications (outbox) : traitement immédiat par un pool de threads dédié (nombre
+# de threads) en plus de la commande `diffuser_notifications`, taille des lots et nombre maximum de
+# tentatives par entrée
+NOTIFICATIONS_DIFFUSION_IMMEDIATE = os.environ.get("NOTIFICATIONS_DIFFUSION_IMMEDIATE", "1") == "1"
+NOTIFICATIONS_DIFFUSION_WORKERS = int(os.environ.get("NOTIFICATIONS_DIFFUSION_WORKERS", "1"))
+NOTIFICATIONS_TAILLE_LOT = int(os.environ.get("NOTIFICATIONS_TAILLE_LOT", "100"))
+NOTIFICATIONS_TENTATIVES_MAX = int(os.environ.get("NOTIFICATIONS_TENTATIVES_MAX", "5"))
+
+# Flux SSE des notifications (/api/notifications/stream/) : intervalle de lecture de MongoDB et
+# délai entre deux commentaires de maintien de connexion, en secondes
+NOTIFICATIONS_STREAM_INTERVALLE = float(os.environ.get("NOTIFICATIONS_STREAM_INTERVALLE", "2"))
+NOTIFICATIONS_STREAM_HEARTBEAT = float(os.environ.get("NOTIFICATIONS_STREAM_HEARTBEAT", "20"))
+
+# Rétention des notifications : les notifications lues envoyées depuis plus de
+# NOTIFICATIONS_RETENTION_JOURS sont déplacées dans l'archive (commande `archiver_notifications`),
+# où elles expirent après NOTIFICATIONS_ARCHIVE_JOURS (0 : conservées sans limite)
+NOTIFICATIONS_RETENTION_JOURS = int(os.environ.get("NOTIFICATIONS_RETENTION_JOURS", "60"))
+NOTIFICATIONS_ARCHIVE_JOURS = int(os.environ.get("NOTIFICATIONS_ARCHIVE_JOURS", "365"))
+
+# Regroupement des notifications : les notifications d'un même type pour un même destinataire
+# créées moins de NOTIFICATIONS_REGROUPEMENT_FENETRE secondes après la première non lue sont
+# fusionnées dans celle-ci (0 : une notification par devoir/message)
+NOTIFICATIONS_REGROUPEMENT_FENETRE = int(os.environ.get("NOTIFICATIONS_REGROUPEMENT_FENETRE", "0"))
+
+# Cache des tokens validés (par processus) : nombre maximum d'entrées et durée de validité en
+# secondes ; un token supprimé dans un autre processus reste accepté au plus AUTH_CACHE_TTL secondes
+AUTH_CACHE_TAILLE = int(os.environ.get("AUTH_CACHE_TAILLE", "1024"))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", "60"))
+
+# Durée de vie d'un token de session (jours) ; MongoDB supprime les tokens expirés (index TTL)
+AUTH_TOKEN_DUREE_JOURS = int(os.environ.get("AUTH_TOKEN_DUREE_JOURS", "30"))
+
+# Jetons d'accès signés (login avec "format": "signe") : durée de validité en secondes, et délai
+# de rechargement de la liste des jetons révoqués (une déconnexion est vue par les autres processus
+# au plus tard après ce délai)
+AUTH_JETON_DUREE = int(os.environ.get("AUTH_JETON_DUREE", "900"))
+AUTH_REVOCATIONS_INTERVALLE = float(os.environ.get("AUTH_REVOCATIONS_INTERVALLE", "30"))